@@ -0,0 +1,465 @@
+"""
+Inference backends for the bolt detector.
+
+The model can run through one of:
+    pytorch   - ultralytics YOLO on best.pt (the original path)
+    onnx      - ONNX Runtime on CPU, using best.onnx exported from best.pt
+    openvino  - OpenVINO on CPU, using an IR exported from best.pt
+    stub      - no model at all: synthetic boxes through the real pre- and
+                post-processing, for benchmarks and tests without best.pt
+
+The ONNX and OpenVINO artifacts are exported once with ultralytics and
+cached next to best.pt; an INT8-quantized variant can be selected as well.
+Once exported, those two backends need neither torch nor ultralytics, so
+the heavy imports stay off the startup path.
+
+Every backend is called like an ultralytics model, backend(images, conf=...),
+and returns one Detections object per image, so the rest of the pipeline
+does not depend on which backend produced the boxes.
+
+The backend is chosen with the DETECTION_BACKEND environment variable (or
+--backend on the worker) and DETECTION_INT8=1 (or --int8).
+
+Pre-export the artifacts with:
+    python backends.py --export onnx [--int8]
+"""
+
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_PATH = os.path.join(SCRIPT_DIR, "best.pt")
+DATA_YAML_PATH = os.path.join(SCRIPT_DIR, "data.yaml")
+
+BACKEND_PYTORCH = 'pytorch'
+BACKEND_ONNX = 'onnx'
+BACKEND_OPENVINO = 'openvino'
+BACKEND_STUB = 'stub'
+BACKENDS = (BACKEND_PYTORCH, BACKEND_ONNX, BACKEND_OPENVINO, BACKEND_STUB)
+
+# Defaults, overridable from the environment
+DEFAULT_BACKEND = os.environ.get('DETECTION_BACKEND', BACKEND_PYTORCH)
+DEFAULT_INT8 = os.environ.get('DETECTION_INT8', '0').lower() in ('1', 'true', 'yes')
+
+# Input size the model was trained and exported at
+DEFAULT_IMGSZ = 640
+
+# ultralytics defaults, so every backend filters boxes the same way
+DEFAULT_CONF = 0.25
+DEFAULT_IOU = 0.7
+DEFAULT_MAX_DET = 300
+
+# Letterbox padding value used by ultralytics
+LETTERBOX_COLOR = (114, 114, 114)
+
+# Simulated forward pass time per image of the stub backend
+STUB_MS = float(os.environ.get('DETECTION_STUB_MS', '0'))
+
+
+class Detections:
+    """
+    Detections for one image, in the same format for every backend.
+
+    boxes are (N, 4) float32 [x1, y1, x2, y2] in pixels of the original
+    image, confidences (N,) float32 and class_ids (N,) int. names maps class
+    ids to class names.
+    """
+
+    def __init__(self, boxes, confidences, class_ids, orig_img, names, raw=None):
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.confidences = np.asarray(confidences, dtype=np.float32).reshape(-1)
+        self.class_ids = np.asarray(class_ids, dtype=np.int64).reshape(-1)
+        self.orig_img = orig_img
+        self.names = names
+        # Backend-specific result (the ultralytics Results for pytorch)
+        self.raw = raw
+
+    def __len__(self):
+        return len(self.confidences)
+
+    def plot(self):
+        """Return a copy of the image with the boxes and labels drawn on it."""
+        if self.raw is not None:
+            return self.raw.plot()
+
+        annotated = self.orig_img.copy()
+        for box, confidence, class_id in zip(self.boxes, self.confidences, self.class_ids):
+            x1, y1, x2, y2 = (int(round(v)) for v in box)
+            color = class_color(int(class_id))
+            label = f"{self.names.get(int(class_id), int(class_id))} {confidence:.2f}"
+            cv2.rectangle(annotated, (x1, y1), (x2, y2), color, 2)
+            (text_w, text_h), baseline = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+            top = max(0, y1 - text_h - baseline - 2)
+            cv2.rectangle(annotated, (x1, top), (x1 + text_w + 4, top + text_h + baseline + 2), color, -1)
+            cv2.putText(annotated, label, (x1 + 2, top + text_h + 1),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+        return annotated
+
+
+def class_color(class_id):
+    """BGR colour for a class: green for good bolts, red for bad, orange for missing."""
+    palette = [(113, 204, 46), (60, 76, 231), (18, 156, 243)]
+    return palette[class_id % len(palette)]
+
+
+def names_from_labels(class_labels):
+    return {i: name for i, name in enumerate(class_labels or [])}
+
+
+# --- Pre/post-processing shared by the exported backends ---
+
+def letterbox(img, imgsz=DEFAULT_IMGSZ):
+    """
+    Resize keeping the aspect ratio and pad to imgsz x imgsz, as ultralytics
+    does. Returns the padded image, the scale gain and the (left, top) pad.
+    """
+    height, width = img.shape[:2]
+    gain = min(imgsz / height, imgsz / width)
+    new_w, new_h = int(round(width * gain)), int(round(height * gain))
+    if (new_w, new_h) != (width, height):
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    pad_w, pad_h = (imgsz - new_w) / 2, (imgsz - new_h) / 2
+    left, right = int(round(pad_w - 0.1)), int(round(pad_w + 0.1))
+    top, bottom = int(round(pad_h - 0.1)), int(round(pad_h + 0.1))
+    img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=LETTERBOX_COLOR)
+    return img, gain, (left, top)
+
+
+def preprocess(images, imgsz=DEFAULT_IMGSZ):
+    """Letterbox a list of BGR images into one float32 NCHW RGB batch in [0, 1]."""
+    batch = np.empty((len(images), 3, imgsz, imgsz), dtype=np.float32)
+    transforms = []
+    for i, img in enumerate(images):
+        padded, gain, pad = letterbox(img, imgsz)
+        batch[i] = padded[:, :, ::-1].transpose(2, 0, 1)
+        transforms.append((gain, pad))
+    batch *= 1.0 / 255.0
+    return batch, transforms
+
+
+def nms(boxes, scores, iou_threshold):
+    """Greedy non-maximum suppression. Returns the indices of the boxes kept."""
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1).clip(0) * (y2 - y1).clip(0)
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        if order.size == 1:
+            break
+        rest = order[1:]
+        inter_w = (np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest])).clip(0)
+        inter_h = (np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest])).clip(0)
+        inter = inter_w * inter_h
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+def class_aware_nms(boxes, scores, class_ids, iou_threshold):
+    """NMS applied per class, by offsetting each class into its own region."""
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = class_ids.astype(np.float32)[:, None] * (boxes.max() + 1)
+    return nms(boxes + offsets, scores, iou_threshold)
+
+
+def nonempty_boxes(boxes):
+    """Mask of the (N, 4) x1, y1, x2, y2 boxes with a positive width and height."""
+    return (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+
+
+def postprocess(output, transforms, images, names, conf=DEFAULT_CONF, iou=DEFAULT_IOU,
+                classes=None, max_det=DEFAULT_MAX_DET):
+    """
+    Decode raw YOLOv8 output of shape (batch, 4 + num_classes, anchors) into
+    Detections in original image coordinates.
+    """
+    results = []
+    for prediction, (gain, (left, top)), img in zip(output, transforms, images):
+        prediction = prediction.T
+        class_scores = prediction[:, 4:]
+        class_ids = class_scores.argmax(axis=1)
+        scores = class_scores[np.arange(len(class_ids)), class_ids]
+
+        mask = scores > conf
+        if classes is not None:
+            mask &= np.isin(class_ids, classes)
+        xywh, scores, class_ids = prediction[mask, :4], scores[mask], class_ids[mask]
+
+        boxes = np.empty_like(xywh)
+        boxes[:, 0] = xywh[:, 0] - xywh[:, 2] / 2
+        boxes[:, 1] = xywh[:, 1] - xywh[:, 3] / 2
+        boxes[:, 2] = xywh[:, 0] + xywh[:, 2] / 2
+        boxes[:, 3] = xywh[:, 1] + xywh[:, 3] / 2
+
+        # Undo the letterbox, then drop the boxes left with no area by the clipping
+        boxes[:, [0, 2]] -= left
+        boxes[:, [1, 3]] -= top
+        boxes /= gain
+        height, width = img.shape[:2]
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+        valid = nonempty_boxes(boxes)
+        boxes, scores, class_ids = boxes[valid], scores[valid], class_ids[valid]
+
+        keep = class_aware_nms(boxes, scores, class_ids, iou)[:max_det]
+        boxes, scores, class_ids = boxes[keep], scores[keep], class_ids[keep]
+
+        results.append(Detections(boxes, scores, class_ids, img, names))
+    return results
+
+
+# --- Export and caching of the CPU artifacts ---
+
+def _is_fresh(artifact_path, model_path):
+    """True if the cached artifact exists and is newer than the weights."""
+    if not os.path.exists(artifact_path):
+        return False
+    if not os.path.exists(model_path):
+        return True
+    return os.path.getmtime(artifact_path) >= os.path.getmtime(model_path)
+
+
+def onnx_path_for(model_path, int8=False):
+    base = os.path.splitext(model_path)[0]
+    return f"{base}.int8.onnx" if int8 else f"{base}.onnx"
+
+
+def openvino_path_for(model_path, int8=False):
+    base = os.path.splitext(model_path)[0]
+    name = os.path.basename(base)
+    model_dir = f"{base}_int8_openvino_model" if int8 else f"{base}_openvino_model"
+    return os.path.join(model_dir, f"{name}.xml")
+
+
+def export_onnx(model_path=MODEL_PATH, int8=False, imgsz=DEFAULT_IMGSZ):
+    """
+    Export best.pt to ONNX (with a dynamic batch axis) once and cache it next
+    to the weights. With int8=True, the exported model is additionally
+    quantized to INT8 with ONNX Runtime dynamic quantization. A model_path
+    that already is an .onnx file (e.g. best.int8.onnx copied to the Pi on
+    its own) is used as is.
+    """
+    if model_path.endswith('.onnx'):
+        if not os.path.exists(model_path):
+            raise Exception(f"ONNX model not found at {model_path}")
+        return model_path
+    fp32_path = onnx_path_for(model_path)
+    if not _is_fresh(fp32_path, model_path):
+        print(f"Exporting {model_path} to ONNX...", file=sys.stderr, flush=True)
+        from ultralytics import YOLO
+        exported = YOLO(model_path).export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+        if os.path.abspath(exported) != os.path.abspath(fp32_path):
+            os.replace(exported, fp32_path)
+    if not int8:
+        return fp32_path
+
+    int8_path = onnx_path_for(model_path, int8=True)
+    if not _is_fresh(int8_path, fp32_path):
+        print(f"Quantizing {fp32_path} to INT8...", file=sys.stderr, flush=True)
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QUInt8)
+    return int8_path
+
+
+def export_openvino(model_path=MODEL_PATH, int8=False, imgsz=DEFAULT_IMGSZ):
+    """
+    Export best.pt to an OpenVINO IR once and cache it next to the weights.
+    INT8 export calibrates on the validation images listed in data.yaml.
+    """
+    xml_path = openvino_path_for(model_path, int8)
+    if not _is_fresh(xml_path, model_path):
+        print(f"Exporting {model_path} to OpenVINO{' INT8' if int8 else ''}...", file=sys.stderr, flush=True)
+        from ultralytics import YOLO
+        exported_dir = YOLO(model_path).export(format='openvino', imgsz=imgsz, dynamic=True,
+                                               int8=int8, data=DATA_YAML_PATH)
+        exported_xml = os.path.join(exported_dir, os.path.basename(xml_path))
+        if os.path.abspath(exported_xml) != os.path.abspath(xml_path):
+            os.makedirs(os.path.dirname(xml_path), exist_ok=True)
+            for suffix in ('.xml', '.bin'):
+                os.replace(os.path.splitext(exported_xml)[0] + suffix,
+                           os.path.splitext(xml_path)[0] + suffix)
+    return xml_path
+
+
+# --- Backends ---
+
+class PyTorchBackend:
+    """ultralytics YOLO on the .pt weights."""
+
+    name = BACKEND_PYTORCH
+
+    def __init__(self, model_path, names, imgsz=DEFAULT_IMGSZ, threads=None):
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        from ultralytics import YOLO
+        self.model = YOLO(model_path)
+        self.names = names or dict(self.model.names)
+        self.imgsz = imgsz
+        self.artifact_path = model_path
+
+    def __call__(self, images, conf=DEFAULT_CONF, iou=DEFAULT_IOU, classes=None,
+                 max_det=DEFAULT_MAX_DET, verbose=False, **kwargs):
+        if not isinstance(images, list):
+            images = [images]
+        results = self.model(images, conf=conf, iou=iou, classes=classes, max_det=max_det,
+                             imgsz=kwargs.get('imgsz', self.imgsz), verbose=verbose)
+        detections = []
+        for img, result in zip(images, results):
+            boxes = result.boxes
+            detections.append(Detections(boxes.xyxy.cpu().numpy(),
+                                         boxes.conf.cpu().numpy(),
+                                         boxes.cls.cpu().numpy().astype(np.int64),
+                                         img, self.names, raw=result))
+        return detections
+
+
+class OnnxRuntimeBackend:
+    """ONNX Runtime on CPU."""
+
+    name = BACKEND_ONNX
+
+    def __init__(self, model_path, names, int8=False, imgsz=DEFAULT_IMGSZ, threads=None):
+        import onnxruntime
+        self.artifact_path = export_onnx(model_path, int8, imgsz)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(self.artifact_path, options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.names = names
+        self.imgsz = imgsz
+
+    def __call__(self, images, conf=DEFAULT_CONF, iou=DEFAULT_IOU, classes=None,
+                 max_det=DEFAULT_MAX_DET, verbose=False, **kwargs):
+        if not isinstance(images, list):
+            images = [images]
+        batch, transforms = preprocess(images, kwargs.get('imgsz', self.imgsz))
+        output = self.session.run(None, {self.input_name: batch})[0]
+        return postprocess(output, transforms, images, self.names, conf, iou, classes, max_det)
+
+
+class OpenVinoBackend:
+    """OpenVINO on CPU."""
+
+    name = BACKEND_OPENVINO
+
+    def __init__(self, model_path, names, int8=False, imgsz=DEFAULT_IMGSZ, threads=None):
+        import openvino
+        self.artifact_path = export_openvino(model_path, int8, imgsz)
+        core = openvino.Core()
+        config = {'PERFORMANCE_HINT': 'LATENCY'}
+        if threads:
+            config['INFERENCE_NUM_THREADS'] = threads
+        self.compiled = core.compile_model(core.read_model(self.artifact_path), 'CPU', config)
+        self.names = names
+        self.imgsz = imgsz
+
+    def __call__(self, images, conf=DEFAULT_CONF, iou=DEFAULT_IOU, classes=None,
+                 max_det=DEFAULT_MAX_DET, verbose=False, **kwargs):
+        if not isinstance(images, list):
+            images = [images]
+        batch, transforms = preprocess(images, kwargs.get('imgsz', self.imgsz))
+        output = self.compiled(batch)[0]
+        return postprocess(output, transforms, images, self.names, conf, iou, classes, max_det)
+
+
+class StubBackend:
+    """
+    Stand-in for the model that needs no weights nor runtime. Each image is
+    letterboxed like for a real model, a synthetic YOLOv8 output with a few
+    overlapping boxes (seeded from the image content, so repeatable) is
+    built, and it is decoded by the shared postprocess and NMS. stub_ms of
+    sleep per image stands in for the forward pass.
+    """
+
+    name = BACKEND_STUB
+    artifact_path = BACKEND_STUB
+
+    # Boxes per image, each predicted by a few neighbouring anchors
+    BOXES = 5
+    DUPLICATES = 3
+
+    def __init__(self, names, imgsz=DEFAULT_IMGSZ, stub_ms=STUB_MS):
+        self.names = names or {0: 'object'}
+        self.imgsz = imgsz
+        self.stub_ms = stub_ms
+
+    def __call__(self, images, conf=DEFAULT_CONF, iou=DEFAULT_IOU, classes=None,
+                 max_det=DEFAULT_MAX_DET, verbose=False, **kwargs):
+        if not isinstance(images, list):
+            images = [images]
+        imgsz = kwargs.get('imgsz', self.imgsz)
+        batch, transforms = preprocess(images, imgsz)
+        anchors = sum((imgsz // stride) ** 2 for stride in (8, 16, 32))
+        output = np.zeros((len(images), 4 + len(self.names), anchors), dtype=np.float32)
+        for i, img in enumerate(images):
+            rng = np.random.default_rng(int(img[::32, ::32].sum()))
+            for b in range(self.BOXES):
+                center = rng.uniform(0.1, 0.9, 2) * imgsz
+                size = rng.uniform(0.03, 0.1, 2) * imgsz
+                class_id = int(rng.integers(len(self.names)))
+                score = rng.uniform(0.4, 0.95)
+                for d in range(self.DUPLICATES):
+                    anchor = (b * self.DUPLICATES + d) * (anchors // (self.BOXES * self.DUPLICATES))
+                    output[i, :2, anchor] = center + rng.normal(0, 0.5, 2)
+                    output[i, 2:4, anchor] = size
+                    output[i, 4 + class_id, anchor] = score - 0.05 * d
+        if self.stub_ms:
+            time.sleep(self.stub_ms * len(images) / 1000)
+        return postprocess(output, transforms, images, self.names, conf, iou, classes, max_det)
+
+
+def load_backend(backend=None, model_path=MODEL_PATH, class_labels=None, int8=None, imgsz=DEFAULT_IMGSZ,
+                 threads=None):
+    """
+    Create the configured backend for the given weights. threads caps the
+    CPU threads used by inference (default: the runtime's own choice),
+    e.g. when several model instances share a machine.
+    """
+    backend = (backend or DEFAULT_BACKEND).lower()
+    int8 = DEFAULT_INT8 if int8 is None else int8
+    names = names_from_labels(class_labels)
+
+    start = time.perf_counter()
+    if backend == BACKEND_PYTORCH:
+        if int8:
+            print("Warning: INT8 is not available for the pytorch backend, using FP32", file=sys.stderr, flush=True)
+        model = PyTorchBackend(model_path, names, imgsz, threads)
+    elif backend == BACKEND_ONNX:
+        model = OnnxRuntimeBackend(model_path, names, int8, imgsz, threads)
+    elif backend == BACKEND_OPENVINO:
+        model = OpenVinoBackend(model_path, names, int8, imgsz, threads)
+    elif backend == BACKEND_STUB:
+        model = StubBackend(names, imgsz)
+    else:
+        raise Exception(f"Unknown detection backend '{backend}', expected one of {', '.join(BACKENDS)}")
+    model.int8 = bool(int8) and backend in (BACKEND_ONNX, BACKEND_OPENVINO)
+    print(f"Loaded {backend}{' INT8' if model.int8 else ''} backend from {model.artifact_path} "
+          f"in {(time.perf_counter() - start) * 1000:.0f}ms", file=sys.stderr, flush=True)
+    return model
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export and cache the CPU inference artifacts.")
+    parser.add_argument("--export", choices=[BACKEND_ONNX, BACKEND_OPENVINO], required=True)
+    parser.add_argument("--int8", action="store_true", help="also build the INT8-quantized variant")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--imgsz", type=int, default=DEFAULT_IMGSZ)
+    args = parser.parse_args()
+
+    if args.export == BACKEND_ONNX:
+        print(export_onnx(args.model, args.int8, args.imgsz))
+    else:
+        print(export_openvino(args.model, args.int8, args.imgsz))
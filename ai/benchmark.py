@@ -0,0 +1,369 @@
+"""
+Benchmark of the detection pipeline.
+
+    python benchmark.py [--backend NAME] [--int8] [--images PATH ...]
+        [--resolutions VGA,SVGA,XGA] [--iterations 50] [--batch-sizes 1,2,4,8]
+        [--output results.json]
+    python benchmark.py --compare baseline.json candidate.json
+
+Measured, for one backend:
+    cold_start   import of process_image plus model load, in a fresh
+                 interpreter (--cold-runs times)
+    latency      warm single-frame latency per ESP32-CAM resolution, for the
+                 whole pipeline and for each stage: decode (JPEG), inference,
+                 plot and encode (JPEG), with mean and p50/p95/p99
+    throughput   images per second of one forward pass over batches of
+                 --batch-sizes frames
+    peak_rss_mb  peak resident memory of the benchmark process and of the
+                 cold-start runs
+
+Frames are synthetic (a deterministic scene of bolt-like circles) unless
+sample images are given with --images; either way they are resized to each
+resolution and JPEG-encoded once, as the camera would send them.
+
+With --backend stub no weights or inference runtime are needed, so the
+harness runs on any machine; the stub still goes through the real
+pre/post-processing, plotting and encoding. Results are written as JSON
+together with the commit, backend and machine they were measured on; use
+--compare to print the relative change between two result files.
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from backends import BACKENDS, DEFAULT_BACKEND, DEFAULT_INT8, SCRIPT_DIR
+
+# ESP32-CAM frame sizes (framesize_t names)
+RESOLUTIONS = {
+    'QVGA': (320, 240),
+    'VGA': (640, 480),
+    'SVGA': (800, 600),
+    'XGA': (1024, 768),
+    'HD': (1280, 720),
+    'SXGA': (1280, 1024),
+    'UXGA': (1600, 1200),
+}
+
+# ESP32-CAM default JPEG quality is 12 on its 0-63 scale; about 80 for OpenCV
+CAMERA_JPEG_QUALITY = 80
+
+PERCENTILES = (50, 95, 99)
+STAGES = ('decode_ms', 'inference_ms', 'plot_ms', 'encode_ms', 'total_ms')
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(samples):
+    """Mean, min, max and percentiles of a list of milliseconds."""
+    values = np.asarray(samples, dtype=np.float64)
+    summary = {'mean': float(values.mean()), 'min': float(values.min()), 'max': float(values.max())}
+    for p in PERCENTILES:
+        summary[f'p{p}'] = float(np.percentile(values, p))
+    return {name: round(value, 3) for name, value in summary.items()}
+
+
+def synthetic_frame(width, height, seed=0):
+    """A repeatable test scene: gradient background with bolt-like circles."""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(60, 160, width, dtype=np.float32)
+    y = np.linspace(40, 120, height, dtype=np.float32)[:, None]
+    gray = (x + y).astype(np.uint8)
+    img = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+    for _ in range(12):
+        center = (int(rng.integers(width)), int(rng.integers(height)))
+        radius = int(rng.integers(max(2, width // 80), max(3, width // 25)))
+        shade = int(rng.integers(30, 220))
+        cv2.circle(img, center, radius, (shade, shade, shade), -1, cv2.LINE_AA)
+        cv2.circle(img, center, max(1, radius // 2), (20, 20, 20), -1, cv2.LINE_AA)
+    noise = rng.normal(0, 4, img.shape)
+    return np.clip(img + noise, 0, 255).astype(np.uint8)
+
+
+def load_sample_images(paths):
+    """Read the images named by files, directories or glob patterns."""
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = sorted(glob.glob(os.path.join(path, '*.jp*g')) + glob.glob(os.path.join(path, '*.png')))
+        else:
+            matches = sorted(glob.glob(path)) or [path]
+        for match in matches:
+            img = cv2.imread(match)
+            if img is None:
+                print(f"Warning: could not read {match}", file=sys.stderr, flush=True)
+            else:
+                images.append(img)
+    if not images:
+        raise Exception("No sample images could be read")
+    return images
+
+
+def make_frames(width, height, samples=None, count=4):
+    """JPEG-encoded frames at a resolution, from the samples or synthetic."""
+    if samples:
+        sources = [cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA) for img in samples]
+    else:
+        sources = [synthetic_frame(width, height, seed) for seed in range(count)]
+    params = [cv2.IMWRITE_JPEG_QUALITY, CAMERA_JPEG_QUALITY]
+    return [cv2.imencode('.jpg', img, params)[1].tobytes() for img in sources]
+
+
+# --- Measurements ---
+
+def measure_cold_start(backend, int8, runs):
+    """Run the import and model load in fresh interpreters."""
+    results = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        command = [sys.executable, os.path.abspath(__file__), '--probe-cold-start', '--backend', backend]
+        if int8:
+            command.append('--int8')
+        completed = subprocess.run(command, cwd=SCRIPT_DIR, capture_output=True)
+        wall_ms = (time.perf_counter() - start) * 1000
+        if completed.returncode != 0:
+            raise Exception(f"Cold start run failed: {completed.stderr.decode(errors='replace').strip()}")
+        probe = json.loads(completed.stdout.decode().strip().splitlines()[-1])
+        probe['process_ms'] = wall_ms
+        results.append(probe)
+    return {
+        'runs': runs,
+        'import_ms': summarize([r['import_ms'] for r in results]),
+        'load_ms': summarize([r['load_ms'] for r in results]),
+        'total_ms': summarize([r['import_ms'] + r['load_ms'] for r in results]),
+        'process_ms': summarize([r['process_ms'] for r in results]),
+        'peak_rss_mb': round(max(r['peak_rss_mb'] for r in results), 1),
+    }
+
+
+def probe_cold_start(backend, int8):
+    """Child side of measure_cold_start: print the timings as JSON."""
+    start = time.perf_counter()
+    import process_image
+    from worker import redirect_stdout
+    import_ms = (time.perf_counter() - start) * 1000
+    out = redirect_stdout()
+
+    start = time.perf_counter()
+    process_image.load_model(backend=backend, int8=int8)
+    load_ms = (time.perf_counter() - start) * 1000
+    out.write(json.dumps({'import_ms': import_ms, 'load_ms': load_ms,
+                          'peak_rss_mb': peak_rss_mb()}).encode() + b'\n')
+    out.flush()
+
+
+def measure_latency(model, frames, warmup, iterations):
+    """Warm single-frame latency of decode, inference, plot and encode."""
+    from process_image import decode_image, detect, encode_image, plot_result
+
+    samples = {stage: [] for stage in STAGES}
+    detections = 0
+    for i in range(warmup + iterations):
+        data = frames[i % len(frames)]
+        timings = {}
+        start = time.perf_counter()
+        img = decode_image(data)
+        timings['decode_ms'] = (time.perf_counter() - start) * 1000
+        result = detect(model, img, timings)
+        annotated_img = plot_result(result, timings)
+        encode_start = time.perf_counter()
+        encode_image(annotated_img)
+        timings['encode_ms'] = (time.perf_counter() - encode_start) * 1000
+        timings['total_ms'] = (time.perf_counter() - start) * 1000
+        if i >= warmup:
+            detections += len(result)
+            for stage in STAGES:
+                samples[stage].append(timings[stage])
+    stages = {stage: summarize(values) for stage, values in samples.items()}
+    stages['detections_per_frame'] = round(detections / iterations, 2)
+    return stages
+
+
+def measure_throughput(model, frames, batch_size, warmup, iterations):
+    """Images per second of batched forward passes on decoded frames."""
+    from process_image import CONFIDENCE_THRESHOLD, decode_image
+
+    images = [decode_image(frames[i % len(frames)]) for i in range(batch_size)]
+    samples = []
+    for i in range(warmup + iterations):
+        start = time.perf_counter()
+        model(images, conf=CONFIDENCE_THRESHOLD, verbose=False)
+        if i >= warmup:
+            samples.append((time.perf_counter() - start) * 1000)
+    return {
+        'batch_size': batch_size,
+        'batch_ms': summarize(samples),
+        'images_per_s': round(batch_size * len(samples) / (sum(samples) / 1000), 2),
+    }
+
+
+def git_commit():
+    try:
+        completed = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                                   capture_output=True, timeout=10)
+        return completed.stdout.decode().strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def environment(model, args):
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': git_commit(),
+        'backend': model.name,
+        'int8': bool(getattr(model, 'int8', False)),
+        'artifact': model.artifact_path,
+        'frames': 'samples' if args.images else 'synthetic',
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def run(args):
+    from process_image import load_class_labels, load_model
+
+    results = {}
+    if args.cold_runs:
+        print(f"Cold start ({args.cold_runs} runs)...", file=sys.stderr, flush=True)
+        results['cold_start'] = measure_cold_start(args.backend, args.int8, args.cold_runs)
+
+    model = load_model(backend=args.backend, int8=args.int8, class_labels=load_class_labels())
+    results['environment'] = environment(model, args)
+    samples = load_sample_images(args.images) if args.images else None
+
+    results['latency'] = {}
+    for name in args.resolutions:
+        width, height = RESOLUTIONS[name]
+        print(f"Latency at {name} ({width}x{height})...", file=sys.stderr, flush=True)
+        frames = make_frames(width, height, samples)
+        latency = measure_latency(model, frames, args.warmup, args.iterations)
+        latency['resolution'] = [width, height]
+        results['latency'][name] = latency
+
+    width, height = RESOLUTIONS[args.resolutions[0]]
+    frames = make_frames(width, height, samples)
+    results['throughput'] = []
+    for batch_size in args.batch_sizes:
+        print(f"Throughput with batches of {batch_size}...", file=sys.stderr, flush=True)
+        results['throughput'].append(measure_throughput(model, frames, batch_size, args.warmup,
+                                                        max(1, args.iterations // batch_size)))
+    results['throughput_resolution'] = [width, height]
+    results['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    return results
+
+
+# --- Comparison ---
+
+def flatten(results):
+    """Pick the comparable figures of a result file as {name: value}."""
+    figures = {}
+    for phase in ('import_ms', 'load_ms', 'total_ms'):
+        if phase in results.get('cold_start', {}):
+            figures[f'cold_start.{phase}.p50'] = results['cold_start'][phase]['p50']
+    for name, latency in results.get('latency', {}).items():
+        for stage in STAGES:
+            for stat in ('p50', 'p95', 'p99'):
+                figures[f'latency.{name}.{stage}.{stat}'] = latency[stage][stat]
+    for entry in results.get('throughput', []):
+        figures[f"throughput.batch{entry['batch_size']}.images_per_s"] = entry['images_per_s']
+    if 'peak_rss_mb' in results:
+        figures['peak_rss_mb'] = results['peak_rss_mb']
+    return figures
+
+
+def compare(baseline_path, candidate_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(candidate_path) as f:
+        candidate = json.load(f)
+    for label, results in (('baseline', baseline), ('candidate', candidate)):
+        env = results.get('environment', {})
+        print(f"{label}: {env.get('backend')}{' INT8' if env.get('int8') else ''} "
+              f"@ {env.get('commit')} on {env.get('platform')}")
+
+    before, after = flatten(baseline), flatten(candidate)
+    for name in sorted(set(before) & set(after)):
+        if before[name]:
+            change = (after[name] - before[name]) / before[name] * 100
+            print(f"{name:50s} {before[name]:10.2f} -> {after[name]:10.2f} ({change:+.1f}%)")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the detection pipeline.")
+    parser.add_argument("--backend", choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help="inference backend (default from DETECTION_BACKEND; 'stub' needs no model)")
+    parser.add_argument("--int8", action="store_true", default=DEFAULT_INT8,
+                        help="use the INT8-quantized model (onnx/openvino)")
+    parser.add_argument("--images", nargs='+', help="sample images (files, directories or globs) "
+                                                    "instead of synthetic frames")
+    parser.add_argument("--resolutions", default="VGA,SVGA,XGA",
+                        help=f"comma-separated ESP32-CAM frame sizes among {','.join(RESOLUTIONS)}")
+    parser.add_argument("--warmup", type=int, default=5, help="untimed iterations before measuring")
+    parser.add_argument("--iterations", type=int, default=50, help="timed frames per resolution")
+    parser.add_argument("--batch-sizes", default="1,2,4,8", help="comma-separated batch sizes")
+    parser.add_argument("--cold-runs", type=int, default=3,
+                        help="fresh-interpreter cold starts to time (0 to skip)")
+    parser.add_argument("--output", help="write the results to this JSON file (default: stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CANDIDATE"),
+                        help="compare two result files instead of running")
+    parser.add_argument("--probe-cold-start", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    args.resolutions = [name.strip().upper() for name in args.resolutions.split(',') if name.strip()]
+    for name in args.resolutions:
+        if name not in RESOLUTIONS:
+            parser.error(f"unknown resolution {name}, expected one of {', '.join(RESOLUTIONS)}")
+    if not args.resolutions:
+        parser.error("at least one resolution is needed")
+    args.batch_sizes = [int(size) for size in args.batch_sizes.split(',') if size.strip()]
+    args.iterations = max(1, args.iterations)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.compare:
+        compare(*args.compare)
+        return 0
+    if args.probe_cold_start:
+        probe_cold_start(args.backend, args.int8)
+        return 0
+
+    # Keep stdout for the JSON results
+    from worker import redirect_stdout
+    out = redirect_stdout()
+    try:
+        results = run(args)
+    except Exception as e:
+        print(f"Error in benchmark: {str(e)}", file=sys.stderr, flush=True)
+        return 1
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+        print(f"Results written to {args.output}", file=sys.stderr, flush=True)
+    else:
+        out.write(text.encode() + b'\n')
+        out.flush()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
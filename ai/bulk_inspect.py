@@ -0,0 +1,392 @@
+"""
+Offline bulk inspection of recorded frames.
+
+    python bulk_inspect.py SOURCE [SOURCE ...] --report report.jsonl
+        [--annotate-dir DIR] [--defects-only] [--workers N] [--threads N]
+        [--backend NAME] [--int8] [--resume]
+
+A source is a directory of images (e.g. backend/frames, searched
+recursively), a glob pattern ("captures/**/*.jpg"), a single image, a raw
+MJPEG capture (.mjpeg/.mjpg: JPEG frames back to back, with or without
+multipart headers in between) or any video file OpenCV can read.
+
+Frames are streamed through a producer/consumer pipeline: the producer
+walks the sources and hands out one task per frame, and a pool of worker
+processes, each with its own model loaded once at startup, runs
+detection. Image files are read and decoded inside the workers; MJPEG
+frames are passed as JPEG bytes and video frames as raw BGR buffers. The
+number of frames in flight is bounded, so long videos are never fully
+read into memory.
+
+The report gets one record per frame as soon as it is done (frames finish
+out of order): JSON lines for a .jsonl report, or a CSV with one row per
+detection (and one empty row for a frame without any) for a .csv report.
+Each frame has a stable key (the absolute file path, plus "#<frame>" for
+video and MJPEG frames), and --resume skips every key already reported
+without an error, so an interrupted run can be restarted with the same
+command line.
+"""
+
+import argparse
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import cv2
+
+from backends import BACKENDS, DEFAULT_BACKEND, DEFAULT_INT8
+from process_image import (DEFECT_CLASSES, JPEG_QUALITY, decode_image, detect, extract_detections,
+                           load_class_labels, load_model, plot_result)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+MJPEG_EXTENSIONS = ('.mjpeg', '.mjpg')
+
+# Frames handed to the pool but not reported yet, per worker process
+IN_FLIGHT_PER_WORKER = 4
+
+# Read size when splitting MJPEG captures
+MJPEG_CHUNK_SIZE = 1 << 20
+
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+
+CSV_FIELDS = ['key', 'source', 'frame', 'width', 'height', 'class_id', 'class_name',
+              'confidence', 'x1', 'y1', 'x2', 'y2', 'defect', 'annotated', 'error']
+
+
+# --- Producer ---
+
+def expand_sources(sources):
+    """Yield the files named by the sources: directories, globs or plain paths."""
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS + MJPEG_EXTENSIONS):
+                        yield os.path.join(root, name)
+        elif glob.has_magic(source):
+            matches = sorted(glob.glob(source, recursive=True))
+            if not matches:
+                print(f"Warning: no files match {source}", file=sys.stderr, flush=True)
+            for path in matches:
+                if os.path.isfile(path):
+                    yield path
+        elif os.path.isfile(source):
+            yield source
+        else:
+            print(f"Warning: skipping missing source {source}", file=sys.stderr, flush=True)
+
+
+def iter_mjpeg_frames(path, chunk_size=MJPEG_CHUNK_SIZE):
+    """Split a raw MJPEG capture into JPEG frames on the SOI/EOI markers."""
+    buffer = bytearray()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            buffer += chunk
+            while True:
+                start = buffer.find(JPEG_SOI)
+                if start < 0:
+                    # Keep a trailing 0xff in case the marker is split across reads
+                    del buffer[:max(0, len(buffer) - 1)]
+                    break
+                end = buffer.find(JPEG_EOI, start + 2)
+                if end < 0:
+                    del buffer[:start]
+                    break
+                yield bytes(buffer[start:end + 2])
+                del buffer[:end + 2]
+
+
+def iter_video_frames(path):
+    """Decode a video file frame by frame."""
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise Exception(f"Could not open video: {path}")
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+
+def iter_tasks(paths, done_keys):
+    """
+    Yield one task dict per frame not reported yet. Tasks carry either a
+    path for the worker to read, or the encoded (jpeg) or raw (bgr) frame.
+    """
+    for path in paths:
+        source = os.path.abspath(path)
+        lower = path.lower()
+        if lower.endswith(IMAGE_EXTENSIONS):
+            if source not in done_keys:
+                yield {'key': source, 'source': source, 'frame': None, 'path': source}
+            continue
+
+        try:
+            if lower.endswith(MJPEG_EXTENSIONS):
+                for index, data in enumerate(iter_mjpeg_frames(path)):
+                    key = f"{source}#{index}"
+                    if key not in done_keys:
+                        yield {'key': key, 'source': source, 'frame': index,
+                               'data': data, 'format': 'jpeg'}
+            else:
+                for index, frame in enumerate(iter_video_frames(path)):
+                    key = f"{source}#{index}"
+                    if key not in done_keys:
+                        yield {'key': key, 'source': source, 'frame': index, 'data': frame.tobytes(),
+                               'format': 'bgr', 'width': frame.shape[1], 'height': frame.shape[0]}
+        except Exception as e:
+            print(f"Error reading {path}: {str(e)}", file=sys.stderr, flush=True)
+
+
+def bounded(tasks, slots):
+    """Hold the producer back until a slot is released for each task."""
+    for task in tasks:
+        slots.acquire()
+        yield task
+
+
+# --- Pool workers ---
+
+_model = None
+_load_error = None
+_class_labels = None
+_annotate_dir = None
+_defects_only = False
+
+
+def init_worker(backend, int8, threads, annotate_dir, defects_only):
+    """Pool initializer: load the model once per worker process."""
+    global _model, _load_error, _class_labels, _annotate_dir, _defects_only
+    # An initializer that raises makes the pool respawn the worker forever,
+    # so the error is kept and raised by the first task instead
+    try:
+        _class_labels = load_class_labels()
+        _model = load_model(backend=backend, int8=int8, class_labels=_class_labels, threads=threads)
+    except Exception as e:
+        _load_error = f"Error loading model: {str(e)}"
+    _annotate_dir = annotate_dir
+    _defects_only = defects_only
+
+
+def annotated_name(task):
+    stem = os.path.splitext(os.path.basename(task['source']))[0]
+    if task['frame'] is not None:
+        stem = f"{stem}_{task['frame']:06d}"
+    return stem + '.jpg'
+
+
+def inspect_frame(task):
+    """Run detection on one task and return its report record."""
+    if _load_error:
+        raise Exception(_load_error)
+    record = {'key': task['key'], 'source': task['source'], 'frame': task['frame']}
+    timings = {}
+    try:
+        start = time.perf_counter()
+        if 'path' in task:
+            img = cv2.imread(task['path'])
+            if img is None:
+                raise Exception(f"Could not load image from: {task['path']}")
+        else:
+            img = decode_image(task['data'], task['format'], task.get('width'), task.get('height'))
+        timings['decode_ms'] = (time.perf_counter() - start) * 1000
+
+        result = detect(_model, img, timings)
+        detections = extract_detections(result, _class_labels)
+        defects = sum(1 for d in detections if d['class_name'] in DEFECT_CLASSES)
+        record['image_size'] = [img.shape[1], img.shape[0]]
+        record['detections'] = detections
+        record['defects'] = defects
+
+        if _annotate_dir and (defects or not _defects_only):
+            annotated_img = plot_result(result, timings)
+            output_path = os.path.join(_annotate_dir, annotated_name(task))
+            start = time.perf_counter()
+            if not cv2.imwrite(output_path, annotated_img, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]):
+                raise Exception(f"Failed to write output file to {output_path}")
+            timings['encode_ms'] = (time.perf_counter() - start) * 1000
+            record['annotated'] = output_path
+    except Exception as e:
+        record['error'] = str(e)
+    record['timings'] = {name: round(value, 1) for name, value in timings.items()}
+    return record
+
+
+# --- Reports ---
+
+class JsonlReport:
+    """One JSON object per frame and line."""
+
+    def __init__(self, path, resume):
+        self.path = path
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        if resume and self.file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    # Start after the line an interrupted run left unfinished
+                    self.file.write('\n')
+
+    @staticmethod
+    def done_keys(path):
+        keys = set()
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line cut short by an interrupted run
+                    continue
+                if 'error' not in record:
+                    keys.add(record['key'])
+        return keys
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CsvReport:
+    """One row per detection, or a single empty row for a frame without any."""
+
+    def __init__(self, path, resume):
+        self.path = path
+        new_file = not resume or not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=CSV_FIELDS)
+        if new_file:
+            self.writer.writeheader()
+
+    @staticmethod
+    def done_keys(path):
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            return {row['key'] for row in csv.DictReader(f) if row.get('key') and not row.get('error')}
+
+    def write(self, record):
+        width, height = record.get('image_size') or ('', '')
+        base = {'key': record['key'], 'source': record['source'], 'frame': record['frame'],
+                'width': width, 'height': height, 'annotated': record.get('annotated', ''),
+                'error': record.get('error', '')}
+        rows = []
+        for detection in record.get('detections') or []:
+            x1, y1, x2, y2 = detection['box']
+            rows.append(dict(base, class_id=detection['class_id'], class_name=detection['class_name'],
+                             confidence=detection['confidence'], x1=x1, y1=y1, x2=x2, y2=y2,
+                             defect=int(detection['class_name'] in DEFECT_CLASSES)))
+        self.writer.writerows(rows or [base])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def open_report(path, resume):
+    """Open the report for writing; returns (report, keys already done)."""
+    report_class = CsvReport if path.lower().endswith('.csv') else JsonlReport
+    done_keys = set()
+    if resume and os.path.exists(path):
+        done_keys = report_class.done_keys(path)
+    return report_class(path, resume), done_keys
+
+
+# --- Command line ---
+
+def parse_args(argv):
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Run bolt detection over image folders, globs, "
+                                                 "MJPEG captures and videos.")
+    parser.add_argument("sources", nargs='+', help="directories, glob patterns, images, .mjpeg captures or videos")
+    parser.add_argument("--report", required=True, help="per-frame report (.jsonl, or .csv)")
+    parser.add_argument("--annotate-dir", help="also write annotated JPEGs to this directory")
+    parser.add_argument("--defects-only", action="store_true",
+                        help="only write annotated images for frames with a defect")
+    parser.add_argument("--resume", action="store_true",
+                        help="append to the report and skip the frames it already covers")
+    parser.add_argument("--workers", type=int, default=max(1, cpus // 2),
+                        help="number of worker processes, one model each")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="inference threads per worker (default: CPUs / workers, 0: runtime default)")
+    parser.add_argument("--backend", choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help="inference backend (default from DETECTION_BACKEND)")
+    parser.add_argument("--int8", action="store_true", default=DEFAULT_INT8,
+                        help="use the INT8-quantized model (onnx/openvino)")
+    args = parser.parse_args(argv)
+    args.workers = max(1, args.workers)
+    if args.threads is None:
+        args.threads = max(1, cpus // args.workers)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.annotate_dir:
+        os.makedirs(args.annotate_dir, exist_ok=True)
+
+    report, done_keys = open_report(args.report, args.resume)
+    if done_keys:
+        print(f"Resuming: {len(done_keys)} frames already in {args.report}", flush=True)
+
+    slots = threading.BoundedSemaphore(args.workers * IN_FLIGHT_PER_WORKER)
+    tasks = bounded(iter_tasks(expand_sources(args.sources), done_keys), slots)
+
+    frames = errors = defect_frames = 0
+    class_counts = {}
+    start = time.perf_counter()
+    pool = multiprocessing.Pool(args.workers, initializer=init_worker,
+                                initargs=(args.backend, args.int8, args.threads,
+                                          args.annotate_dir, args.defects_only))
+    try:
+        for record in pool.imap_unordered(inspect_frame, tasks):
+            slots.release()
+            report.write(record)
+            frames += 1
+            if 'error' in record:
+                errors += 1
+                print(f"Error on {record['key']}: {record['error']}", file=sys.stderr, flush=True)
+                continue
+            defect_frames += bool(record['defects'])
+            for detection in record['detections']:
+                class_counts[detection['class_name']] = class_counts.get(detection['class_name'], 0) + 1
+            if frames % 100 == 0:
+                elapsed = time.perf_counter() - start
+                print(f"{frames} frames ({frames / elapsed:.1f} fps)", flush=True)
+        pool.close()
+    except KeyboardInterrupt:
+        print("Interrupted; rerun with --resume to continue", file=sys.stderr, flush=True)
+        pool.terminate()
+        return 130
+    except Exception as e:
+        print(f"Error in bulk inspection: {str(e)}", file=sys.stderr, flush=True)
+        pool.terminate()
+        return 1
+    finally:
+        pool.join()
+        report.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"Inspected {frames} frames in {elapsed:.1f}s ({frames / elapsed if elapsed else 0:.1f} fps), "
+          f"{defect_frames} with defects, {errors} errors", flush=True)
+    for class_name, count in sorted(class_counts.items()):
+        print(f"  {class_name}: {count}", flush=True)
+    print(f"Report written to {args.report}", flush=True)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+"""
+Micro-batching inference engine used by the detection worker.
+
+Requests are collected for a short window (or until the batch is full) and
+run through the model as one batched forward pass. Each caller gets a
+concurrent.futures.Future that resolves to its own Detections result.
+
+Only requests with identical inference options (input size, confidence
+threshold, ...; see profiles.py) are batched together, since a forward
+pass applies one set of options to every image in it.
+
+Requests are served FIFO by default. Real-time camera frames can instead be
+submitted with policy="latest": each stream then has a single waiting slot
+and a newer frame replaces the one still waiting, whose future fails with
+FrameDropped. Results carry the frame's capture timestamp and age, and the
+engine counts processed, dropped and stale frames.
+"""
+
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+from profiles import get_profile
+
+# Defaults for the batching window
+DEFAULT_MAX_BATCH_SIZE = 4
+DEFAULT_BATCH_WINDOW_MS = 10
+
+# Results older than this (from capture to end of inference) count as stale
+DEFAULT_STALE_AFTER_MS = 500
+
+# Scheduling policies
+POLICY_FIFO = 'fifo'
+POLICY_LATEST = 'latest'
+
+
+class FrameDropped(Exception):
+    """Raised on the future of a frame replaced by a newer one before inference."""
+
+
+class InferenceRequest:
+    """One image waiting for inference, with the future its caller holds."""
+
+    def __init__(self, img, options, capture_ts=None):
+        self.img = img
+        self.options = options
+        self.future = Future()
+        self.submitted_at = time.perf_counter()
+        # Wall-clock capture time in milliseconds since the epoch
+        self.capture_ts = capture_ts if capture_ts is not None else time.time() * 1000
+        self.timings = {}
+
+    def batch_key(self):
+        return tuple(sorted(self.options.items()))
+
+
+class InferenceEngine:
+    """
+    Runs model inference on a background thread, grouping requests that
+    arrive within batch_window_ms of each other (up to max_batch_size)
+    into a single model call.
+    """
+
+    def __init__(self, model, max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 batch_window_ms=DEFAULT_BATCH_WINDOW_MS, stale_after_ms=DEFAULT_STALE_AFTER_MS):
+        self.model = model
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.batch_window = max(0.0, batch_window_ms / 1000.0)
+        self.stale_after_ms = stale_after_ms
+        self._queue = queue.Queue()
+        # Waiting frame per stream for the "latest" policy. The queue only
+        # holds the stream name; the frame is read from the slot when the
+        # engine gets to it, so it is always the newest one.
+        self._latest = {}
+        # Requests taken off the queue but held back for a later batch
+        self._pending = []
+        self._lock = threading.Lock()
+        self.counters = {'submitted': 0, 'processed': 0, 'dropped': 0, 'stale': 0}
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="inference-engine", daemon=True)
+        self._thread.start()
+
+    def submit(self, img, options=None, policy=POLICY_FIFO, stream='default', capture_ts=None):
+        """
+        Queue a decoded image for inference and return a Future.
+
+        The future resolves to (result, timings) where timings holds the
+        time spent waiting for the batch (queue_ms), the duration of the
+        batched forward pass (inference_ms), the batch size, the capture
+        timestamp and age of the frame at the end of inference, and whether
+        it was stale by then.
+
+        With policy="latest", a frame still waiting on the same stream is
+        dropped (its future raises FrameDropped) in favour of this one.
+        """
+        if not self._running:
+            raise Exception("Inference engine is stopped")
+        request = InferenceRequest(img, dict(options or get_profile().options(self.model.names)), capture_ts)
+
+        with self._lock:
+            self.counters['submitted'] += 1
+            if policy == POLICY_LATEST:
+                replaced = self._latest.get(stream)
+                self._latest[stream] = request
+                if replaced is not None:
+                    self.counters['dropped'] += 1
+            else:
+                replaced = None
+
+        if policy != POLICY_LATEST:
+            self._queue.put(request)
+        elif replaced is None:
+            self._queue.put(stream)
+        else:
+            # The replaced frame's place in the queue now serves this one
+            replaced.future.set_exception(FrameDropped(f"Frame on stream '{stream}' replaced by a newer one"))
+        return request.future
+
+    def get_counters(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def queue_depth(self):
+        """Number of queued entries and held-back requests waiting for a batch."""
+        return self._queue.qsize() + len(self._pending)
+
+    def _next_request(self, timeout=None):
+        """
+        Take the next entry off the queue, resolving stream names to the
+        frame waiting in that stream's slot. Returns None for the stop
+        sentinel and raises queue.Empty on timeout.
+        """
+        while True:
+            entry = self._queue.get(timeout=timeout)
+            if entry is None or isinstance(entry, InferenceRequest):
+                return entry
+            with self._lock:
+                request = self._latest.pop(entry, None)
+            if request is not None:
+                return request
+
+    def stop(self):
+        """Stop the engine thread once the queued requests have been served."""
+        self._running = False
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect_batch(self, first, pending):
+        """
+        Gather requests compatible with `first`, starting with those already
+        held back in `pending`, then from the queue until the window closes.
+        Incompatible requests are appended to `pending` for a later batch.
+        Returns the batch and whether the stop sentinel was seen.
+        """
+        key = first.batch_key()
+        batch = [first]
+        for request in list(pending):
+            if len(batch) >= self.max_batch_size:
+                break
+            if request.batch_key() == key:
+                pending.remove(request)
+                batch.append(request)
+
+        deadline = time.perf_counter() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._next_request(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            if request.batch_key() == key:
+                batch.append(request)
+            else:
+                pending.append(request)
+        return batch, False
+
+    def _run_batch(self, batch):
+        started = time.perf_counter()
+        try:
+            results = self.model([request.img for request in batch], verbose=False, **batch[0].options)
+        except Exception as e:
+            print(f"Error in batched inference: {str(e)}", file=sys.stderr, flush=True)
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        inference_ms = (time.perf_counter() - started) * 1000
+        now_ms = time.time() * 1000
+
+        stale = 0
+        for request, result in zip(batch, results):
+            age_ms = now_ms - request.capture_ts
+            request.timings['queue_ms'] = (started - request.submitted_at) * 1000
+            request.timings['inference_ms'] = inference_ms
+            request.timings['batch_size'] = len(batch)
+            request.timings['capture_ts'] = request.capture_ts
+            request.timings['age_ms'] = age_ms
+            request.timings['stale'] = age_ms > self.stale_after_ms
+            stale += request.timings['stale']
+
+        with self._lock:
+            self.counters['processed'] += len(batch)
+            self.counters['stale'] += stale
+
+        for request, result in zip(batch, results):
+            request.future.set_result((result, request.timings))
+
+    def _run(self):
+        # Requests pulled off the queue that did not fit the previous batch
+        pending = self._pending
+        stopping = False
+        while True:
+            if pending:
+                first = pending.pop(0)
+            elif stopping:
+                return
+            else:
+                first = self._next_request()
+                if first is None:
+                    return
+
+            batch, saw_stop = self._collect_batch(first, pending)
+            stopping = stopping or saw_stop
+            self._run_batch(batch)
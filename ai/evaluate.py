@@ -0,0 +1,437 @@
+"""
+Accuracy versus speed of one detector configuration on a data.yaml split.
+
+    python evaluate.py [--split val|test] [--backend NAME] [--int8]
+        [--profile NAME] [--imgsz N] [--batch-size N] [--decode-threads N]
+        [--limit N] [--output results.json]
+    python evaluate.py --compare baseline.json candidate.json
+
+The images of the split are streamed from disk: a pool of threads reads
+and decodes them (cv2 releases the GIL while decoding) a little ahead of
+the model, which sees them in batches of --batch-size. Ground truth comes
+from the YOLO label files next to the images (images/ -> labels/).
+
+Accuracy, with boxes matched greedily by confidence to the ground truth
+of the same class:
+    map50, map50_95   mean average precision at IoU 0.5 and averaged over
+                      IoU 0.5:0.95 (COCO 101-point interpolation), from the
+                      detections above --conf (0.001 by default, so the
+                      whole precision-recall curve is covered)
+    classes           AP per class, and precision/recall at IoU 0.5 at the
+                      operating threshold: the profile's confidence, the
+                      one the robot runs with (--operating-conf to change)
+
+Speed: images per second over the whole run, and the mean and p50/p95/p99
+of the decode time per image and of each forward pass.
+
+Results are written as JSON with the configuration they were measured
+with; --compare prints two result files side by side, e.g. to find the
+fastest configuration that still finds Boulon_Mauvais.
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import yaml
+
+from backends import BACKENDS, DATA_YAML_PATH, DEFAULT_BACKEND, DEFAULT_INT8
+from benchmark import git_commit, peak_rss_mb, summarize
+from profiles import DEFAULT_PROFILE, PROFILES, get_profile
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# IoU thresholds of mAP@0.5:0.95
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+
+# Minimum confidence of the detections used for the precision-recall curves
+EVAL_CONF = 0.001
+
+# Images decoded ahead of the model, per decode thread
+LOOKAHEAD_PER_THREAD = 4
+
+
+# --- Dataset ---
+
+def split_images(data_yaml_path, split):
+    """
+    Image paths of a split. Paths in data.yaml are relative to its "path"
+    entry or to its own directory; Roboflow exports write them as
+    "../valid/images", which is also tried without the leading "../".
+    """
+    with open(data_yaml_path) as f:
+        data = yaml.safe_load(f)
+    if split not in data:
+        raise Exception(f"Split '{split}' not found in {data_yaml_path}")
+    root = os.path.join(os.path.dirname(os.path.abspath(data_yaml_path)), data.get('path', ''))
+
+    entries = data[split] if isinstance(data[split], list) else [data[split]]
+    images = []
+    for entry in entries:
+        path = os.path.normpath(os.path.join(root, entry))
+        if not os.path.exists(path) and entry.startswith('../'):
+            path = os.path.normpath(os.path.join(root, entry[3:]))
+        if os.path.isdir(path):
+            images += sorted(p for p in glob.glob(os.path.join(path, '**', '*'), recursive=True)
+                             if p.lower().endswith(IMAGE_EXTENSIONS))
+        elif path.endswith('.txt') and os.path.exists(path):
+            # A list of image paths, relative to the list's directory
+            with open(path) as f:
+                images += [os.path.normpath(os.path.join(os.path.dirname(path), line.strip()))
+                           for line in f if line.strip()]
+        else:
+            raise Exception(f"Images of split '{split}' not found at {path}")
+    if not images:
+        raise Exception(f"No images in split '{split}'")
+    return images, data.get('names', [])
+
+
+def label_path(image_path):
+    """The YOLO label file of an image: .../images/x.jpg -> .../labels/x.txt"""
+    directory, filename = os.path.split(image_path)
+    parts = directory.split(os.sep)
+    if 'images' in parts:
+        index = len(parts) - 1 - parts[::-1].index('images')
+        parts[index] = 'labels'
+    return os.path.join(os.sep.join(parts), os.path.splitext(filename)[0] + '.txt')
+
+
+def load_labels(path, width, height):
+    """Ground-truth boxes (xyxy pixels) and class ids from a YOLO label file."""
+    boxes, class_ids = [], []
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                values = line.split()
+                if len(values) < 5:
+                    continue
+                class_ids.append(int(values[0]))
+                coords = np.array(values[1:], dtype=np.float32)
+                if len(coords) == 4:
+                    cx, cy, w, h = coords
+                    boxes.append([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2])
+                else:
+                    # Segmentation polygon: use its bounding box
+                    xs, ys = coords[0::2], coords[1::2]
+                    boxes.append([xs.min(), ys.min(), xs.max(), ys.max()])
+    boxes = np.array(boxes, dtype=np.float32).reshape(-1, 4) * np.array([width, height, width, height],
+                                                                           dtype=np.float32)
+    return boxes, np.array(class_ids, dtype=np.int64)
+
+
+def load_sample(image_path):
+    start = time.perf_counter()
+    img = cv2.imread(image_path)
+    decode_ms = (time.perf_counter() - start) * 1000
+    if img is None:
+        raise Exception(f"Could not load image from: {image_path}")
+    boxes, class_ids = load_labels(label_path(image_path), img.shape[1], img.shape[0])
+    return image_path, img, boxes, class_ids, decode_ms
+
+
+def iter_samples(image_paths, threads):
+    """Decoded images and their labels, in order, read ahead by a thread pool."""
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="decode") as executor:
+        paths = iter(image_paths)
+        ahead = deque()
+        for path in paths:
+            ahead.append(executor.submit(load_sample, path))
+            if len(ahead) >= threads * LOOKAHEAD_PER_THREAD:
+                break
+        while ahead:
+            future = ahead.popleft()
+            path = next(paths, None)
+            if path is not None:
+                ahead.append(executor.submit(load_sample, path))
+            yield future.result()
+
+
+# --- Matching and average precision ---
+
+def box_iou(boxes_a, boxes_b):
+    """IoU matrix of two sets of xyxy boxes."""
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    area_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-9)
+
+
+def match_detections(boxes, confidences, class_ids, gt_boxes, gt_class_ids, thresholds=IOU_THRESHOLDS):
+    """
+    True-positive flags (detections x thresholds): at each IoU threshold,
+    detections are taken by decreasing confidence and matched to the
+    unmatched ground-truth box of the same class they overlap most.
+    """
+    tp = np.zeros((len(boxes), len(thresholds)), dtype=bool)
+    if not len(boxes) or not len(gt_boxes):
+        return tp
+    iou = box_iou(boxes, gt_boxes)
+    iou[class_ids[:, None] != gt_class_ids[None, :]] = 0
+    order = np.argsort(-confidences, kind='stable')
+    for t, threshold in enumerate(thresholds):
+        matched = np.zeros(len(gt_boxes), dtype=bool)
+        for i in order:
+            candidates = np.flatnonzero(~matched & (iou[i] >= threshold))
+            if len(candidates):
+                matched[candidates[np.argmax(iou[i, candidates])]] = True
+                tp[i, t] = True
+    return tp
+
+
+def average_precision(tp, confidences, n_gt):
+    """AP of one class and IoU threshold, with COCO's 101-point interpolation."""
+    if n_gt == 0:
+        return None
+    if not len(tp):
+        return 0.0
+    order = np.argsort(-confidences, kind='stable')
+    hits = np.cumsum(tp[order])
+    recall = hits / n_gt
+    precision = hits / np.arange(1, len(hits) + 1)
+    # Precision envelope: the best precision at this recall or beyond
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    index = np.searchsorted(recall, np.linspace(0, 1, 101), side='left')
+    found = index < len(recall)
+    return float(np.sum(precision[index[found]]) / 101)
+
+
+class Evaluator:
+    """Accumulates detections and ground truth over the images of a split."""
+
+    def __init__(self, names):
+        self.names = names
+        self.confidences, self.class_ids, self.tp = [], [], []
+        self.gt_counts = np.zeros(len(names), dtype=np.int64)
+        self.images = 0
+
+    def add(self, result, gt_boxes, gt_class_ids):
+        self.images += 1
+        self.gt_counts += np.bincount(gt_class_ids, minlength=len(self.names))[:len(self.names)]
+        self.tp.append(match_detections(result.boxes, result.confidences, result.class_ids,
+                                        gt_boxes, gt_class_ids))
+        self.confidences.append(result.confidences)
+        self.class_ids.append(result.class_ids)
+
+    def summary(self, operating_conf):
+        confidences = np.concatenate(self.confidences) if self.confidences else np.zeros(0)
+        class_ids = np.concatenate(self.class_ids) if self.class_ids else np.zeros(0, dtype=np.int64)
+        tp = np.concatenate(self.tp) if self.tp else np.zeros((0, len(IOU_THRESHOLDS)), dtype=bool)
+
+        classes, ap50s, ap50_95s = {}, [], []
+        total = {'tp': 0, 'fp': 0, 'fn': 0}
+        for class_id, name in enumerate(self.names):
+            n_gt = int(self.gt_counts[class_id])
+            mine = class_ids == class_id
+            aps = [average_precision(tp[mine, t], confidences[mine], n_gt) for t in range(len(IOU_THRESHOLDS))]
+            kept = mine & (confidences >= operating_conf)
+            hits = int(tp[kept, 0].sum())
+            counts = {'tp': hits, 'fp': int(kept.sum()) - hits, 'fn': n_gt - hits}
+            for key in total:
+                total[key] += counts[key]
+            entry = dict(counts, instances=n_gt, detections=int(kept.sum()),
+                         precision=round(hits / kept.sum(), 4) if kept.sum() else None,
+                         recall=round(hits / n_gt, 4) if n_gt else None)
+            if n_gt:
+                entry['ap50'] = round(aps[0], 4)
+                entry['ap50_95'] = round(float(np.mean(aps)), 4)
+                ap50s.append(aps[0])
+                ap50_95s.append(np.mean(aps))
+            classes[name] = entry
+
+        detected = total['tp'] + total['fp']
+        instances = total['tp'] + total['fn']
+        return {
+            'images': self.images,
+            'instances': int(self.gt_counts.sum()),
+            'map50': round(float(np.mean(ap50s)), 4) if ap50s else None,
+            'map50_95': round(float(np.mean(ap50_95s)), 4) if ap50_95s else None,
+            'operating_conf': operating_conf,
+            'precision': round(total['tp'] / detected, 4) if detected else None,
+            'recall': round(total['tp'] / instances, 4) if instances else None,
+            'classes': classes,
+        }
+
+
+# --- Evaluation run ---
+
+def evaluate(args):
+    from process_image import load_model
+
+    image_paths, names = split_images(args.data, args.split)
+    if args.limit:
+        image_paths = image_paths[:args.limit]
+    model = load_model(backend=args.backend, int8=args.int8, class_labels=names, threads=args.threads or None)
+
+    profile = get_profile(args.profile).with_overrides(imgsz=args.imgsz, iou=args.iou)
+    operating_conf = args.operating_conf if args.operating_conf is not None else profile.conf
+    options = profile.with_overrides(conf=min(args.conf, operating_conf)).options(model.names)
+
+    evaluator = Evaluator(names)
+    decode_samples, batch_samples = [], []
+    batch = []
+    print(f"Evaluating {len(image_paths)} images of the {args.split} split "
+          f"({model.name}, imgsz {options['imgsz']})...", file=sys.stderr, flush=True)
+
+    def run_batch():
+        start = time.perf_counter()
+        results = model([img for _, img, _, _ in batch], verbose=False, **options)
+        batch_samples.append((time.perf_counter() - start) * 1000)
+        for (_, _, gt_boxes, gt_class_ids), result in zip(batch, results):
+            evaluator.add(result, gt_boxes, gt_class_ids)
+        batch.clear()
+        if evaluator.images % 100 < args.batch_size:
+            print(f"{evaluator.images}/{len(image_paths)} images", file=sys.stderr, flush=True)
+
+    start = time.perf_counter()
+    for path, img, gt_boxes, gt_class_ids, decode_ms in iter_samples(image_paths, args.decode_threads):
+        decode_samples.append(decode_ms)
+        batch.append((path, img, gt_boxes, gt_class_ids))
+        if len(batch) >= args.batch_size:
+            run_batch()
+    if batch:
+        run_batch()
+    wall_s = time.perf_counter() - start
+
+    return {
+        'configuration': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'commit': git_commit(),
+            'backend': model.name,
+            'int8': bool(getattr(model, 'int8', False)),
+            'artifact': model.artifact_path,
+            'profile': profile.to_dict(),
+            'split': args.split,
+            'batch_size': args.batch_size,
+            'threads': args.threads,
+            'decode_threads': args.decode_threads,
+            'cpus': os.cpu_count(),
+        },
+        'accuracy': evaluator.summary(operating_conf),
+        'speed': {
+            'images_per_s': round(len(decode_samples) / wall_s, 2) if wall_s else None,
+            'wall_s': round(wall_s, 2),
+            'decode_ms': summarize(decode_samples),
+            'batch_ms': summarize(batch_samples),
+            'inference_ms_per_image': round(sum(batch_samples) / len(decode_samples), 3),
+        },
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def print_report(results):
+    accuracy, speed, config = results['accuracy'], results['speed'], results['configuration']
+    print(f"{config['backend']}{' INT8' if config['int8'] else ''}, profile {config['profile']['name']} "
+          f"(imgsz {config['profile']['imgsz']}), batch {config['batch_size']}, {config['split']} split",
+          file=sys.stderr)
+    print(f"mAP50 {accuracy['map50']}  mAP50-95 {accuracy['map50_95']}  "
+          f"P {accuracy['precision']}  R {accuracy['recall']} at conf {accuracy['operating_conf']}",
+          file=sys.stderr)
+    for name, entry in accuracy['classes'].items():
+        print(f"  {name:20s} AP50 {entry.get('ap50')}  P {entry['precision']}  R {entry['recall']}  "
+              f"({entry['instances']} instances)", file=sys.stderr)
+    print(f"{speed['images_per_s']} images/s, forward pass p50 {speed['batch_ms']['p50']}ms "
+          f"p95 {speed['batch_ms']['p95']}ms, decode p50 {speed['decode_ms']['p50']}ms", file=sys.stderr, flush=True)
+
+
+# --- Comparison ---
+
+def flatten(results):
+    """Pick the comparable figures of a result file as {name: value}."""
+    accuracy, speed = results['accuracy'], results['speed']
+    figures = {name: accuracy[name] for name in ('map50', 'map50_95', 'precision', 'recall')}
+    for class_name, entry in accuracy['classes'].items():
+        for name in ('ap50', 'precision', 'recall'):
+            figures[f'{class_name}.{name}'] = entry.get(name)
+    figures['images_per_s'] = speed['images_per_s']
+    for stat in ('p50', 'p95', 'p99'):
+        figures[f'batch_ms.{stat}'] = speed['batch_ms'][stat]
+    return figures
+
+
+def compare(baseline_path, candidate_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(candidate_path) as f:
+        candidate = json.load(f)
+    for label, results in (('baseline', baseline), ('candidate', candidate)):
+        config = results['configuration']
+        print(f"{label}: {config['backend']}{' INT8' if config['int8'] else ''}, profile "
+              f"{config['profile']['name']} imgsz {config['profile']['imgsz']}, batch {config['batch_size']} "
+              f"@ {config['commit']}")
+
+    before, after = flatten(baseline), flatten(candidate)
+    for name in sorted(set(before) & set(after)):
+        if before[name] is None or after[name] is None:
+            continue
+        print(f"{name:40s} {before[name]:10.4f} -> {after[name]:10.4f} ({after[name] - before[name]:+.4f})")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Measure accuracy and speed of a detector configuration "
+                                                 "on a data.yaml split.")
+    parser.add_argument("--data", default=DATA_YAML_PATH, help="dataset description (default: data.yaml)")
+    parser.add_argument("--split", default='val', help="split to evaluate (val or test)")
+    parser.add_argument("--backend", choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help="inference backend (default from DETECTION_BACKEND)")
+    parser.add_argument("--int8", action="store_true", default=DEFAULT_INT8,
+                        help="use the INT8-quantized model (onnx/openvino)")
+    parser.add_argument("--threads", type=int, default=0, help="inference threads (0: runtime default)")
+    parser.add_argument("--profile", choices=PROFILES, default=DEFAULT_PROFILE,
+                        help="inference profile (default from DETECTION_PROFILE)")
+    parser.add_argument("--imgsz", type=int, help="override the profile's input size")
+    parser.add_argument("--iou", type=float, help="override the profile's NMS IoU threshold")
+    parser.add_argument("--conf", type=float, default=EVAL_CONF,
+                        help="minimum confidence of the detections used for mAP")
+    parser.add_argument("--operating-conf", type=float,
+                        help="threshold of the reported precision/recall (default: the profile's)")
+    parser.add_argument("--batch-size", type=int, default=1, help="images per forward pass")
+    parser.add_argument("--decode-threads", type=int, default=os.cpu_count() or 1,
+                        help="threads reading and decoding images ahead of the model")
+    parser.add_argument("--limit", type=int, help="only evaluate the first N images")
+    parser.add_argument("--output", help="write the results to this JSON file (default: stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CANDIDATE"),
+                        help="compare two result files instead of running")
+    args = parser.parse_args(argv)
+    args.batch_size = max(1, args.batch_size)
+    args.decode_threads = max(1, args.decode_threads)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    # Keep stdout for the JSON results
+    from worker import redirect_stdout
+    out = redirect_stdout()
+    try:
+        results = evaluate(args)
+    except Exception as e:
+        print(f"Error in evaluation: {str(e)}", file=sys.stderr, flush=True)
+        return 1
+
+    print_report(results)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+        print(f"Results written to {args.output}", file=sys.stderr, flush=True)
+    else:
+        out.write(text.encode() + b'\n')
+        out.flush()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
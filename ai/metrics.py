@@ -0,0 +1,417 @@
+"""
+Instrumentation of the detection worker.
+
+Metrics collects what is needed to tell where real-time detection loses
+time: per-stage latency histograms (decode, gate, queue, inference,
+merge, plot, encode, total), batch sizes, request outcomes, the engine's
+frame counters and queue depth, resident memory, and the identity of the
+loaded model. It renders them as JSON or in the Prometheus text
+exposition format; the worker serves both through its "metrics" op and,
+with --metrics-port, over HTTP (/metrics and /metrics.json).
+
+StreamStats keeps the throughput (frames per second over the last few
+seconds) and latency of each named stream, so that a stream that is slow
+or starved by others can be told apart from an overall slowdown.
+
+Sampler is an opt-in sampling profiler: a background thread records the
+Python stack of every thread at a fixed interval and reports the samples
+as collapsed stacks ("thread;module:function;... count" per line), the
+input format of flamegraph.pl and speedscope.
+"""
+
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PREFIX = 'siana_detection'
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32)
+
+# Timings keys recorded as stages
+STAGES = ('decode_ms', 'gate_ms', 'queue_ms', 'inference_ms', 'merge_ms', 'plot_ms', 'encode_ms', 'total_ms')
+
+# Period over which stream throughput and latency percentiles are computed
+STREAM_WINDOW_S = 10
+
+DEFAULT_SAMPLE_INTERVAL_MS = 5
+MAX_PROFILE_SECONDS = 120
+
+
+class Histogram:
+    """Cumulative-bucket histogram, as Prometheus exposes them."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': round(self.sum, 3),
+                'mean': round(self.sum / self.count, 3) if self.count else None,
+                'buckets': {str(bound): total for bound, total in self.cumulative()}}
+
+
+def memory_usage():
+    """Current and peak resident set size, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = peak if sys.platform == 'darwin' else peak * 1024
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        current = peak
+    return current, peak
+
+
+class StreamStats:
+    """Request outcomes, throughput and latency of one stream (not thread-safe)."""
+
+    def __init__(self, window_s=STREAM_WINDOW_S):
+        self.window_s = window_s
+        self.started_at = time.monotonic()
+        self.outcomes = Counter()
+        self.latency = Histogram(LATENCY_BUCKETS_MS)
+        # (finish time, latency in ms) of the requests answered within the window
+        self._recent = deque()
+
+    def observe(self, latency_ms, outcome='ok'):
+        now = time.monotonic()
+        self.outcomes[outcome] += 1
+        self.latency.observe(latency_ms)
+        self._recent.append((now, latency_ms))
+        self._trim(now)
+
+    def count(self, outcome):
+        self.outcomes[outcome] += 1
+
+    def _trim(self, now):
+        while self._recent and self._recent[0][0] < now - self.window_s:
+            self._recent.popleft()
+
+    def to_dict(self):
+        now = time.monotonic()
+        self._trim(now)
+        latencies = sorted(latency for _, latency in self._recent)
+        window = min(self.window_s, max(now - self.started_at, 1e-3))
+        stats = {'requests': dict(self.outcomes), 'fps': round(len(latencies) / window, 2),
+                 'mean_latency_ms': round(self.latency.sum / self.latency.count, 3) if self.latency.count else None}
+        if latencies:
+            stats['latency_ms'] = {'p50': round(latencies[len(latencies) // 2], 3),
+                                   'p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+                                   'max': round(latencies[-1], 3)}
+        return stats
+
+
+def _escape(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def metric_lines(name, kind, help_text, samples):
+    """
+    Exposition lines of one metric family. samples are (suffix, labels,
+    value) tuples, e.g. ('_bucket', {'le': 0.5}, 12).
+    """
+    lines = [f'# HELP {PREFIX}_{name} {help_text}', f'# TYPE {PREFIX}_{name} {kind}']
+    for suffix, labels, value in samples:
+        lines.append(f'{PREFIX}_{name}{suffix}{_labels(labels)} {value}')
+    return lines
+
+
+def _histogram_samples(histogram, labels, divisor=1):
+    samples = [('_bucket', dict(labels, le=bound / divisor if divisor != 1 else bound), total)
+               for bound, total in histogram.cumulative()]
+    samples.append(('_bucket', dict(labels, le='+Inf'), histogram.count))
+    samples.append(('_sum', labels or None, round(histogram.sum / divisor, 6)))
+    samples.append(('_count', labels or None, histogram.count))
+    return samples
+
+
+def stream_metric_lines(streams):
+    """Exposition lines of the StreamStats of each stream, by stream name."""
+    outcomes, latencies, fps = [], [], []
+    for stream, stats in sorted(streams.items()):
+        outcomes += [('', {'stream': stream, 'outcome': outcome}, count)
+                     for outcome, count in sorted(stats.outcomes.items())]
+        if stats.latency.count:
+            latencies += _histogram_samples(stats.latency, {'stream': stream}, divisor=1000)
+        fps.append(('', {'stream': stream}, stats.to_dict()['fps']))
+    if not streams:
+        return []
+    return (metric_lines('stream_requests_total', 'counter', 'Finished requests by stream and outcome.', outcomes)
+            + metric_lines('stream_latency_seconds', 'histogram', 'Time to answer a request, by stream.', latencies)
+            + metric_lines('stream_fps', 'gauge', f'Requests answered per second over the last {STREAM_WINDOW_S}s.',
+                           fps))
+
+
+def merge_prometheus(texts, label='worker'):
+    """
+    Merge the exposition texts of several processes into one, keeping the
+    samples of each metric family together and telling the processes apart
+    with a label holding their index.
+    """
+    families = {}
+    for index, text in enumerate(texts):
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                family = families.setdefault(line.split(' ', 3)[2], [line, None, []])
+            elif line.startswith('# TYPE '):
+                family[1] = line
+            elif line and family is not None:
+                end = min(i for i in (line.find('{'), line.find(' ')) if i >= 0)
+                if line[end] == '{':
+                    line = f'{line[:end + 1]}{label}="{index}",{line[end + 1:]}'
+                else:
+                    line = f'{line[:end]}{{{label}="{index}"}}{line[end:]}'
+                family[2].append(line)
+    lines = []
+    for help_line, type_line, samples in families.values():
+        lines += [help_line, type_line] + samples
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+class Metrics:
+    """
+    Thread-safe store of the worker's measurements. sources are callables
+    returning extra state at render time: engine counters and queue depth
+    (engine) and per-stream gate and controller counters (streams).
+    """
+
+    def __init__(self, info=None):
+        self.info = dict(info or {})
+        self.started_at = time.time()
+        self.stages = {stage: Histogram(LATENCY_BUCKETS_MS) for stage in STAGES}
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.outcomes = Counter()
+        self.streams = {}
+        self.gauges = {}
+        self.sources = {}
+        self._lock = threading.Lock()
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def _stream(self, stream):
+        stats = self.streams.get(stream)
+        if stats is None:
+            stats = self.streams[stream] = StreamStats()
+        return stats
+
+    def observe(self, timings, outcome='ok', stream=None):
+        """Record the timings dict of one finished request (of a stream)."""
+        with self._lock:
+            self.outcomes[outcome] += 1
+            if stream is not None and 'total_ms' in timings:
+                self._stream(stream).observe(timings['total_ms'], outcome)
+            for stage, histogram in self.stages.items():
+                value = timings.get(stage)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    histogram.observe(value)
+            batch_size = timings.get('batch_size')
+            if batch_size:
+                self.batch_sizes.observe(batch_size)
+
+    def count(self, outcome, stream=None):
+        with self._lock:
+            self.outcomes[outcome] += 1
+            if stream is not None:
+                self._stream(stream).count(outcome)
+
+    def to_dict(self):
+        current, peak = memory_usage()
+        with self._lock:
+            snapshot = {
+                'info': dict(self.info),
+                'uptime_s': round(time.time() - self.started_at, 1),
+                'rss_bytes': current,
+                'peak_rss_bytes': peak,
+                'requests': dict(self.outcomes),
+                'stages_ms': {stage: h.to_dict() for stage, h in self.stages.items() if h.count},
+                'batch_size': self.batch_sizes.to_dict(),
+                'gauges': dict(self.gauges),
+                'streams': {stream: stats.to_dict() for stream, stats in self.streams.items()},
+            }
+        for name, source in list(self.sources.items()):
+            value = source()
+            if isinstance(snapshot.get(name), dict):
+                # Sources may add fields to the entries already there (e.g. streams)
+                for key, entry in value.items():
+                    snapshot[name].setdefault(key, {}).update(entry)
+            else:
+                snapshot[name] = value
+        return snapshot
+
+    def render_prometheus(self):
+        """The metrics in the Prometheus text exposition format (0.0.4)."""
+        snapshot = self.to_dict()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.extend(metric_lines(name, kind, help_text, samples))
+
+        metric('info', 'gauge', 'Loaded model and backend.', [('', snapshot['info'], 1)])
+        metric('uptime_seconds', 'gauge', 'Time since the worker started.', [('', None, snapshot['uptime_s'])])
+        metric('resident_memory_bytes', 'gauge', 'Resident set size.', [('', None, snapshot['rss_bytes'])])
+        metric('peak_resident_memory_bytes', 'gauge', 'Peak resident set size.',
+               [('', None, snapshot['peak_rss_bytes'])])
+        for name, value in snapshot['gauges'].items():
+            metric(name, 'gauge', name.replace('_', ' ').capitalize() + '.', [('', None, value)])
+        metric('requests_total', 'counter', 'Finished requests by outcome.',
+               [('', {'outcome': outcome}, count) for outcome, count in sorted(snapshot['requests'].items())])
+
+        engine = snapshot.get('engine', {})
+        if engine:
+            metric('queue_depth', 'gauge', 'Frames waiting for inference.', [('', None, engine['queue_depth'])])
+            metric('frames_total', 'counter', 'Frames seen by the inference engine.',
+                   [('', {'state': state}, engine['counters'][state]) for state in sorted(engine['counters'])])
+
+        samples = []
+        with self._lock:
+            for stage, histogram in self.stages.items():
+                if not histogram.count:
+                    continue
+                samples += _histogram_samples(histogram, {'stage': stage[:-3]}, divisor=1000)
+            batch_samples = _histogram_samples(self.batch_sizes, {})
+            lines.extend(stream_metric_lines(self.streams))
+        metric('stage_seconds', 'histogram', 'Time spent per pipeline stage.', samples)
+        metric('batch_size', 'histogram', 'Images per forward pass.', batch_samples)
+
+        streams = snapshot.get('streams', {})
+        gate_samples, size_samples = [], []
+        for stream, state in sorted(streams.items()):
+            for result, count in sorted(state.get('gate', {}).items()):
+                gate_samples.append(('', {'stream': stream, 'result': result}, count))
+            if 'adaptive' in state:
+                size_samples.append(('', {'stream': stream}, state['adaptive']['imgsz']))
+        if gate_samples:
+            metric('gate_frames_total', 'counter', 'Frames seen by the motion gate.', gate_samples)
+        if size_samples:
+            metric('input_size_pixels', 'gauge', 'Input size chosen by the adaptive controller.', size_samples)
+        return '\n'.join(lines) + '\n'
+
+
+# --- Sampling profiler ---
+
+class Sampler:
+    """Samples the stacks of all threads and aggregates them as collapsed stacks."""
+
+    def __init__(self, interval_ms=DEFAULT_SAMPLE_INTERVAL_MS):
+        self.interval = max(0.001, interval_ms / 1000)
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _collapse(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            names.append(f"{module}:{code.co_name}")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                name = thread_names.get(thread_id, str(thread_id)).replace(';', '_')
+                self.stacks[f"{name};{self._collapse(frame)}"] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        """One "frame;frame;... count" line per distinct stack."""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def profile_for(seconds, interval_ms=DEFAULT_SAMPLE_INTERVAL_MS):
+    """Sample all threads for a while and return the collapsed stacks."""
+    sampler = Sampler(interval_ms)
+    sampler.start()
+    time.sleep(min(max(0.1, seconds), MAX_PROFILE_SECONDS))
+    sampler.stop()
+    return sampler.collapsed()
+
+
+# --- HTTP endpoint ---
+
+def serve_http(metrics, port, host='127.0.0.1', allow_profiling=False):
+    """
+    Serve /metrics (Prometheus text), /metrics.json and, when profiling is
+    allowed, /profile?seconds=N on a daemon thread. Returns the server.
+    """
+    import json
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/metrics':
+                body, content_type = metrics.render_prometheus().encode(), 'text/plain; version=0.0.4'
+            elif url.path == '/metrics.json':
+                body, content_type = json.dumps(metrics.to_dict()).encode(), 'application/json'
+            elif url.path == '/profile' and allow_profiling:
+                query = parse_qs(url.query)
+                seconds = float(query.get('seconds', ['10'])[0])
+                interval_ms = float(query.get('interval_ms', [DEFAULT_SAMPLE_INTERVAL_MS])[0])
+                body, content_type = profile_for(seconds, interval_ms).encode(), 'text/plain'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Keep scrapes out of the worker log
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"Metrics served on http://{host}:{server.server_address[1]}/metrics", file=sys.stderr, flush=True)
+    return server
@@ -0,0 +1,457 @@
+"""
+MJPEG stream ingest for the detector.
+
+Reads the multipart/x-mixed-replace stream served by esp32-cam.ino at
+/stream and hands every JPEG frame, in memory, to a callback; used with
+an engine.InferenceEngine the frames go straight to inference without
+touching the disk:
+
+    python mjpeg.py http://192.168.4.1/stream [--backend NAME] [--profile NAME]
+        [--stream NAME] [--duration S]
+
+prints one line of JSON per analysed frame (capture_ts, age, detections,
+timings) on stdout. Frames that arrive while the engine is busy replace
+the waiting one (the engine's "latest" policy).
+
+MultipartParser is incremental: received chunks are appended to one
+growing bytearray, the parse position moves forward through it and the
+consumed prefix is only dropped once it makes up most of the buffer, so
+every byte is copied a bounded number of times however the stream is cut
+into chunks. Parts are delimited by their Content-Length when the part
+headers give one (esp32-cam.ino does, and sends no CRLF after the JPEG),
+and by scanning for the next boundary otherwise; the scan resumes where
+the previous one stopped instead of starting over.
+
+MjpegClient reconnects with exponential backoff (and some jitter) when
+the camera is unreachable or the stream breaks. For tests and development
+without a camera, serve_mjpeg runs a local stand-in that streams images
+(or synthetic frames) the way the ESP32 does, chunked transfer encoding
+included:
+
+    python mjpeg.py --serve [IMAGES ...] [--port 8081] [--fps 10]
+"""
+
+import argparse
+import http.client
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BOUNDARY = b'frame'
+
+# Frames larger than this are skipped (UXGA JPEGs are a few hundred KB)
+MAX_FRAME_SIZE = 8 << 20
+
+# Bytes requested from the socket per read
+CHUNK_SIZE = 64 << 10
+
+DEFAULT_TIMEOUT_S = 5
+BACKOFF_INITIAL_S = 0.5
+BACKOFF_MAX_S = 10
+
+DEFAULT_SERVE_PORT = 8081
+DEFAULT_SERVE_FPS = 10
+
+_BOUNDARY_RE = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+
+
+def boundary_from_content_type(content_type):
+    """The multipart boundary of a Content-Type header, or None."""
+    match = _BOUNDARY_RE.search(content_type or '')
+    if not match:
+        return None
+    boundary = match.group(1).strip()
+    # Some servers repeat the leading dashes in the header
+    return (boundary[2:] if boundary.startswith('--') else boundary).encode('latin-1')
+
+
+class MultipartParser:
+    """
+    Incremental parser of a multipart/x-mixed-replace body. feed() takes
+    the chunks as they arrive and returns the complete parts as
+    (headers, body bytes) pairs.
+    """
+
+    def __init__(self, boundary=DEFAULT_BOUNDARY, max_frame_size=MAX_FRAME_SIZE):
+        self.delimiter = b'--' + boundary
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        # Parse position in the buffer, and where the current search resumes
+        self._pos = 0
+        self._scan = 0
+        self._state = 'boundary'
+        self._headers = None
+        self._length = None
+        self.counters = {'parts': 0, 'bytes': 0, 'skipped': 0}
+
+    def feed(self, data):
+        self._buffer += data
+        self.counters['bytes'] += len(data)
+        parts = []
+        while True:
+            if self._state == 'boundary':
+                if not self._find_boundary():
+                    break
+            elif self._state == 'headers':
+                if not self._parse_headers():
+                    break
+            else:
+                part = self._read_body()
+                if part is None:
+                    break
+                if part is not False:
+                    parts.append(part)
+        self._compact()
+        return parts
+
+    def _compact(self):
+        # Drop the consumed prefix once it outweighs the unparsed rest, so
+        # each byte is moved a bounded number of times
+        if self._pos and self._pos * 2 >= len(self._buffer):
+            del self._buffer[:self._pos]
+            self._scan = max(0, self._scan - self._pos)
+            self._pos = 0
+
+    def _find_boundary(self):
+        index = self._buffer.find(self.delimiter, max(self._pos, self._scan))
+        if index < 0:
+            # Keep what could be the start of a delimiter cut by the chunk
+            self._pos = max(self._pos, len(self._buffer) - len(self.delimiter) + 1)
+            self._scan = self._pos
+            return False
+        self._pos = self._scan = index + len(self.delimiter)
+        self._state = 'headers'
+        return True
+
+    def _parse_headers(self):
+        end = self._buffer.find(b'\r\n\r\n', max(self._pos, self._scan))
+        if end < 0:
+            self._scan = max(self._pos, len(self._buffer) - 3)
+            if len(self._buffer) - self._pos > 8192:
+                # Not a part header: resynchronise on the next boundary
+                self.counters['skipped'] += 1
+                self._state = 'boundary'
+            return False
+        block = bytes(self._buffer[self._pos:end]).decode('latin-1')
+        # The first line is the rest of the boundary line ("" or "--" at the end)
+        lines = block.split('\r\n')
+        self._headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            self._headers[name.strip().lower()] = value.strip()
+        try:
+            self._length = int(self._headers['content-length'])
+        except (KeyError, ValueError):
+            self._length = None
+        self._pos = self._scan = end + 4
+        self._state = 'body'
+        return True
+
+    def _read_body(self):
+        """The finished part, None when more data is needed, False for a skipped part."""
+        start = self._pos
+        if self._length is not None:
+            end = start + self._length
+            if self._length > self.max_frame_size:
+                # Skip it without keeping it in memory
+                if len(self._buffer) < end:
+                    self._length -= len(self._buffer) - start
+                    self._pos = self._scan = len(self._buffer)
+                    return None
+                return self._skip(end)
+            if len(self._buffer) < end:
+                return None
+            next_pos = end
+        else:
+            index = self._buffer.find(self.delimiter, max(start, self._scan))
+            if index < 0:
+                self._scan = max(start, len(self._buffer) - len(self.delimiter) + 1)
+                if len(self._buffer) - start > self.max_frame_size:
+                    self.counters['skipped'] += 1
+                    self._pos = self._scan
+                    self._state = 'boundary'
+                return None
+            end = next_pos = index
+            if self._buffer[end - 2:end] == b'\r\n':
+                end -= 2
+
+        body = bytes(self._buffer[start:end])
+        self._pos = self._scan = next_pos
+        self._state = 'boundary'
+        self.counters['parts'] += 1
+        return self._headers, body
+
+    def _skip(self, end):
+        self.counters['skipped'] += 1
+        self._pos = self._scan = end
+        self._state = 'boundary'
+        return False
+
+
+class MjpegClient:
+    """
+    Reads an MJPEG stream and calls on_frame(jpeg_bytes, capture_ts) for
+    every frame, capture_ts being the arrival time in milliseconds since the
+    epoch. run() loops until stop(), reconnecting with exponential backoff.
+    """
+
+    def __init__(self, url, on_frame, timeout=DEFAULT_TIMEOUT_S, backoff_initial=BACKOFF_INITIAL_S,
+                 backoff_max=BACKOFF_MAX_S, chunk_size=CHUNK_SIZE):
+        self.url = url
+        self.on_frame = on_frame
+        self.timeout = timeout
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.chunk_size = chunk_size
+        self.connected = False
+        self.counters = {'connects': 0, 'disconnects': 0, 'frames': 0, 'skipped': 0, 'bytes': 0}
+        self._stop = threading.Event()
+        self._response = None
+        self._thread = None
+
+    def start(self):
+        """Run the client on a background thread."""
+        self._thread = threading.Thread(target=self.run, name="mjpeg-client", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        response = self._response
+        if response is not None:
+            try:
+                response.close()
+            except Exception:
+                pass
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(self.timeout)
+
+    def run(self):
+        backoff = self.backoff_initial
+        while not self._stop.is_set():
+            frames_before = self.counters['frames']
+            try:
+                self._read_stream()
+            except (OSError, http.client.HTTPException, ValueError, AttributeError) as e:
+                # AttributeError: read1 on a response closed by stop()
+                if not self._stop.is_set():
+                    print(f"MJPEG stream error: {str(e)}", file=sys.stderr, flush=True)
+            if self.connected:
+                self.connected = False
+                self.counters['disconnects'] += 1
+            if self._stop.is_set():
+                break
+            # Start over from a short delay once the stream delivered frames
+            if self.counters['frames'] > frames_before:
+                backoff = self.backoff_initial
+            delay = backoff * random.uniform(0.8, 1.2)
+            print(f"Reconnecting to {self.url} in {delay:.1f}s", file=sys.stderr, flush=True)
+            self._stop.wait(delay)
+            backoff = min(backoff * 2, self.backoff_max)
+
+    def _read_stream(self):
+        response = urllib.request.urlopen(self.url, timeout=self.timeout)
+        self._response = response
+        try:
+            boundary = boundary_from_content_type(response.headers.get('Content-Type'))
+            if boundary is None:
+                raise ValueError(f"No multipart boundary in Content-Type: {response.headers.get('Content-Type')}")
+            parser = MultipartParser(boundary)
+            self.connected = True
+            self.counters['connects'] += 1
+            print(f"Connected to MJPEG stream {self.url}", file=sys.stderr, flush=True)
+
+            while not self._stop.is_set():
+                chunk = response.read1(self.chunk_size)
+                if not chunk:
+                    raise ValueError("Stream ended")
+                self.counters['bytes'] += len(chunk)
+                skipped = parser.counters['skipped']
+                for headers, body in parser.feed(chunk):
+                    if not body.startswith(b'\xff\xd8'):
+                        self.counters['skipped'] += 1
+                        continue
+                    self.counters['frames'] += 1
+                    self.on_frame(body, time.time() * 1000)
+                self.counters['skipped'] += parser.counters['skipped'] - skipped
+        finally:
+            self._response = None
+            response.close()
+
+
+# --- Feeding the inference engine ---
+
+def feed_engine(client_url, engine, on_result, stream='esp32-cam', options=None, **client_kwargs):
+    """
+    An MjpegClient (not started) that decodes every frame and submits it
+    to an InferenceEngine with the "latest" policy; on_result(result,
+    timings) is called for each analysed frame.
+    """
+    from engine import POLICY_LATEST, FrameDropped
+    from process_image import decode_image
+
+    def on_done(future):
+        try:
+            result, timings = future.result()
+        except FrameDropped:
+            return
+        except Exception as e:
+            print(f"Error in inference: {str(e)}", file=sys.stderr, flush=True)
+            return
+        on_result(result, timings)
+
+    def on_frame(jpeg, capture_ts):
+        try:
+            img = decode_image(jpeg)
+        except Exception as e:
+            print(f"Could not decode frame: {str(e)}", file=sys.stderr, flush=True)
+            return
+        future = engine.submit(img, options, policy=POLICY_LATEST, stream=stream, capture_ts=capture_ts)
+        future.add_done_callback(on_done)
+
+    return MjpegClient(client_url, on_frame, **client_kwargs)
+
+
+# --- Local stand-in for the ESP32-CAM ---
+
+def serve_mjpeg(frames, port=DEFAULT_SERVE_PORT, fps=DEFAULT_SERVE_FPS, host='127.0.0.1',
+                boundary=DEFAULT_BOUNDARY, max_frames=None):
+    """
+    Serve JPEG frames in a loop at /stream like esp32-cam.ino: chunked
+    multipart with "--frame", Content-Type and Content-Length part headers
+    and no CRLF after the data. max_frames ends each response after that
+    many frames. Runs on a daemon thread; returns the server.
+    """
+    if not frames:
+        raise Exception("No frames to serve")
+    interval = 1 / fps if fps > 0 else 0
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def write_chunk(self, data):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+        def do_GET(self):
+            if self.path != '/stream':
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', f'multipart/x-mixed-replace; boundary={boundary.decode()}')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            sent = 0
+            try:
+                while max_frames is None or sent < max_frames:
+                    frame = frames[sent % len(frames)]
+                    self.write_chunk(b'--' + boundary + b'\r\n')
+                    self.write_chunk(b'Content-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(frame))
+                    self.write_chunk(frame)
+                    self.wfile.flush()
+                    sent += 1
+                    time.sleep(interval)
+                self.wfile.write(b'0\r\n\r\n')
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mjpeg-server", daemon=True).start()
+    print(f"Serving {len(frames)} frames at http://{host}:{server.server_address[1]}/stream ({fps} fps)",
+          file=sys.stderr, flush=True)
+    return server
+
+
+def load_frames(paths):
+    """JPEG bytes of the given images, or of synthetic VGA frames."""
+    import cv2
+
+    if paths:
+        from benchmark import load_sample_images
+        images = load_sample_images(paths)
+    else:
+        from benchmark import RESOLUTIONS, synthetic_frame
+        images = [synthetic_frame(*RESOLUTIONS['VGA'], seed) for seed in range(8)]
+    return [cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 80])[1].tobytes() for img in images]
+
+
+def parse_args(argv):
+    from profiles import DEFAULT_PROFILE, PROFILES
+    from backends import BACKENDS, DEFAULT_BACKEND, DEFAULT_INT8
+
+    parser = argparse.ArgumentParser(description="Run detection on an MJPEG stream, or serve a stand-in stream.")
+    parser.add_argument("url", nargs='?', help="MJPEG stream URL (e.g. http://192.168.4.1/stream)")
+    parser.add_argument("--stream", default='esp32-cam', help="stream name used by the engine")
+    parser.add_argument("--backend", choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help="inference backend (default from DETECTION_BACKEND)")
+    parser.add_argument("--int8", action="store_true", default=DEFAULT_INT8,
+                        help="use the INT8-quantized model (onnx/openvino)")
+    parser.add_argument("--profile", choices=PROFILES, default=DEFAULT_PROFILE,
+                        help="inference profile (default from DETECTION_PROFILE)")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    parser.add_argument("--serve", nargs='*', metavar="IMAGE",
+                        help="serve these images (default: synthetic frames) as a stand-in camera")
+    parser.add_argument("--port", type=int, default=DEFAULT_SERVE_PORT, help="port of the stand-in camera")
+    parser.add_argument("--fps", type=float, default=DEFAULT_SERVE_FPS, help="frame rate of the stand-in camera")
+    args = parser.parse_args(argv)
+    if args.serve is None and not args.url:
+        parser.error("a stream URL or --serve is needed")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.serve is not None:
+        server = serve_mjpeg(load_frames(args.serve), args.port, args.fps)
+        try:
+            time.sleep(args.duration) if args.duration else threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        server.shutdown()
+        return 0
+
+    from engine import InferenceEngine
+    from process_image import extract_detections, load_class_labels, load_model
+    from profiles import get_profile
+    from worker import redirect_stdout
+
+    # Keep stdout for the detections
+    out = redirect_stdout()
+    write_lock = threading.Lock()
+    class_labels = load_class_labels()
+    model = load_model(backend=args.backend, int8=args.int8, class_labels=class_labels)
+    engine = InferenceEngine(model)
+
+    def on_result(result, timings):
+        line = json.dumps({'stream': args.stream, 'capture_ts': timings['capture_ts'],
+                           'age_ms': round(timings['age_ms'], 1), 'stale': timings['stale'],
+                           'detections': extract_detections(result, class_labels),
+                           'timings': {key: round(value, 3) for key, value in timings.items()
+                                       if key.endswith('_ms')}})
+        with write_lock:
+            out.write(line.encode('utf-8') + b'\n')
+            out.flush()
+
+    client = feed_engine(args.url, engine, on_result, args.stream,
+                         get_profile(args.profile).options(model.names)).start()
+    try:
+        time.sleep(args.duration) if args.duration else threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    client.stop()
+    engine.stop()
+    print(f"MJPEG client counters: {client.counters}, engine counters: {engine.get_counters()}",
+          file=sys.stderr, flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,144 @@
+"""
+Motion gate that skips inference on frames that have not changed.
+
+When the robot is parked at an inspection point, consecutive camera frames
+are nearly identical. Each frame is reduced to a small grayscale thumbnail
+and a 64-bit difference hash (dHash):
+
+- if the thumbnail differs from the last inferred frame by less than the
+  threshold (mean absolute difference, 0-255 scale), the previous
+  detections are reused;
+- otherwise, if the hash matches one of the recently inferred frames kept
+  in an LRU cache (e.g. the arm swinging back to a position it was in), the
+  cached detections are reused;
+- otherwise the frame goes through the model and its result is stored.
+
+A frame is always re-inferred after max_skips consecutive reuses, so
+slow drift cannot keep stale boxes on screen forever.
+
+Detections are only reused under the inference options they were computed
+with (see options_key()): a frame checked with other options (profile,
+classes, imgsz, conf, tiling...) resets the gate and is inferred.
+"""
+
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from backends import Detections
+
+DEFAULT_CHANGE_THRESHOLD = 2.0
+DEFAULT_THUMB_SIZE = 32
+DEFAULT_CACHE_SIZE = 64
+DEFAULT_MAX_SKIPS = 30
+
+
+class Fingerprint:
+    """Downscaled grayscale thumbnail and dHash of a frame, and the options it is inferred with."""
+
+    __slots__ = ('thumb', 'hash', 'options_key')
+
+    def __init__(self, thumb, frame_hash, options_key=None):
+        self.thumb = thumb
+        self.hash = frame_hash
+        self.options_key = options_key
+
+
+def options_key(options, tiled=False):
+    """Hashable form of resolved inference options (profiles.InferenceProfile.options())."""
+    return (bool(tiled),) + tuple(sorted(options.items()))
+
+
+def fingerprint(img, thumb_size=DEFAULT_THUMB_SIZE):
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    thumb = cv2.resize(gray, (thumb_size, thumb_size), interpolation=cv2.INTER_AREA)
+    # dHash: compare horizontally adjacent pixels of a 9x8 thumbnail
+    small = cv2.resize(thumb, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    frame_hash = int(np.packbits(bits).view('>u8')[0])
+    return Fingerprint(thumb, frame_hash)
+
+
+def reuse_detections(result, img):
+    """Rebind cached detections to the new frame so they are drawn on it."""
+    return Detections(result.boxes, result.confidences, result.class_ids, img, result.names)
+
+
+class MotionGate:
+    """Decides per frame whether the previous detections can be reused."""
+
+    def __init__(self, threshold=DEFAULT_CHANGE_THRESHOLD, thumb_size=DEFAULT_THUMB_SIZE,
+                 cache_size=DEFAULT_CACHE_SIZE, max_skips=DEFAULT_MAX_SKIPS):
+        self.threshold = threshold
+        self.thumb_size = thumb_size
+        self.cache_size = cache_size
+        self.max_skips = max_skips
+        self._last = None
+        self._last_result = None
+        self._skips = 0
+        self._cache = OrderedDict()
+        self._options_key = None
+        self._lock = threading.Lock()
+        self.counters = {'inferred': 0, 'reused_motion': 0, 'reused_cache': 0, 'option_resets': 0}
+
+    def _reset(self, options_key):
+        if self._last_result is not None or self._cache:
+            self.counters['option_resets'] += 1
+        self._options_key = options_key
+        self._last = None
+        self._last_result = None
+        self._skips = 0
+        self._cache.clear()
+
+    def check(self, img, options_key=None):
+        """
+        Returns (fingerprint, cached_result, reason). cached_result is None
+        when the frame must be inferred; reason is 'motion' or 'cache' when
+        a previous result is reused. options_key identifies the inference
+        options; a change of options resets the gate.
+        """
+        fp = fingerprint(img, self.thumb_size)
+        fp.options_key = options_key
+        with self._lock:
+            if options_key != self._options_key:
+                self._reset(options_key)
+            if self._skips < self.max_skips:
+                if self._last is not None and self._last_result is not None:
+                    diff = cv2.absdiff(fp.thumb, self._last.thumb).mean()
+                    if diff < self.threshold:
+                        self._skips += 1
+                        self.counters['reused_motion'] += 1
+                        return fp, reuse_detections(self._last_result, img), 'motion'
+
+                key = (options_key, fp.hash)
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self._cache.move_to_end(key)
+                    self._skips += 1
+                    self.counters['reused_cache'] += 1
+                    return fp, reuse_detections(cached, img), 'cache'
+
+            self.counters['inferred'] += 1
+            return fp, None, None
+
+    def store(self, fp, result):
+        """Record the result of an inferred frame as the new reference."""
+        # Keep only the boxes, not the frame they were found on
+        result = Detections(result.boxes, result.confidences, result.class_ids, None, result.names)
+        with self._lock:
+            if fp.options_key != self._options_key:
+                return # Inferred under options that have been replaced since
+            self._last = fp
+            self._last_result = result
+            self._skips = 0
+            key = (fp.options_key, fp.hash)
+            self._cache[key] = result
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def get_counters(self):
+        with self._lock:
+            return dict(self.counters)
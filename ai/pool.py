@@ -0,0 +1,541 @@
+"""
+Fair scheduling of several camera streams over a pool of detection workers.
+
+Started with `python process_image.py --pool [--processes N]
+[--scheduling round_robin|weighted] [--in-flight N] [worker options]`.
+The pool speaks the worker protocol (see worker.py) on stdin/stdout and
+runs N `process_image.py --worker` child processes behind it (default: one
+per CPU), each with its share of the CPUs as inference threads. Options
+it does not know itself are passed on to every worker.
+
+Every stream (the "stream" field of a request, "default" when missing) has
+its own waiting room in the pool: a single slot for "latest" policy frames,
+where a newer frame replaces the waiting one (answered with
+{"ok": false, "dropped": true}), and a queue for FIFO requests. A worker
+only holds --in-flight requests at a time (default: its batch size); each
+time one of them is answered, the scheduler picks the stream whose request
+goes next, so a stream sending at a high rate, or a burst of uploads, only
+ever gets its turn and cannot starve the other robots:
+
+- round_robin: streams with a waiting request take turns;
+- weighted: turns are shared in proportion to the "priority" of each
+  stream (taken from its latest request, default 1), with smooth weighted
+  round-robin so a high-priority stream does not get all its turns in a row.
+
+Requests that rely on per-stream state kept by the worker (motion gate,
+tracker, adaptive input size) always go to the same worker, picked for the
+stream on its first such request; other requests go to the least busy
+worker with a free slot.
+
+The "stats" op returns the pool counters, the submitted/processed/dropped
+/stale counts, throughput (fps) and latency of every stream as seen by the
+clients (from the pool receiving a request to answering it), and the
+state of each worker. The "metrics" op adds the metrics of every worker
+(labelled worker="<index>" in the Prometheus format), and "profile" is
+passed on to the worker given by "worker" (default 0).
+"""
+
+import argparse
+import itertools
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import metrics
+from worker import read_message, redirect_stdout, write_message
+
+SCHEDULING_ROUND_ROBIN = 'round_robin'
+SCHEDULING_WEIGHTED = 'weighted'
+
+# Delay before a crashed worker process is restarted
+RESTART_DELAY_S = 2
+
+# How long the pool waits for a worker to answer a metrics query
+QUERY_TIMEOUT_S = 10
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'process_image.py')
+
+
+class Stream:
+    """Waiting requests, scheduling weight and statistics of one stream."""
+
+    def __init__(self, name):
+        self.name = name
+        self.weight = 1.0
+        # Credit of the smooth weighted round-robin
+        self.current = 0.0
+        self.latest = None
+        self.queue = deque()
+        # Worker holding the stream's gate, tracker and controller state
+        self.home = None
+        self.in_flight = 0
+        self.stats = metrics.StreamStats()
+
+    def peek(self):
+        if self.queue:
+            return self.queue[0]
+        return self.latest
+
+    def pop(self):
+        if self.queue:
+            return self.queue.popleft()
+        request, self.latest = self.latest, None
+        return request
+
+    def waiting(self):
+        return len(self.queue) + (self.latest is not None)
+
+
+class PoolRequest:
+    """A client request waiting in the pool or running on a worker."""
+
+    def __init__(self, header, payload):
+        self.header = header
+        self.payload = payload
+        self.received_at = time.perf_counter()
+
+    @property
+    def pinned(self):
+        """Whether the request uses per-stream state kept by the worker."""
+        return bool(self.header.get('gate') or self.header.get('track') or self.header.get('adaptive'))
+
+
+class WorkerProcess:
+    """One `process_image.py --worker` child and the requests it is running."""
+
+    def __init__(self, index, args, env, on_message):
+        self.index = index
+        self.args = args
+        self.env = env
+        self.on_message = on_message
+        self.process = None
+        self.ready = False
+        self.loaded = Future()
+        self.in_flight = {}
+        self._write_lock = threading.Lock()
+
+    def start(self):
+        self.ready = False
+        self.loaded = Future()
+        self.process = subprocess.Popen(self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=self.env)
+        threading.Thread(target=self._read, args=(self.process,), name=f"pool-reader-{self.index}",
+                         daemon=True).start()
+
+    def _read(self, process):
+        try:
+            while True:
+                header, payload = read_message(process.stdout)
+                if header is None:
+                    break
+                if header.get('type') == 'ready':
+                    self.ready = True
+                    self.loaded.set_result(header)
+                elif header.get('type') == 'error':
+                    self.loaded.set_exception(Exception(header.get('error', 'Worker failed to start')))
+                else:
+                    self.on_message(self, header, payload)
+        except (ValueError, EOFError, OSError) as e:
+            print(f"Worker {self.index} protocol error: {str(e)}", file=sys.stderr, flush=True)
+        process.wait()
+        if not self.loaded.done():
+            self.loaded.set_exception(Exception(f"Worker {self.index} exited with code {process.returncode}"))
+        self.on_message(self, None, None)
+
+    def send(self, header, payload=b''):
+        with self._write_lock:
+            write_message(self.process.stdin, header, payload)
+
+    def close(self):
+        """Ask the worker to finish what it holds and exit."""
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+
+
+class Pool:
+    """
+    Receives client requests, keeps them per stream and dispatches them to
+    the worker processes as those free up.
+    """
+
+    def __init__(self, output_stream, worker_args, processes, threads, in_flight,
+                 scheduling=SCHEDULING_WEIGHTED):
+        self.output_stream = output_stream
+        self.in_flight = max(1, in_flight)
+        self.scheduling = scheduling
+        self.streams = {}
+        self.counters = {'submitted': 0, 'processed': 0, 'dropped': 0, 'stale': 0, 'errors': 0, 'restarts': 0}
+        self.running = True
+        self._ids = itertools.count(1)
+        # Pool-level queries (metrics, profile) sent to a worker: (worker, future) by request id
+        self._queries = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._write_lock = threading.Lock()
+
+        # The pool serves the metrics of every worker; they must not bind the port themselves
+        env = dict(os.environ)
+        env.pop('DETECTION_METRICS_PORT', None)
+        args = [sys.executable, SCRIPT_PATH, '--worker'] + list(worker_args)
+        if threads:
+            args += ['--threads', str(threads)]
+        self.workers = [WorkerProcess(index, args, env, self._on_worker_message) for index in range(processes)]
+
+    def send(self, header, payload=b''):
+        with self._write_lock:
+            write_message(self.output_stream, header, payload)
+
+    def start(self):
+        """Start the workers and wait for their models. Returns the ready header of the first one."""
+        for worker in self.workers:
+            worker.start()
+        headers = [worker.loaded.result() for worker in self.workers]
+        ready = dict(headers[0], load_ms=max(header['load_ms'] for header in headers),
+                     processes=len(self.workers), scheduling=self.scheduling)
+        return ready
+
+    def close(self):
+        """Answer everything still waiting (while a worker is up), then stop the workers."""
+        with self._lock:
+            self._idle.wait_for(lambda: not any(worker.ready for worker in self.workers)
+                                or (not any(stream.waiting() for stream in self.streams.values())
+                                    and not any(worker.in_flight for worker in self.workers)))
+            self.running = False
+            leftover = []
+            for stream in self.streams.values():
+                while stream.waiting():
+                    leftover.append(stream.pop())
+        for request in leftover:
+            self.send({'id': request.header.get('id'), 'ok': False, 'error': 'Detection worker pool stopped'})
+        for worker in self.workers:
+            worker.close()
+
+    # --- Scheduling ---
+
+    def _stream(self, name):
+        stream = self.streams.get(name)
+        if stream is None:
+            stream = self.streams[name] = Stream(name)
+        return stream
+
+    def submit(self, header, payload):
+        """Queue a process request on its stream and dispatch what can be."""
+        request = PoolRequest(header, payload)
+        replaced = None
+        with self._lock:
+            stream = self._stream(header.get('stream', 'default'))
+            self.counters['submitted'] += 1
+            if header.get('priority') is not None:
+                stream.weight = max(0.01, float(header['priority']))
+            if header.get('policy') == 'latest':
+                replaced, stream.latest = stream.latest, request
+                if replaced is not None:
+                    self.counters['dropped'] += 1
+                    stream.stats.count('dropped')
+            else:
+                stream.queue.append(request)
+        if replaced is not None:
+            self.send({'id': replaced.header.get('id'), 'ok': False, 'dropped': True,
+                       'error': f"Frame on stream '{stream.name}' replaced by a newer one"})
+        self._dispatch()
+
+    def _worker_for(self, stream, request):
+        """The worker that should run a request, or None when it has to wait."""
+        if request.pinned:
+            if stream.home is None:
+                # Spread stateful streams over the workers
+                homes = [s.home for s in self.streams.values() if s.home is not None]
+                stream.home = min(range(len(self.workers)), key=homes.count)
+            worker = self.workers[stream.home]
+            return worker if worker.ready and len(worker.in_flight) < self.in_flight else None
+        free = [worker for worker in self.workers if worker.ready and len(worker.in_flight) < self.in_flight]
+        return min(free, key=lambda worker: len(worker.in_flight)) if free else None
+
+    def _pick(self):
+        """
+        The next (stream, worker) pair to dispatch, by smooth weighted
+        round-robin over the streams that have a request a worker can take.
+        """
+        candidates = []
+        for stream in self.streams.values():
+            request = stream.peek()
+            if request is None:
+                continue
+            worker = self._worker_for(stream, request)
+            if worker is not None:
+                candidates.append((stream, worker))
+        if not candidates:
+            return None, None
+
+        total = 0.0
+        for stream, _ in candidates:
+            weight = stream.weight if self.scheduling == SCHEDULING_WEIGHTED else 1.0
+            stream.current += weight
+            total += weight
+        stream, worker = max(candidates, key=lambda candidate: candidate[0].current)
+        stream.current -= total
+        return stream, worker
+
+    def _dispatch(self):
+        """Send waiting requests to workers until no worker can take more."""
+        while True:
+            with self._lock:
+                stream, worker = self._pick()
+                if stream is None:
+                    return
+                request = stream.pop()
+                worker_id = next(self._ids)
+                worker.in_flight[worker_id] = (request, stream)
+                stream.in_flight += 1
+            try:
+                worker.send(dict(request.header, id=worker_id), request.payload)
+            except OSError as e:
+                # The worker died; its reader fails the requests it held
+                print(f"Could not send to worker {worker.index}: {str(e)}", file=sys.stderr, flush=True)
+
+    def _on_worker_message(self, worker, header, payload):
+        if header is None:
+            self._on_worker_exit(worker)
+            return
+
+        worker_id = header.get('id')
+        with self._lock:
+            query = self._queries.pop(worker_id, None)
+            entry = None if query is not None else worker.in_flight.pop(worker_id, None)
+        if query is not None:
+            query[1].set_result((header, payload))
+            return
+        if entry is None:
+            return
+
+        request, stream = entry
+        latency_ms = (time.perf_counter() - request.received_at) * 1000
+        with self._lock:
+            stream.in_flight -= 1
+            if header.get('ok'):
+                outcome = 'stale' if header.get('stale') else 'ok'
+                self.counters['processed'] += 1
+                self.counters['stale'] += outcome == 'stale'
+                stream.stats.observe(latency_ms, outcome)
+            elif header.get('dropped'):
+                self.counters['dropped'] += 1
+                stream.stats.count('dropped')
+            else:
+                self.counters['errors'] += 1
+                stream.stats.count('error')
+            self._idle.notify_all()
+
+        response = dict(header, id=request.header.get('id'))
+        if response.get('timings') is not None:
+            response['timings'] = dict(response['timings'], pool_ms=latency_ms)
+        self.send(response, payload or b'')
+        self._dispatch()
+
+    def _on_worker_exit(self, worker):
+        with self._lock:
+            worker.ready = False
+            failed = list(worker.in_flight.values())
+            worker.in_flight.clear()
+            for _, stream in failed:
+                stream.in_flight -= 1
+                stream.stats.count('error')
+            self.counters['errors'] += len(failed)
+            restart = self.running
+            queries = [query for query_worker, query in self._queries.values() if query_worker is worker]
+            self._idle.notify_all()
+        for query in queries:
+            if not query.done():
+                query.set_exception(Exception(f"Worker {worker.index} exited"))
+        for request, _ in failed:
+            self.send({'id': request.header.get('id'), 'ok': False, 'error': 'Detection worker process exited'})
+
+        if restart and worker.loaded.done() and worker.loaded.exception() is None:
+            print(f"Worker {worker.index} exited, restarting in {RESTART_DELAY_S}s", file=sys.stderr, flush=True)
+            with self._lock:
+                self.counters['restarts'] += 1
+            timer = threading.Timer(RESTART_DELAY_S, self._restart, args=(worker,))
+            timer.daemon = True
+            timer.start()
+
+    def _restart(self, worker):
+        with self._lock:
+            if not self.running:
+                return
+        worker.start()
+        # Dispatch again once the model is loaded
+        worker.loaded.add_done_callback(lambda _: self._dispatch())
+
+    # --- Queries ---
+
+    def query(self, worker, header):
+        """Send a pool-level request to one worker and wait for its answer."""
+        future = Future()
+        with self._lock:
+            worker_id = next(self._ids)
+            self._queries[worker_id] = (worker, future)
+        worker.send(dict(header, id=worker_id))
+        return future
+
+    def _query_all(self, header):
+        futures = [self.query(worker, header) for worker in self.workers if worker.ready]
+        return [future.result(timeout=QUERY_TIMEOUT_S) for future in futures]
+
+    def get_counters(self):
+        with self._lock:
+            counters = dict(self.counters)
+            counters['streams'] = {name: dict(stream.stats.to_dict(), waiting=stream.waiting(),
+                                              in_flight=stream.in_flight, weight=stream.weight,
+                                              worker=stream.home)
+                                   for name, stream in self.streams.items()}
+            counters['workers'] = [{'pid': worker.process.pid if worker.process else None,
+                                    'ready': worker.ready, 'in_flight': len(worker.in_flight)}
+                                   for worker in self.workers]
+        return counters
+
+    def to_dict(self):
+        """Pool counters and streams, plus the metrics of every worker."""
+        snapshot = self.get_counters()
+        snapshot['workers'] = [dict(state, metrics=header.get('metrics'))
+                               for state, (header, _) in zip(snapshot['workers'],
+                                                             self._query_all({'op': 'metrics'}))]
+        return snapshot
+
+    def render_prometheus(self):
+        """Stream metrics of the pool followed by the metrics of every worker."""
+        worker_texts = [payload.decode('utf-8')
+                        for _, payload in self._query_all({'op': 'metrics', 'format': 'prometheus'})]
+        with self._lock:
+            lines = metrics.stream_metric_lines({name: stream.stats for name, stream in self.streams.items()})
+            lines += metrics.metric_lines('stream_waiting', 'gauge', 'Requests waiting in the pool, by stream.',
+                                          [('', {'stream': name}, stream.waiting())
+                                           for name, stream in sorted(self.streams.items())])
+            lines += metrics.metric_lines('worker_in_flight', 'gauge', 'Requests held by each worker process.',
+                                          [('', {'worker': worker.index}, len(worker.in_flight))
+                                           for worker in self.workers])
+        # The pool's stream metrics share their names with the workers' own
+        lines = [line.replace(f'{metrics.PREFIX}_stream_', f'{metrics.PREFIX}_pool_stream_', 1) for line in lines]
+        return '\n'.join(lines) + '\n' + metrics.merge_prometheus(worker_texts)
+
+    # --- Requests ---
+
+    def handle(self, header, payload):
+        request_id = header.get('id')
+        op = header.get('op', 'process')
+        if op == 'process':
+            self.submit(header, payload)
+            return
+        if op == 'ping':
+            self.send({'id': request_id, 'ok': True})
+            return
+        # Queries that wait on the workers are answered from a thread so requests keep flowing
+        threading.Thread(target=self._answer_query, args=(header,), name=f"pool-{op}", daemon=True).start()
+
+    def _answer_query(self, header):
+        request_id = header.get('id')
+        op = header.get('op')
+        try:
+            if op == 'stats':
+                self.send({'id': request_id, 'ok': True, 'counters': self.get_counters()})
+            elif op == 'metrics' and header.get('format') == 'prometheus':
+                self.send({'id': request_id, 'ok': True}, self.render_prometheus().encode('utf-8'))
+            elif op == 'metrics':
+                self.send({'id': request_id, 'ok': True, 'metrics': self.to_dict()})
+            elif op == 'profile':
+                worker = self.workers[int(header.get('worker', 0))]
+                # The sampling itself takes "seconds"
+                timeout = float(header.get('seconds', 10)) + QUERY_TIMEOUT_S
+                response, payload = self.query(worker, header).result(timeout=timeout)
+                self.send(dict(response, id=request_id), payload or b'')
+            else:
+                raise Exception(f"Unknown op: {op}")
+        except Exception as e:
+            print(f"Error in request {request_id}: {str(e)}", file=sys.stderr, flush=True)
+            self.send({'id': request_id, 'ok': False, 'error': str(e)})
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="process_image.py --pool",
+                                     description="Schedule detection requests of several streams over "
+                                                 "a pool of worker processes. Other options are passed "
+                                                 "on to the workers.")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="inference threads per worker (default: CPUs / processes)")
+    parser.add_argument("--in-flight", type=int, default=0,
+                        help="requests held by each worker at a time (default: its batch size)")
+    parser.add_argument("--scheduling", choices=(SCHEDULING_ROUND_ROBIN, SCHEDULING_WEIGHTED),
+                        default=SCHEDULING_WEIGHTED,
+                        help="turns between streams: plain round-robin, or weighted by request priority")
+    parser.add_argument("--metrics-port", type=int, default=int(os.environ.get('DETECTION_METRICS_PORT', '0')),
+                        help="serve the pool and worker metrics on this local port (0: off)")
+    args, worker_args = parser.parse_known_args(argv)
+
+    cpus = os.cpu_count() or 1
+    args.processes = args.processes if args.processes > 0 else cpus
+    if args.threads is None:
+        args.threads = max(1, cpus // args.processes)
+    if args.in_flight <= 0:
+        # The worker's own batch size, so each of them can fill a batch
+        batch_args = argparse.ArgumentParser(add_help=False)
+        batch_args.add_argument("--batch-size", type=int, default=None)
+        batch_size = batch_args.parse_known_args(worker_args)[0].batch_size
+        args.in_flight = batch_size or int(os.environ.get('DETECTION_BATCH_SIZE', '4'))
+    return args, worker_args
+
+
+def serve(argv=(), input_stream=None, output_stream=None):
+    """Serve requests until stdin closes. Returns a process exit code."""
+    args, worker_args = parse_args(list(argv))
+    if output_stream is None:
+        output_stream = redirect_stdout()
+    if input_stream is None:
+        input_stream = sys.stdin.buffer
+
+    pool = Pool(output_stream, worker_args, args.processes, args.threads, args.in_flight, args.scheduling)
+    try:
+        start = time.perf_counter()
+        ready = pool.start()
+    except Exception as e:
+        print(f"Error starting worker pool: {str(e)}", file=sys.stderr, flush=True)
+        pool.running = False
+        for worker in pool.workers:
+            if worker.process and worker.process.poll() is None:
+                worker.process.kill()
+        write_message(output_stream, {'type': 'error', 'error': str(e)})
+        return 1
+
+    if args.metrics_port:
+        try:
+            metrics.serve_http(pool, args.metrics_port)
+        except OSError as e:
+            print(f"Could not serve metrics on port {args.metrics_port}: {str(e)}", file=sys.stderr, flush=True)
+    print(f"Worker pool ready ({args.processes} processes x {args.threads} threads, {args.scheduling} "
+          f"scheduling, started in {(time.perf_counter() - start) * 1000:.0f}ms)", file=sys.stderr, flush=True)
+    pool.send(ready)
+
+    try:
+        while True:
+            try:
+                header, payload = read_message(input_stream)
+            except (ValueError, EOFError) as e:
+                print(f"Pool protocol error: {str(e)}", file=sys.stderr, flush=True)
+                return 1
+            if header is None:
+                return 0
+
+            if header.get('op') == 'shutdown':
+                pool.close()
+                pool.send({'id': header.get('id'), 'ok': True})
+                return 0
+
+            pool.handle(header, payload)
+    finally:
+        if pool.running:
+            pool.close()
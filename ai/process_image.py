@@ -1,96 +1,321 @@
-
-from ultralytics import YOLO
 import cv2
+import numpy as np
 import sys
 import os
+import time
 import yaml
-import base64
 
-def process_image(input_path, output_path):
+# Absolute paths to the model and data files live next to this script. The
+# model is run through a pluggable backend (PyTorch, ONNX Runtime or
+# OpenVINO), so torch is only imported when the pytorch backend is used.
+from backends import BACKEND_PYTORCH, DATA_YAML_PATH, DEFAULT_BACKEND, MODEL_PATH, load_backend
+from profiles import CONFIDENCE_THRESHOLD, get_profile
+from render import get_encoder, get_renderer
+from tiling import detect_tiled
+
+# JPEG quality used when encoding results in memory
+JPEG_QUALITY = 90
+
+# data.yaml classes that mark a defective (or missing) bolt
+DEFECT_CLASSES = ('Boulon_Mauvais', 'fp-bolt-missing')
+
+
+def load_class_labels(data_yaml_path=DATA_YAML_PATH):
+    """Return the class names listed in data.yaml, or an empty list."""
+    class_labels = []
+    if os.path.exists(data_yaml_path):
+        try:
+            with open(data_yaml_path, 'r') as f:
+                data_config = yaml.safe_load(f)
+                if 'names' in data_config:
+                    class_labels = data_config['names']
+                    print(f"Loaded {len(class_labels)} class labels: {class_labels}", flush=True)
+                else:
+                    print(f"Warning: 'names' key not found in {data_yaml_path}", flush=True)
+        except Exception as e:
+            print(f"Error loading class labels: {str(e)}", file=sys.stderr, flush=True)
+    return class_labels
+
+
+def load_model(model_path=MODEL_PATH, backend=None, int8=None, class_labels=None, threads=None):
+    """
+    Load the detector with the configured backend (see backends.py),
+    raising if the weights file is missing.
+    """
+    backend = backend or DEFAULT_BACKEND
+    print(f"Looking for model at: {model_path}", flush=True)
+    if not os.path.exists(model_path) and backend == BACKEND_PYTORCH:
+        print(f"Model not found at: {model_path}", file=sys.stderr, flush=True)
+        raise Exception(f"Model file not found at {model_path}")
+
+    if class_labels is None:
+        class_labels = load_class_labels()
+
+    print(f"Loading {backend} model from: {model_path}", flush=True)
+    return load_backend(backend, model_path, class_labels, int8, threads=threads)
+
+
+def decode_image(data, image_format='jpeg', width=None, height=None):
+    """
+    Decode an in-memory frame into a BGR image without touching the disk.
+
+    data can be any bytes-like object (bytes, bytearray, memoryview); it is
+    wrapped with np.frombuffer so no copy is made before decoding. With
+    image_format='bgr' the buffer is used as-is as a height x width x 3 image.
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if image_format == 'bgr':
+        if not width or not height:
+            raise Exception("Raw BGR frames need a width and height")
+        if buffer.size != width * height * 3:
+            raise Exception(f"Raw BGR frame has {buffer.size} bytes, expected {width * height * 3}")
+        return buffer.reshape((height, width, 3))
+    if image_format != 'jpeg':
+        raise Exception(f"Unsupported image format: {image_format}")
+
+    img = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if img is None:
+        raise Exception("Could not decode image data")
+    return img
+
+
+def encode_image(img, quality=JPEG_QUALITY):
+    """Encode a BGR image to JPEG bytes in memory (libjpeg-turbo when available)."""
+    return get_encoder().encode(img, quality)
+
+
+def detect(model, img, timings, tiled=False, profile=None):
+    """
+    Run the model on a decoded image and return its Detections. The
+    inference options come from profile (an InferenceProfile, default from
+    DETECTION_PROFILE). With tiled=True large images are run as overlapping
+    tiles (see tiling.py) so that small bolts keep enough pixels.
+    """
+    options = (profile or get_profile()).options(model.names)
+    start = time.perf_counter()
+    if tiled:
+        result = detect_tiled(model, img, options, timings=timings)
+    else:
+        result = model(img, verbose=False, **options)[0]
+    timings['inference_ms'] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def plot_result(result, timings, in_place=False):
+    """
+    Draw the detections of a result onto a copy of its image, or onto the
+    image itself with in_place=True. The copy is a buffer reused by the
+    next call from the same thread, so write or encode it before then.
+    """
+    start = time.perf_counter()
+    annotated_img = get_renderer(result.names).render(result, in_place)
+    timings['plot_ms'] = (time.perf_counter() - start) * 1000
+    return annotated_img
+
+
+def annotate_image(model, img, timings, tiled=False):
+    """Run detection on a decoded image and return the annotated copy."""
+    result = detect(model, img, timings, tiled)
+
+    # Get the annotated image
+    return plot_result(result, timings)
+
+
+def extract_detections(result, class_labels=None):
+    """
+    Convert a Detections result into a list of plain dicts:
+    {"class_id", "class_name", "confidence", "box": [x1, y1, x2, y2]},
+    with box coordinates in pixels of the original image.
+    Class names come from data.yaml when available, else from the model.
+    """
+    detections = []
+    for box, confidence, class_id in zip(result.boxes, result.confidences, result.class_ids):
+        class_id = int(class_id)
+        if class_labels and class_id < len(class_labels):
+            class_name = class_labels[class_id]
+        else:
+            class_name = result.names.get(class_id, str(class_id))
+        detections.append({
+            'class_id': class_id,
+            'class_name': class_name,
+            'confidence': round(float(confidence), 4),
+            'box': [round(float(v), 1) for v in box],
+        })
+    return detections
+
+
+def run_detection(model, input_path, output_path, timings=None, tiled=False):
+    """
+    Run detection on one image file with an already loaded model and write
+    the annotated result to output_path.
+
+    If a timings dict is given, it is filled with the duration in
+    milliseconds of each stage (decode, inference, plot, encode).
+    """
+    if timings is None:
+        timings = {}
+
+    # Verify input file exists
+    if not os.path.exists(input_path):
+        raise Exception(f"Input image does not exist: {input_path}")
+
+    # Load the image
+    start = time.perf_counter()
+    img = cv2.imread(input_path)
+    if img is None:
+        raise Exception(f"Could not load image from: {input_path}")
+    timings['decode_ms'] = (time.perf_counter() - start) * 1000
+
+    annotated_img = annotate_image(model, img, timings, tiled)
+
+    # Save the annotated image
+    start = time.perf_counter()
+    cv2.imwrite(output_path, annotated_img)
+    timings['encode_ms'] = (time.perf_counter() - start) * 1000
+
+    # Verify the output file was created
+    if not os.path.exists(output_path):
+        raise Exception(f"Failed to write output file to {output_path}")
+
+    return timings
+
+
+def process_image_bytes(model, data, image_format='jpeg', width=None, height=None,
+                        quality=JPEG_QUALITY, timings=None, tiled=False):
+    """
+    In-memory counterpart of run_detection: takes an encoded JPEG (or a raw
+    BGR buffer with its width and height) and returns the annotated result
+    as JPEG bytes, with no filesystem round trip.
+    """
+    if timings is None:
+        timings = {}
+
+    start = time.perf_counter()
+    img = decode_image(data, image_format, width, height)
+    timings['decode_ms'] = (time.perf_counter() - start) * 1000
+
+    annotated_img = annotate_image(model, img, timings, tiled)
+
+    start = time.perf_counter()
+    encoded = encode_image(annotated_img, quality)
+    timings['encode_ms'] = (time.perf_counter() - start) * 1000
+    return encoded
+
+
+def detect_image_bytes(model, data, class_labels=None, image_format='jpeg',
+                       width=None, height=None, timings=None, tiled=False):
+    """
+    Structured counterpart of process_image_bytes: returns the detections
+    instead of an annotated JPEG, skipping the plot and encode stages.
+    The result is {"detections": [...], "image_size": [width, height]}.
+    """
+    if timings is None:
+        timings = {}
+
+    start = time.perf_counter()
+    img = decode_image(data, image_format, width, height)
+    timings['decode_ms'] = (time.perf_counter() - start) * 1000
+
+    result = detect(model, img, timings, tiled)
+    return {
+        'detections': extract_detections(result, class_labels),
+        'image_size': [img.shape[1], img.shape[0]],
+    }
+
+
+def process_image(input_path, output_path, tiled=False):
     try:
         # Print current working directory for debugging
         print(f"Current working directory: {os.getcwd()}", flush=True)
-        
-        # Get the absolute path to the model and data files
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        model_path = os.path.join(script_dir, "best.pt")
-        data_yaml_path = os.path.join(script_dir, "data.yaml")
-        
-        print(f"Looking for model at: {model_path}", flush=True)
-        print(f"Looking for data.yaml at: {data_yaml_path}", flush=True)
-        
-        # Check if model exists
-        if not os.path.exists(model_path):
-            print(f"Model not found at: {model_path}", file=sys.stderr, flush=True)
-            raise Exception(f"Model file not found at {model_path}")
-        
+        print(f"Looking for data.yaml at: {DATA_YAML_PATH}", flush=True)
+
         # Load class labels from data.yaml
-        class_labels = []
-        if os.path.exists(data_yaml_path):
-            try:
-                with open(data_yaml_path, 'r') as f:
-                    data_config = yaml.safe_load(f)
-                    if 'names' in data_config:
-                        class_labels = data_config['names']
-                        print(f"Loaded {len(class_labels)} class labels: {class_labels}", flush=True)
-                    else:
-                        print(f"Warning: 'names' key not found in {data_yaml_path}", flush=True)
-            except Exception as e:
-                print(f"Error loading class labels: {str(e)}", file=sys.stderr, flush=True)
-        
+        class_labels = load_class_labels()
+
         # Verify input file exists
         print(f"Checking input image at: {input_path}", flush=True)
         if not os.path.exists(input_path):
             raise Exception(f"Input image does not exist: {input_path}")
-        
-        # Load the YOLO model with absolute path
-        print(f"Loading YOLO model from: {model_path}", flush=True)
-        model = YOLO(model_path)
-        
-        # Load the image
-        print(f"Loading image from: {input_path}", flush=True)
-        img = cv2.imread(input_path)
-        if img is None:
-            raise Exception(f"Could not load image from: {input_path}")
-        
-        # Set confidence threshold to match app.py
-        confidence_threshold = 0.5
-        
-        # Perform detection with confidence threshold
-        print(f"Running object detection with confidence threshold {confidence_threshold}...", flush=True)
-        results = model(img, conf=confidence_threshold)
-        
-        # Get the first result
-        result = results[0]
-        
-        # Get the annotated image
-        print("Generating annotated image...", flush=True)
-        annotated_img = result.plot()
-        
-        # Save the annotated image
-        print(f"Saving result to: {output_path}", flush=True)
-        cv2.imwrite(output_path, annotated_img)
-        
-        # Verify the output file was created
-        if not os.path.exists(output_path):
-            raise Exception(f"Failed to write output file to {output_path}")
-        
-        print("Image processing completed successfully", flush=True)
+
+        # Load the model with absolute path
+        model = load_model(class_labels=class_labels)
+
+        print(f"Running {'tiled ' if tiled else ''}object detection with confidence threshold "
+              f"{CONFIDENCE_THRESHOLD}...", flush=True)
+        timings = run_detection(model, input_path, output_path, tiled=tiled)
+        print(f"Saved result to: {output_path}", flush=True)
+
+        stages = ", ".join(f"{name}={value:.1f}ms" for name, value in timings.items())
+        print(f"Image processing completed successfully ({stages})", flush=True)
         return True
     except Exception as e:
         print(f"Error in process_image: {str(e)}", file=sys.stderr, flush=True)
         return False
 
 if __name__ == "__main__":
+    # Long-running mode: load the model once and serve requests on stdin/stdout
+    if len(sys.argv) >= 2 and sys.argv[1] == "--worker":
+        from worker import serve
+        sys.exit(serve(sys.argv[2:]))
+
+    # Several streams over a pool of worker processes, same protocol
+    if len(sys.argv) >= 2 and sys.argv[1] == "--pool":
+        from pool import serve
+        sys.exit(serve(sys.argv[2:]))
+
+    # Tiled inference for large images, in any of the modes below
+    tiled = len(sys.argv) >= 2 and sys.argv[1] == "--tiled"
+    if tiled:
+        del sys.argv[1]
+
     # This script accepts input and output paths as command-line arguments
     if len(sys.argv) != 3:
         print("Usage: python process_image.py <input_image_path> <output_image_path>", file=sys.stderr)
+        print("       python process_image.py - -   (JPEG on stdin, annotated JPEG on stdout)", file=sys.stderr)
+        print("       python process_image.py --json <input_image_path>", file=sys.stderr)
+        print("       python process_image.py --worker [--batch-size N] [--batch-window-ms MS]", file=sys.stderr)
+        print("       python process_image.py --pool [--processes N] [--scheduling round_robin|weighted]",
+              file=sys.stderr)
+        print("       add --tiled before the arguments to detect small bolts on large images", file=sys.stderr)
         sys.exit(1)
-    
+
+    # JSON mode: print structured detections instead of writing an image
+    if sys.argv[1] == "--json":
+        import json
+        from worker import redirect_stdout
+        json_out = redirect_stdout()
+        try:
+            with open(sys.argv[2], 'rb') as f:
+                data = f.read()
+            labels = load_class_labels()
+            model = load_model(class_labels=labels)
+            timings = {}
+            output = detect_image_bytes(model, data, labels, timings=timings, tiled=tiled)
+            output['timings'] = timings
+            json_out.write(json.dumps(output).encode('utf-8') + b'\n')
+            json_out.flush()
+        except Exception as e:
+            print(f"Error in process_image: {str(e)}", file=sys.stderr, flush=True)
+            sys.exit(1)
+        sys.exit(0)
+
     input_path = sys.argv[1]
     output_path = sys.argv[2]
-    
+
+    # Pipe mode: keep stdout for the image and send logs to stderr
+    if input_path == "-" and output_path == "-":
+        from worker import redirect_stdout
+        image_out = redirect_stdout()
+        try:
+            model = load_model()
+            image_out.write(process_image_bytes(model, sys.stdin.buffer.read(), tiled=tiled))
+            image_out.flush()
+        except Exception as e:
+            print(f"Error in process_image: {str(e)}", file=sys.stderr, flush=True)
+            sys.exit(1)
+        sys.exit(0)
+
     print(f"Processing image: {input_path} -> {output_path}", flush=True)
-    
-    success = process_image(input_path, output_path)
-    sys.exit(0 if success else 1)
\ No newline at end of file
+
+    success = process_image(input_path, output_path, tiled)
+    sys.exit(0 if success else 1)
@@ -0,0 +1,174 @@
+"""
+Inference profiles and the adaptive input-size controller.
+
+A profile is the set of options a forward pass runs with: input size
+(imgsz), confidence threshold, IoU threshold of the NMS, class filter and
+maximum number of detections. A few named profiles are predefined; the
+default one is picked with DETECTION_PROFILE (or --profile on the worker)
+and every request can name another profile and override single fields:
+
+    {"op": "process", "profile": "fast", "conf": 0.4, "classes": ["fp-bolt-missing"]}
+
+Classes can be given by id or by data.yaml name.
+
+ImageSizeController keeps a real-time stream within a latency budget: when
+the recent latency (90th percentile over a window of frames) exceeds the
+budget the input size is stepped down, and when it stays well below the
+budget it is stepped back up, never above the profile's own size. Since
+the engine only batches requests with identical options, frames at
+different sizes are never mixed in one forward pass.
+"""
+
+import os
+import threading
+from collections import deque
+
+import numpy as np
+
+from backends import DEFAULT_IMGSZ, DEFAULT_IOU, DEFAULT_MAX_DET
+
+# Confidence threshold to match app.py
+CONFIDENCE_THRESHOLD = 0.5
+
+# Input sizes the controller steps through (multiples of the 32 px stride)
+ADAPTIVE_SIZES = (640, 576, 512, 448, 384, 320)
+
+# Default latency budget (capture to end of inference) for adaptive streams
+DEFAULT_LATENCY_BUDGET_MS = 200
+
+# Frames observed before the controller reconsiders the size
+DEFAULT_WINDOW = 20
+
+# Step back up when the recent latency is below this fraction of the budget
+DEFAULT_HEADROOM = 0.6
+
+STRIDE = 32
+MIN_IMGSZ = 160
+MAX_IMGSZ = 1920
+
+
+class InferenceProfile:
+    """Options of a forward pass: imgsz, conf, iou, classes and max_det."""
+
+    FIELDS = ('imgsz', 'conf', 'iou', 'classes', 'max_det')
+
+    def __init__(self, name='custom', imgsz=DEFAULT_IMGSZ, conf=CONFIDENCE_THRESHOLD, iou=DEFAULT_IOU,
+                 classes=None, max_det=DEFAULT_MAX_DET):
+        self.name = name
+        imgsz = int(imgsz)
+        # Round up to the model stride
+        self.imgsz = min(MAX_IMGSZ, max(MIN_IMGSZ, -(-imgsz // STRIDE) * STRIDE))
+        self.conf = float(conf)
+        self.iou = float(iou)
+        if not 0 <= self.conf <= 1 or not 0 <= self.iou <= 1:
+            raise Exception(f"conf and iou must be between 0 and 1, got {self.conf} and {self.iou}")
+        if isinstance(classes, (str, int)):
+            classes = [classes]
+        self.classes = tuple(classes) if classes else None
+        self.max_det = max(1, int(max_det))
+
+    def with_overrides(self, **overrides):
+        """A copy of the profile with some fields replaced."""
+        fields = {field: getattr(self, field) for field in self.FIELDS}
+        fields.update((key, value) for key, value in overrides.items() if value is not None)
+        return InferenceProfile(self.name, **fields)
+
+    def options(self, names=None):
+        """
+        Keyword arguments for a backend call. Class names are resolved to
+        ids with names, the {id: name} mapping of the model.
+        """
+        classes = None
+        if self.classes is not None:
+            ids = {name: class_id for class_id, name in (names or {}).items()}
+            classes = []
+            for value in self.classes:
+                if isinstance(value, str) and not value.isdigit():
+                    if value not in ids:
+                        raise Exception(f"Unknown class name: {value}")
+                    classes.append(ids[value])
+                else:
+                    classes.append(int(value))
+            classes = tuple(sorted(set(classes)))
+        return {'imgsz': self.imgsz, 'conf': self.conf, 'iou': self.iou,
+                'classes': classes, 'max_det': self.max_det}
+
+    def to_dict(self):
+        return dict({'name': self.name}, **{field: getattr(self, field) for field in self.FIELDS})
+
+
+PROFILES = {
+    'default': InferenceProfile('default'),
+    # Lower resolution for real-time camera frames on slow machines
+    'fast': InferenceProfile('fast', imgsz=416),
+    'realtime': InferenceProfile('realtime', imgsz=320, max_det=100),
+    # Higher resolution and a lower threshold for uploads and offline checks
+    'accurate': InferenceProfile('accurate', imgsz=832, conf=0.35),
+    # Only report faulty or missing bolts
+    'defects': InferenceProfile('defects', conf=0.35, classes=('Boulon_Mauvais', 'fp-bolt-missing')),
+}
+
+DEFAULT_PROFILE = os.environ.get('DETECTION_PROFILE', 'default')
+
+
+def get_profile(name=None):
+    """A predefined profile by name (default: DETECTION_PROFILE)."""
+    name = name or DEFAULT_PROFILE
+    if name not in PROFILES:
+        raise Exception(f"Unknown inference profile '{name}', expected one of {', '.join(PROFILES)}")
+    return PROFILES[name]
+
+
+def profile_from_request(header, default=None):
+    """The profile a request asks for: a named profile plus field overrides."""
+    base = get_profile(header['profile']) if header.get('profile') else (default or get_profile())
+    overrides = {field: header[field] for field in InferenceProfile.FIELDS if field in header}
+    return base.with_overrides(**overrides) if overrides else base
+
+
+class ImageSizeController:
+    """
+    Steps the input size of a stream down when its recent latency exceeds
+    the budget, and back up when there is headroom.
+    """
+
+    def __init__(self, budget_ms=DEFAULT_LATENCY_BUDGET_MS, max_imgsz=DEFAULT_IMGSZ, sizes=ADAPTIVE_SIZES,
+                 window=DEFAULT_WINDOW, headroom=DEFAULT_HEADROOM):
+        self.budget_ms = budget_ms
+        self.sizes = sorted({size for size in sizes if size < max_imgsz} | {max_imgsz}, reverse=True)
+        self.headroom = headroom
+        self._index = 0
+        self._samples = deque(maxlen=max(1, window))
+        self._lock = threading.Lock()
+        self.counters = {'steps_down': 0, 'steps_up': 0}
+
+    @property
+    def imgsz(self):
+        return self.sizes[self._index]
+
+    def observe(self, latency_ms, imgsz):
+        """
+        Record the latency of a frame run at imgsz. Frames still in flight
+        when the size changed are ignored. Returns the size to use next.
+        """
+        with self._lock:
+            if imgsz != self.sizes[self._index]:
+                return self.sizes[self._index]
+            self._samples.append(latency_ms)
+            if len(self._samples) < self._samples.maxlen:
+                return self.sizes[self._index]
+
+            recent = float(np.percentile(self._samples, 90))
+            if recent > self.budget_ms and self._index < len(self.sizes) - 1:
+                self._index += 1
+                self.counters['steps_down'] += 1
+                self._samples.clear()
+            elif recent < self.headroom * self.budget_ms and self._index > 0:
+                self._index -= 1
+                self.counters['steps_up'] += 1
+                self._samples.clear()
+            return self.sizes[self._index]
+
+    def get_counters(self):
+        with self._lock:
+            return dict(self.counters, imgsz=self.sizes[self._index], budget_ms=self.budget_ms)
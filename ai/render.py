@@ -0,0 +1,218 @@
+"""
+Fast drawing and JPEG encoding of detection results.
+
+result.plot() goes through the generic ultralytics plotting code and
+allocates a new full-size image on every call. Renderer only knows about
+our few classes: colours and label sizes are computed once, and boxes are
+drawn onto an output buffer that is reused from one frame to the next (or
+straight onto the frame itself with in_place=True, when the caller no
+longer needs the clean image).
+
+JpegEncoder encodes to memory with libjpeg-turbo through PyTurboJPEG when
+it is installed (pip install PyTurboJPEG, plus the libturbojpeg library),
+and falls back to cv2.imencode otherwise; both use 4:2:0 chroma
+subsampling and no Huffman optimisation pass.
+
+Compare with the old path on a sample image:
+    python render.py --benchmark [--image PATH] [--backend stub] [--iterations 200]
+"""
+
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from backends import class_color
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+FONT_SCALE = 0.5
+FONT_THICKNESS = 1
+BOX_THICKNESS = 2
+TEXT_COLOR = (255, 255, 255)
+
+DEFAULT_QUALITY = 90
+
+
+class Renderer:
+    """
+    Draws boxes and "name confidence" labels. The returned image is the
+    renderer's own buffer and is overwritten by the next call; encode or
+    copy it first. Use one renderer per thread.
+    """
+
+    def __init__(self, names):
+        self.names = dict(names or {})
+        self._colors = {}
+        self._label_sizes = {}
+        self._buffer = None
+
+    def color(self, class_id):
+        color = self._colors.get(class_id)
+        if color is None:
+            color = self._colors[class_id] = class_color(class_id)
+        return color
+
+    def _label_size(self, label):
+        size = self._label_sizes.get(label)
+        if size is None:
+            (text_w, text_h), baseline = cv2.getTextSize(label, FONT, FONT_SCALE, FONT_THICKNESS)
+            size = self._label_sizes[label] = (text_w, text_h, baseline)
+        return size
+
+    def render(self, result, in_place=False):
+        """Draw a Detections result onto a copy of its image (or onto the image itself)."""
+        img = result.orig_img
+        if in_place:
+            canvas = img
+        else:
+            if self._buffer is None or self._buffer.shape != img.shape:
+                self._buffer = np.empty_like(img)
+            canvas = self._buffer
+            np.copyto(canvas, img)
+
+        height = canvas.shape[0]
+        boxes = np.rint(result.boxes).astype(np.int32)
+        for (x1, y1, x2, y2), confidence, class_id in zip(boxes.tolist(), result.confidences.tolist(),
+                                                         result.class_ids.tolist()):
+            color = self.color(class_id)
+            cv2.rectangle(canvas, (x1, y1), (x2, y2), color, BOX_THICKNESS)
+
+            label = f"{self.names.get(class_id, class_id)} {confidence:.2f}"
+            text_w, text_h, baseline = self._label_size(label)
+            label_h = text_h + baseline + 2
+            # Above the box, or inside it when there is no room above
+            top = y1 - label_h if y1 - label_h >= 0 else min(y1, height - label_h)
+            cv2.rectangle(canvas, (x1, top), (x1 + text_w + 4, top + label_h), color, -1)
+            cv2.putText(canvas, label, (x1 + 2, top + text_h + 1), FONT, FONT_SCALE, TEXT_COLOR,
+                        FONT_THICKNESS, cv2.LINE_AA)
+        return canvas
+
+
+def _load_turbojpeg():
+    try:
+        from turbojpeg import TJFLAG_FASTDCT, TJSAMP_420, TurboJPEG
+        return TurboJPEG(), TJSAMP_420, TJFLAG_FASTDCT
+    except Exception:
+        # Module or the libturbojpeg shared library missing
+        return None
+
+
+class JpegEncoder:
+    """In-memory JPEG encoder, with libjpeg-turbo when available."""
+
+    def __init__(self, use_turbo=True):
+        self._turbo = _load_turbojpeg() if use_turbo else None
+        self.name = 'turbojpeg' if self._turbo else 'opencv'
+
+    def encode(self, img, quality=DEFAULT_QUALITY):
+        if self._turbo:
+            turbo, subsample, flags = self._turbo
+            return turbo.encode(img, quality=int(quality), jpeg_subsample=subsample, flags=flags)
+        ok, encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, int(quality),
+                                                 cv2.IMWRITE_JPEG_OPTIMIZE, 0,
+                                                 cv2.IMWRITE_JPEG_SAMPLING_FACTOR,
+                                                 cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420])
+        if not ok:
+            raise Exception("Failed to encode result image")
+        return encoded.tobytes()
+
+
+_encoder = None
+_local = threading.local()
+
+
+def get_encoder():
+    """The process-wide JpegEncoder (TurboJPEG handles are thread-safe)."""
+    global _encoder
+    if _encoder is None:
+        _encoder = JpegEncoder()
+    return _encoder
+
+
+def get_renderer(names):
+    """This thread's Renderer for the given class names."""
+    renderer = getattr(_local, 'renderer', None)
+    if renderer is None or renderer.names != names:
+        renderer = _local.renderer = Renderer(names)
+    return renderer
+
+
+def warm_up():
+    """
+    Draw once on a small image: OpenCV sets up text drawing on the first
+    call in each thread, which would otherwise add tens of milliseconds to
+    the first frame annotated by that thread.
+    """
+    canvas = np.zeros((32, 32, 3), dtype=np.uint8)
+    cv2.rectangle(canvas, (1, 1), (30, 30), TEXT_COLOR, BOX_THICKNESS)
+    cv2.putText(canvas, "0", (2, 20), FONT, FONT_SCALE, TEXT_COLOR, FONT_THICKNESS, cv2.LINE_AA)
+    get_encoder().encode(canvas)
+
+
+# --- Micro-benchmark ---
+
+def _time(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {'mean_ms': round(sum(samples) / len(samples), 3),
+            'p50_ms': round(samples[len(samples) // 2], 3),
+            'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3)}
+
+
+def benchmark(image_path=None, backend='stub', iterations=200, quality=DEFAULT_QUALITY):
+    """Time result.plot() + cv2.imencode against Renderer + JpegEncoder."""
+    from benchmark import RESOLUTIONS, synthetic_frame
+    from process_image import detect, load_class_labels, load_model
+
+    if image_path:
+        img = cv2.imread(image_path)
+        if img is None:
+            raise Exception(f"Could not load image from: {image_path}")
+    else:
+        img = synthetic_frame(*RESOLUTIONS['SVGA'])
+    model = load_model(backend=backend, class_labels=load_class_labels())
+    result = detect(model, img, {})
+    renderer = Renderer(model.names)
+    encoder = JpegEncoder()
+    opencv = JpegEncoder(use_turbo=False)
+
+    def old_path():
+        ok, encoded = cv2.imencode('.jpg', result.plot(), [cv2.IMWRITE_JPEG_QUALITY, quality])
+        return encoded.tobytes()
+
+    return {
+        'image_size': [img.shape[1], img.shape[0]],
+        'detections': len(result),
+        'backend': model.name,
+        'encoder': encoder.name,
+        'plot_imencode': _time(old_path, iterations),
+        'render': _time(lambda: renderer.render(result), iterations),
+        'render_opencv_encode': _time(lambda: opencv.encode(renderer.render(result), quality), iterations),
+        'render_encode': _time(lambda: encoder.encode(renderer.render(result), quality), iterations),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Compare the renderer with result.plot().")
+    parser.add_argument("--benchmark", action="store_true", required=True)
+    parser.add_argument("--image", help="sample image (default: a synthetic SVGA frame)")
+    parser.add_argument("--backend", default='stub', help="backend producing the detections")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--quality", type=int, default=DEFAULT_QUALITY)
+    args = parser.parse_args()
+
+    from worker import redirect_stdout
+    out = redirect_stdout()
+    results = benchmark(args.image, args.backend, max(1, args.iterations), args.quality)
+    out.write(json.dumps(results, indent=2).encode() + b'\n')
+    out.flush()
+    sys.exit(0)
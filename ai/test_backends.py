@@ -0,0 +1,30 @@
+import numpy as np
+
+from backends import Detections, postprocess
+from tiling import merge_tiles
+
+
+def test_postprocess_drops_boxes_clipped_to_zero_area():
+    # A 640x320 image letterboxed into 640x640 is padded by 160 px above and below
+    img = np.zeros((320, 640, 3), np.uint8)
+    output = np.zeros((1, 5, 3), np.float32)
+    output[0, :, 0] = [320, 320, 100, 100, 0.9] # Inside the image
+    output[0, :, 1] = [100, 80, 60, 40, 0.8]    # Entirely in the top padding
+    output[0, :, 2] = [50, 50, 20, 300, 0.7]    # Partly inside
+    result, = postprocess(output, [(1.0, (0, 160))], [img], {0: 'bolt'})
+    assert len(result.boxes) == 2
+    assert (result.boxes[:, 2] > result.boxes[:, 0]).all()
+    assert (result.boxes[:, 3] > result.boxes[:, 1]).all()
+
+
+def test_merge_tiles_drops_boxes_clipped_to_zero_area():
+    img = np.zeros((100, 200, 3), np.uint8)
+    grid = [(0, 0, 100, 100), (100, 0, 200, 100)]
+    names = {0: 'bolt'}
+    left = Detections(np.array([[10, 10, 30, 30]], np.float32), np.array([0.9], np.float32),
+                      np.array([0]), img, names)
+    # Past the right border of the image once shifted into place
+    right = Detections(np.array([[100, 40, 120, 60]], np.float32), np.array([0.8], np.float32),
+                       np.array([0]), img, names)
+    merged = merge_tiles([left, right], grid, img, names)
+    assert merged.boxes.tolist() == [[10, 10, 30, 30]]
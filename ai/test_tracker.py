@@ -0,0 +1,47 @@
+from tracker import DetectionScheduler, Tracker
+
+
+def detection(box, class_id=0, confidence=0.9):
+    return {'class_id': class_id, 'class_name': str(class_id), 'confidence': confidence, 'box': box}
+
+
+def test_tracks_keep_their_id_and_are_counted_once():
+    tracker = Tracker(min_hits=2)
+    for x in range(0, 50, 10):
+        tracks = tracker.update([detection([x, 0, x + 40, 40])])
+    assert [track['track_id'] for track in tracks] == [1]
+    assert tracker.counts(['bolt']) == {'bolt': 1}
+    # Predicted along the velocity learnt from the moving box
+    predicted, = tracker.predict()
+    assert predicted['predicted'] and predicted['box'][0] > tracks[0]['box'][0]
+
+
+def test_scheduler_detects_every_n_frames_while_detections_are_pending():
+    scheduler = DetectionScheduler(detect_every=3)
+    assert [scheduler.schedule() for _ in range(7)] == [
+        (0, True), (1, False), (2, False), (3, True), (4, False), (5, False), (6, True)]
+
+
+def test_scheduler_feeds_the_tracker_in_frame_order():
+    scheduler = DetectionScheduler(detect_every=3, tracker=Tracker(min_hits=1))
+    for _ in range(4):
+        scheduler.schedule()
+    # Predicted frames wait for the detection before them
+    assert scheduler.complete(1, context='frame 1') == []
+    assert scheduler.complete(2, context='frame 2') == []
+    # Frame 3's detection comes back before frame 0's
+    assert scheduler.complete(3, [detection([10, 0, 50, 40])], 'frame 3') == []
+    ready = scheduler.complete(0, [detection([0, 0, 40, 40])], 'frame 0')
+    assert [context for context, _, _ in ready] == ['frame 0', 'frame 1', 'frame 2', 'frame 3']
+    # One bolt, matched across all four frames
+    assert {track['track_id'] for _, tracks, _ in ready for track in tracks} == {1}
+    assert ready[-1][2] == {'0': 1}
+
+
+def test_scheduler_detects_again_after_a_lost_detection():
+    scheduler = DetectionScheduler(detect_every=3)
+    scheduler.schedule()
+    assert scheduler.schedule() == (1, False)
+    assert scheduler.cancel(0) == []
+    assert [context for context, _, _ in scheduler.complete(1, context='frame 1')] == ['frame 1']
+    assert scheduler.schedule() == (2, True)
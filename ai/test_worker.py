@@ -0,0 +1,59 @@
+import io
+
+import cv2
+import numpy as np
+
+from worker import read_message, serve, write_message
+
+
+def run_worker(*requests, args=()):
+    """
+    Serve framed (header, payload) requests with the stub model; returns the
+    responses by id, in the order they were sent.
+    """
+    input_stream, output_stream = io.BytesIO(), io.BytesIO()
+    for header, payload in requests:
+        write_message(input_stream, header, payload)
+    input_stream.seek(0)
+    assert serve(['--backend', 'stub', *args], input_stream, output_stream) == 0
+    output_stream.seek(0)
+    responses = {}
+    while True:
+        header, payload = read_message(output_stream)
+        if header is None:
+            return responses
+        if 'id' in header:
+            responses[header['id']] = (header, payload)
+
+
+def test_annotated_output_of_raw_bgr_frame():
+    frame = np.full((120, 160, 3), 90, np.uint8)
+    data = frame.tobytes()
+    header, payload = run_worker(({'id': 1, 'op': 'process', 'format': 'bgr',
+                                   'width': 160, 'height': 120}, data))[1]
+    assert header['ok'], header.get('error')
+    annotated = cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR)
+    assert annotated.shape == (120, 160, 3)
+    # The stub's boxes were drawn on a copy, not on the request's buffer
+    assert not np.array_equal(annotated, frame)
+    assert data == frame.tobytes()
+
+
+def test_tracked_stream_under_backlog():
+    # The batch window outlasts the requests: every frame is scheduled while the detections are pending
+    frame = np.full((120, 160, 3), 90, np.uint8).tobytes()
+    requests = [({'id': i, 'op': 'process', 'format': 'bgr', 'width': 160, 'height': 120,
+                  'output': 'detections', 'track': True, 'stream': 'cam'}, frame) for i in range(12)]
+    responses = run_worker(*requests, args=['--detect-every', '3', '--batch-size', '16',
+                                            '--batch-window-ms', '1000'])
+    assert list(responses) == list(range(12))
+    assert all(header['ok'] for header, _ in responses.values())
+    pattern = ''.join('T' if header['timings'].get('tracked') else 'D' for header, _ in responses.values())
+    assert pattern == 'DTTDTTDTTDTT'
+    # Once confirmed by the second detection, the same tracks are carried through every frame
+    first = [d['track_id'] for d in responses[0][0]['detections']]
+    assert first
+    for i in range(3, 12):
+        detections = responses[i][0]['detections']
+        assert [d['track_id'] for d in detections] == first
+        assert all(d['predicted'] == (i % 3 != 0) for d in detections)
@@ -0,0 +1,184 @@
+"""
+Tiled inference for large images with small bolts.
+
+Running the model on a whole upload downscales it to the model input size
+(640 px), and bolts only a few dozen pixels wide shrink below what the
+detector can see. In tiled mode the image is split into overlapping tiles
+of about the model input size, the tiles (plus one downscaled pass over
+the whole image, for objects larger than a tile) are run as one batch, and
+the boxes are shifted back into full-image coordinates and merged with
+class-aware NMS.
+
+A box touching a tile edge that lies inside the image is a bolt cut in
+half by the tile; it is dropped, since the overlap between tiles makes the
+whole bolt visible in a neighbouring tile. The overlap therefore has to be
+larger than a bolt.
+
+The number of tiles is capped by max_tiles: on very large images the tiles
+are made bigger (and downscaled by the model) rather than more numerous, so
+latency stays bounded.
+"""
+
+import math
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from backends import Detections, class_aware_nms, nonempty_boxes
+
+DEFAULT_TILE_SIZE = int(os.environ.get('DETECTION_TILE_SIZE', '640'))
+DEFAULT_TILE_OVERLAP = float(os.environ.get('DETECTION_TILE_OVERLAP', '0.2'))
+DEFAULT_MAX_TILES = int(os.environ.get('DETECTION_MAX_TILES', '12'))
+
+# IoU above which boxes found by different tiles are the same bolt
+MERGE_IOU = 0.5
+
+# Boxes this close (in pixels) to an inner tile edge count as cut by it
+EDGE_MARGIN = 2
+
+# Growth of the tile size when the grid has more than max_tiles tiles
+TILE_GROWTH = 1.25
+
+
+def _tile_starts(length, tile_size, overlap):
+    """Start offsets along one axis, spread so the last tile ends at the edge."""
+    if length <= tile_size:
+        return [0]
+    stride = max(1, int(tile_size * (1 - overlap)))
+    count = math.ceil((length - tile_size) / stride) + 1
+    return [round(i * (length - tile_size) / (count - 1)) for i in range(count)]
+
+
+def tile_grid(width, height, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_TILE_OVERLAP,
+              max_tiles=DEFAULT_MAX_TILES):
+    """
+    Split a width x height image into overlapping [x1, y1, x2, y2] tiles.
+    Returns a single tile covering the image when no tiling is needed.
+    """
+    tile_size = max(1, int(tile_size))
+    overlap = min(max(0.0, overlap), 0.9)
+    max_tiles = max(1, int(max_tiles))
+    while True:
+        xs = _tile_starts(width, tile_size, overlap)
+        ys = _tile_starts(height, tile_size, overlap)
+        if len(xs) * len(ys) <= max_tiles:
+            break
+        tile_size = int(math.ceil(tile_size * TILE_GROWTH))
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height)) for y in ys for x in xs]
+
+
+def crop_tiles(img, grid):
+    """Views of the image for each tile (no copy)."""
+    return [img[y1:y2, x1:x2] for x1, y1, x2, y2 in grid]
+
+
+def _inner_edge_mask(boxes, tile, width, height):
+    """Boxes cut by an edge of the tile that is not an image border."""
+    x1, y1, x2, y2 = tile
+    cut = np.zeros(len(boxes), dtype=bool)
+    if x1 > 0:
+        cut |= boxes[:, 0] <= EDGE_MARGIN
+    if y1 > 0:
+        cut |= boxes[:, 1] <= EDGE_MARGIN
+    if x2 < width:
+        cut |= boxes[:, 2] >= (x2 - x1) - EDGE_MARGIN
+    if y2 < height:
+        cut |= boxes[:, 3] >= (y2 - y1) - EDGE_MARGIN
+    return cut
+
+
+def merge_tiles(results, grid, img, names, iou=MERGE_IOU, full_result=None):
+    """
+    Merge the Detections of each tile (and optionally of a whole-image
+    pass) into one Detections in full-image coordinates.
+    """
+    height, width = img.shape[:2]
+    boxes, confidences, class_ids = [], [], []
+    for result, tile in zip(results, grid):
+        keep = ~_inner_edge_mask(result.boxes, tile, width, height)
+        boxes.append(result.boxes[keep] + np.array([tile[0], tile[1], tile[0], tile[1]], dtype=np.float32))
+        confidences.append(result.confidences[keep])
+        class_ids.append(result.class_ids[keep])
+    if full_result is not None:
+        boxes.append(full_result.boxes)
+        confidences.append(full_result.confidences)
+        class_ids.append(full_result.class_ids)
+
+    boxes = np.concatenate(boxes) if boxes else np.zeros((0, 4), dtype=np.float32)
+    confidences = np.concatenate(confidences) if confidences else np.zeros(0, dtype=np.float32)
+    class_ids = np.concatenate(class_ids) if class_ids else np.zeros(0, dtype=np.int64)
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+    valid = nonempty_boxes(boxes)
+    boxes, confidences, class_ids = boxes[valid], confidences[valid], class_ids[valid]
+    keep = class_aware_nms(boxes, confidences, class_ids, iou)
+    return Detections(boxes[keep], confidences[keep], class_ids[keep], img, names)
+
+
+def detect_tiled(model, img, options, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_TILE_OVERLAP,
+                 max_tiles=DEFAULT_MAX_TILES, include_full=True, timings=None):
+    """
+    Run the model over the tiles of an image in one batched call with the
+    given inference options and return the merged Detections. Falls back to
+    a plain call when the image fits in one tile.
+    """
+    if timings is None:
+        timings = {}
+    grid = tile_grid(img.shape[1], img.shape[0], tile_size, overlap, max_tiles)
+    if len(grid) == 1:
+        return model([img], verbose=False, **options)[0]
+
+    images = crop_tiles(img, grid) + ([img] if include_full else [])
+    results = model(images, verbose=False, **options)
+    start = time.perf_counter()
+    merged = merge_tiles(results[:len(grid)], grid, img, model.names,
+                         full_result=results[len(grid)] if include_full else None)
+    timings['merge_ms'] = (time.perf_counter() - start) * 1000
+    timings['tiles'] = len(grid)
+    return merged
+
+
+def submit_tiled(engine, img, names, tile_size=DEFAULT_TILE_SIZE, overlap=DEFAULT_TILE_OVERLAP,
+                 max_tiles=DEFAULT_MAX_TILES, include_full=True, **submit_kwargs):
+    """
+    Submit the tiles of an image to an engine.InferenceEngine, so they are
+    batched with each other (and with other requests) by the engine, and
+    return a Future resolving to (merged Detections, timings) like
+    InferenceEngine.submit does.
+    """
+    grid = tile_grid(img.shape[1], img.shape[0], tile_size, overlap, max_tiles)
+    if len(grid) == 1:
+        return engine.submit(img, **submit_kwargs)
+
+    images = crop_tiles(img, grid) + ([img] if include_full else [])
+    futures = [engine.submit(image, **submit_kwargs) for image in images]
+    merged = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def on_tile_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        try:
+            outputs = [future.result() for future in futures]
+            results = [result for result, _ in outputs]
+            start = time.perf_counter()
+            detections = merge_tiles(results[:len(grid)], grid, img, names,
+                                     full_result=results[len(grid)] if include_full else None)
+            # Timings of the last tile to finish, covering the whole image
+            timings = dict(max((tile_timings for _, tile_timings in outputs),
+                               key=lambda t: t['age_ms']))
+            timings['merge_ms'] = (time.perf_counter() - start) * 1000
+            timings['tiles'] = len(grid)
+            merged.set_result((detections, timings))
+        except Exception as e:
+            merged.set_exception(e)
+
+    for future in futures:
+        future.add_done_callback(on_tile_done)
+    return merged
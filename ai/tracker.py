@@ -0,0 +1,274 @@
+"""
+Lightweight multi-object tracker so YOLO only has to run every Nth frame.
+
+Tracks follow the SORT idea with a simplified motion model: each track keeps
+its last box and a constant-velocity estimate (smoothed with an
+alpha-beta filter instead of a full Kalman filter). On a detection frame,
+detections are matched to the predicted track boxes by IoU (greedy,
+highest IoU first, same class only); on the frames in between the tracks
+are just propagated along their velocity.
+
+DetectionScheduler decides when the detector has to run: every
+detect_every frames, or earlier when tracking becomes uncertain (a track
+was just lost, is not confirmed yet, or its box has been predicted for too
+long without a confirming detection).
+
+Track ids are stable across frames, so each bolt is counted once per class
+(see Tracker.counts) instead of once per frame. Boxes are kept as
+[x1, y1, x2, y2] in pixels and classes use the data.yaml class ids.
+"""
+
+import itertools
+
+DEFAULT_IOU_THRESHOLD = 0.3
+DEFAULT_MAX_AGE = 5
+DEFAULT_MIN_HITS = 2
+DEFAULT_DETECT_EVERY = 3
+
+# Gains of the alpha-beta filter: how much a detection corrects the
+# position and the velocity estimates
+POSITION_GAIN = 0.7
+VELOCITY_GAIN = 0.3
+
+
+def iou(a, b):
+    """Intersection over union of two [x1, y1, x2, y2] boxes."""
+    inter_w = min(a[2], b[2]) - max(a[0], b[0])
+    inter_h = min(a[3], b[3]) - max(a[1], b[1])
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    inter = inter_w * inter_h
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+class Track:
+    """One tracked bolt."""
+
+    def __init__(self, track_id, box, class_id, class_name, confidence):
+        self.track_id = track_id
+        self.box = list(box)
+        self.velocity = [0.0, 0.0, 0.0, 0.0]
+        self.class_id = class_id
+        self.class_name = class_name
+        self.confidence = confidence
+        self.hits = 1
+        # Frames since the track was last confirmed by a detection
+        self.misses = 0
+
+    def predict(self):
+        """Move the box one frame along its velocity."""
+        self.box = [v + dv for v, dv in zip(self.box, self.velocity)]
+
+    def correct(self, box, confidence):
+        """Blend a matched detection into the predicted box and velocity."""
+        for i in range(4):
+            residual = box[i] - self.box[i]
+            self.box[i] += POSITION_GAIN * residual
+            self.velocity[i] += VELOCITY_GAIN * residual / (self.misses + 1)
+        self.confidence = confidence
+        self.hits += 1
+        self.misses = 0
+
+    def to_dict(self):
+        return {
+            'track_id': self.track_id,
+            'class_id': self.class_id,
+            'class_name': self.class_name,
+            'confidence': round(self.confidence, 4),
+            'box': [round(v, 1) for v in self.box],
+            'predicted': self.misses > 0,
+        }
+
+
+class Tracker:
+    """
+    IoU tracker over the detection dicts produced by
+    process_image.extract_detections.
+    """
+
+    def __init__(self, iou_threshold=DEFAULT_IOU_THRESHOLD, max_age=DEFAULT_MAX_AGE,
+                 min_hits=DEFAULT_MIN_HITS):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.tracks = []
+        self._ids = itertools.count(1)
+        # Track ids already counted, per class id
+        self._counted = {}
+        self.lost_since_detection = 0
+
+    def predict(self):
+        """
+        Propagate every track by one frame without a detection and return
+        the current tracks. Tracks not confirmed for more than max_age
+        frames are dropped.
+        """
+        for track in self.tracks:
+            track.predict()
+            track.misses += 1
+        self.lost_since_detection += self._prune()
+        return self.active_tracks()
+
+    def update(self, detections):
+        """Advance one frame and correct the tracks with new detections."""
+        for track in self.tracks:
+            track.predict()
+
+        candidates = []
+        for t, track in enumerate(self.tracks):
+            for d, detection in enumerate(detections):
+                if detection['class_id'] != track.class_id:
+                    continue
+                overlap = iou(track.box, detection['box'])
+                if overlap >= self.iou_threshold:
+                    candidates.append((overlap, t, d))
+        candidates.sort(reverse=True)
+
+        matched_tracks = set()
+        matched_detections = set()
+        for overlap, t, d in candidates:
+            if t in matched_tracks or d in matched_detections:
+                continue
+            matched_tracks.add(t)
+            matched_detections.add(d)
+            self.tracks[t].correct(detections[d]['box'], detections[d]['confidence'])
+
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.misses += 1
+
+        for d, detection in enumerate(detections):
+            if d not in matched_detections:
+                self.tracks.append(Track(next(self._ids), detection['box'], detection['class_id'],
+                                         detection['class_name'], detection['confidence']))
+
+        self.lost_since_detection = self._prune()
+        for track in self.tracks:
+            if track.hits >= self.min_hits:
+                self._counted.setdefault(track.class_id, set()).add(track.track_id)
+        return self.active_tracks()
+
+    def _prune(self):
+        before = len(self.tracks)
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_age]
+        return before - len(self.tracks)
+
+    def active_tracks(self):
+        """
+        Tracks confirmed by at least min_hits detections, plus new tracks on
+        the frame they were detected in, as dicts.
+        """
+        return [track.to_dict() for track in self.tracks
+                if track.hits >= self.min_hits or track.misses == 0]
+
+    def counts(self, class_labels=None):
+        """Number of distinct confirmed tracks seen so far, per class."""
+        counts = {}
+        for class_id, track_ids in self._counted.items():
+            if class_labels and class_id < len(class_labels):
+                key = class_labels[class_id]
+            else:
+                key = str(class_id)
+            counts[key] = len(track_ids)
+        return counts
+
+
+class DetectionScheduler:
+    """
+    Decides whether a frame needs the detector or can be served by the
+    tracker alone, and feeds the tracker accordingly.
+
+    Frames are scheduled as they arrive, but a detection comes back later
+    (and possibly after the frames that followed it), so each frame gets a
+    sequence number from schedule() and complete() feeds the tracker in
+    frame order, holding a frame back until the ones before it are done.
+    While a detection is in flight the following frames are predicted; the
+    next one is only scheduled detect_every frames later.
+    """
+
+    def __init__(self, tracker=None, detect_every=DEFAULT_DETECT_EVERY, max_predicted=None,
+                 class_labels=None):
+        self.tracker = tracker or Tracker()
+        self.detect_every = max(1, int(detect_every))
+        # Run the detector early once any track has gone this many frames
+        # without a confirming detection
+        self.max_predicted = max_predicted if max_predicted is not None else self.detect_every
+        self.class_labels = class_labels
+        # Frames scheduled since the last frame scheduled for the detector
+        self.frames_since_detection = None
+        self.detections_in_flight = 0
+        self._next_seq = 0
+        self._next_to_apply = 0
+        self._detecting = set()
+        # Frame -> (detections, context, cancelled) waiting for the frames before it
+        self._done = {}
+
+    def needs_detection(self):
+        if self.frames_since_detection is None:
+            return True
+        if self.frames_since_detection + 1 >= self.detect_every:
+            return True
+        if self.tracker.lost_since_detection:
+            return True
+        # New tracks are confirmed by the detector before being propagated
+        return any(track.misses >= self.max_predicted or track.hits < self.tracker.min_hits
+                   for track in self.tracker.tracks)
+
+    def schedule(self):
+        """Reserve the next frame: returns (its sequence number, whether it needs the detector)."""
+        seq = self._next_seq
+        self._next_seq += 1
+        if self.detections_in_flight:
+            # The tracks do not reflect the pending detection yet, only the frame count is known
+            detect = self.frames_since_detection is None or self.frames_since_detection + 1 >= self.detect_every
+        else:
+            detect = self.needs_detection()
+        if detect:
+            self.frames_since_detection = 0
+            self.detections_in_flight += 1
+            self._detecting.add(seq)
+        else:
+            self.frames_since_detection += 1
+        return seq, detect
+
+    def complete(self, seq, detections=None, context=None):
+        """
+        Hand in the detections of a scheduled frame (ignored for a frame
+        scheduled without the detector) and feed the tracker every frame now
+        ready in order. Returns (context, tracks, counts) for each of them.
+        """
+        self._done[seq] = (detections, context, False)
+        return self._apply_ready()
+
+    def cancel(self, seq):
+        """Give up on a scheduled frame; returns the frames it was holding back, as complete()."""
+        self._done[seq] = (None, None, True)
+        return self._apply_ready()
+
+    def _apply_ready(self):
+        ready = []
+        while self._next_to_apply in self._done:
+            seq = self._next_to_apply
+            self._next_to_apply += 1
+            detections, context, cancelled = self._done.pop(seq)
+            detected = seq in self._detecting
+            if detected:
+                self._detecting.discard(seq)
+                self.detections_in_flight -= 1
+            if cancelled:
+                if detected and not self.detections_in_flight:
+                    # The detection was lost: run the detector on the next frame
+                    self.frames_since_detection = None
+                continue
+            tracks = self.on_detections(detections) if detected else self.on_skipped_frame()
+            ready.append((context, tracks, self.tracker.counts(self.class_labels)))
+        return ready
+
+    def on_detections(self, detections):
+        """Feed a detector result; returns the tracked boxes for this frame."""
+        return self.tracker.update(detections)
+
+    def on_skipped_frame(self):
+        """Propagate the tracks for a frame the detector did not see."""
+        return self.tracker.predict()
@@ -0,0 +1,541 @@
+"""
+Long-running detection worker for process_image.py.
+
+Started with `python process_image.py --worker [--backend NAME] [--int8]
+[--batch-size N] [--batch-window-ms MS]`. The model and class labels
+are loaded once, then requests are served over stdin/stdout until stdin is
+closed or a "shutdown" request is received.
+
+Framing (both directions): one line of JSON (the header) terminated by a
+newline, followed by exactly header["size"] bytes of binary payload. The
+size field may be omitted when there is no payload.
+
+Requests:
+    {"id": 1, "op": "process", "size": 48213}   + JPEG bytes
+    {"id": 2, "op": "process", "format": "bgr", "width": 640, "height": 480,
+     "size": 921600}                             + raw BGR bytes
+    {"id": 3, "op": "process", "output": "detections", "size": 48213}
+                                                 + JPEG bytes
+    {"id": 4, "op": "process", "input_path": "...", "output_path": "..."}
+    {"id": 5, "op": "ping"}
+    {"id": 6, "op": "stats"}
+    {"id": 7, "op": "shutdown"}
+
+In-memory requests get the annotated JPEG back as the response payload, so
+frames never touch the filesystem. Requests with input_path/output_path
+read and write files as the command-line mode does. With
+"output": "detections" no image is drawn or encoded; the response header
+carries the boxes instead:
+    {"id": 3, "ok": true, "image_size": [640, 480], "timings": {...},
+     "detections": [{"class_id": 1, "class_name": "Boulon_Mauvais",
+                     "confidence": 0.87, "box": [x1, y1, x2, y2]}]}
+
+Responses echo the request id:
+    {"id": 1, "ok": true, "timings": {"decode_ms": ..., "total_ms": ...}, "size": 51022}
+    {"id": 1, "ok": false, "error": "..."}
+
+A {"type": "ready", ...} message is sent once the model is loaded.
+
+Images are run through engine.InferenceEngine, which batches requests that
+arrive within --batch-window-ms of each other (up to --batch-size) into one
+forward pass. Responses can come back out of order; match them by id. The
+timings of each response include queue_ms and batch_size.
+
+Real-time frames should be sent with "policy": "latest", a "stream" name
+and the "capture_ts" (milliseconds since the epoch) of the frame. A frame
+still waiting when a newer one arrives on the same stream is answered with
+{"ok": false, "dropped": true}. Processed frames echo capture_ts, report
+their age_ms in timings and are flagged "stale" when inference finished
+more than --stale-ms after capture. The "stats" op returns the submitted,
+processed, dropped and stale counters.
+
+Frames sent with "gate": true go through a per-stream motion_gate.MotionGate
+first: when the frame barely differs from the last inferred one (or matches
+a recently inferred frame) and is requested with the same inference
+options, the previous detections are reused without running the model and
+the response timings carry "gated": "motion" or "cache".
+
+Detection-output frames sent with "track": true are run through a
+per-stream tracker.DetectionScheduler: the model only sees every
+--detect-every frame (or earlier when tracks become uncertain) and boxes
+are propagated by the tracker in between. Tracked responses carry a
+track_id per box, "predicted" for boxes not confirmed on this frame, and
+"counts" of distinct bolts seen per class; frames served by the tracker
+alone have timings.tracked set. While a detection is in flight the next
+frames are served by the tracker, and the responses of a tracked stream
+are sent in frame order.
+
+Requests sent with "tiled": true are split into overlapping tiles (see
+tiling.py, sized by --tile-size, --tile-overlap and --max-tiles) that go
+through the engine as separate images, so they are batched together; the
+merged boxes come back as one response with timings.tiles set. Tiled
+requests are always served FIFO.
+
+Inference options come from profiles.py: the worker default is set with
+--profile, and a request can pick another "profile" and override
+"imgsz", "conf", "iou", "classes" and "max_det". Requests sent with
+"adaptive": true get their input size from a per-stream
+profiles.ImageSizeController, which steps it down when the recent latency
+of the stream exceeds "budget_ms" (default --latency-budget-ms) and back
+up when there is headroom; timings.imgsz reports the size used.
+
+The "metrics" op returns the worker's metrics.Metrics: per-stage latency
+histograms, batch sizes, request outcomes, queue depth, frame counters,
+memory use and the loaded model, as JSON in the response header (or, with
+"format": "prometheus", as Prometheus text in the payload). --metrics-port
+also serves them over HTTP. When the worker runs with --allow-profiling,
+the "profile" op samples every thread for "seconds" and returns collapsed
+stacks for a flame graph as the payload. Both the metrics and the "stats"
+op report the request outcomes, throughput (fps) and latency of every
+stream.
+
+To serve several streams with more than one worker process, run the pool
+in front of the workers instead (python process_image.py --pool, see
+pool.py); it speaks the same protocol.
+
+Everything else the process prints (our own logs, ultralytics output) is
+redirected to stderr so that stdout only carries protocol messages.
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import cv2
+
+from backends import BACKENDS, DEFAULT_BACKEND, DEFAULT_INT8
+import metrics
+import render
+from profiles import (DEFAULT_LATENCY_BUDGET_MS, DEFAULT_PROFILE, PROFILES, ImageSizeController,
+                      get_profile, profile_from_request)
+from tiling import DEFAULT_MAX_TILES, DEFAULT_TILE_OVERLAP, DEFAULT_TILE_SIZE, submit_tiled
+from tracker import DEFAULT_DETECT_EVERY, DetectionScheduler
+from motion_gate import DEFAULT_CACHE_SIZE, DEFAULT_CHANGE_THRESHOLD, MotionGate, options_key
+from engine import (DEFAULT_BATCH_WINDOW_MS, DEFAULT_MAX_BATCH_SIZE, DEFAULT_STALE_AFTER_MS,
+                    POLICY_FIFO, FrameDropped, InferenceEngine)
+from process_image import (JPEG_QUALITY, decode_image, encode_image, extract_detections,
+                           load_class_labels, load_model, plot_result)
+
+# Threads used to extract boxes or plot and encode results after inference
+FINISHER_THREADS = 2
+
+
+def read_message(stream):
+    """Read one framed message. Returns (None, None) at end of stream."""
+    line = stream.readline()
+    if not line:
+        return None, None
+    header = json.loads(line)
+    size = int(header.get('size', 0))
+    payload = stream.read(size) if size else b''
+    if len(payload) != size:
+        raise EOFError(f"Expected {size} payload bytes, got {len(payload)}")
+    return header, payload
+
+
+def write_message(stream, header, payload=b''):
+    """Write one framed message and flush it."""
+    header = dict(header, size=len(payload))
+    stream.write(json.dumps(header).encode('utf-8') + b'\n')
+    if payload:
+        stream.write(payload)
+    stream.flush()
+
+
+def redirect_stdout():
+    """
+    Keep a private handle on the real stdout for the protocol and point
+    file descriptor 1 at stderr, so stray prints cannot corrupt the framing.
+    """
+    sys.stdout.flush()
+    protocol_out = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    return protocol_out
+
+
+class Worker:
+    """
+    Reads requests, decodes them and hands the images to the micro-batching
+    InferenceEngine. Responses are finished (boxes extracted, or image
+    plotted and encoded) on a small thread pool and may therefore be sent in
+    a different order than the requests arrived; callers match them by id.
+    """
+
+    def __init__(self, model, class_labels, output_stream,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE, batch_window_ms=DEFAULT_BATCH_WINDOW_MS,
+                 stale_after_ms=DEFAULT_STALE_AFTER_MS, motion_threshold=DEFAULT_CHANGE_THRESHOLD,
+                 gate_cache_size=DEFAULT_CACHE_SIZE, detect_every=DEFAULT_DETECT_EVERY,
+                 tile_size=DEFAULT_TILE_SIZE, tile_overlap=DEFAULT_TILE_OVERLAP, max_tiles=DEFAULT_MAX_TILES,
+                 profile=None, latency_budget_ms=DEFAULT_LATENCY_BUDGET_MS, allow_profiling=False):
+        self.model = model
+        self.class_labels = class_labels
+        self.output_stream = output_stream
+        self.engine = InferenceEngine(model, max_batch_size, batch_window_ms, stale_after_ms)
+        self.motion_threshold = motion_threshold
+        self.gate_cache_size = gate_cache_size
+        self.gates = {}
+        self.detect_every = detect_every
+        self.schedulers = {}
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.max_tiles = max_tiles
+        self.profile = profile or get_profile()
+        self.latency_budget_ms = latency_budget_ms
+        self.controllers = {}
+        self.allow_profiling = allow_profiling
+        self.metrics = metrics.Metrics({
+            'backend': model.name,
+            'int8': bool(getattr(model, 'int8', False)),
+            'artifact': os.path.basename(str(model.artifact_path)),
+            'profile': self.profile.name,
+            'pid': os.getpid(),
+        })
+        self.metrics.sources['engine'] = lambda: {'queue_depth': self.engine.queue_depth(),
+                                                  'counters': self.engine.get_counters()}
+        self.metrics.sources['streams'] = self.stream_stats
+        self._finisher = ThreadPoolExecutor(max_workers=FINISHER_THREADS, thread_name_prefix="finisher",
+                                            initializer=render.warm_up)
+        # Start every finisher thread now so the first responses do not pay for the warm-up
+        barrier = threading.Barrier(FINISHER_THREADS)
+        for _ in range(FINISHER_THREADS):
+            self._finisher.submit(barrier.wait)
+        self._write_lock = threading.Lock()
+
+    def send(self, header, payload=b''):
+        with self._write_lock:
+            write_message(self.output_stream, header, payload)
+
+    def close(self):
+        """Serve everything still in flight, then stop the engine and pool."""
+        self.engine.stop()
+        self._finisher.shutdown(wait=True)
+
+    def gate_for(self, stream):
+        """Motion gate of a stream, created on first use."""
+        gate = self.gates.get(stream)
+        if gate is None:
+            gate = self.gates[stream] = MotionGate(self.motion_threshold, cache_size=self.gate_cache_size)
+        return gate
+
+    def scheduler_for(self, stream):
+        """Tracker and detection scheduler of a stream, created on first use."""
+        entry = self.schedulers.get(stream)
+        if entry is None:
+            entry = self.schedulers[stream] = (DetectionScheduler(detect_every=self.detect_every,
+                                                                  class_labels=self.class_labels),
+                                               threading.Lock())
+        return entry
+
+    def controller_for(self, stream, max_imgsz, budget_ms=None):
+        """Input size controller of an adaptive stream, created on first use."""
+        controller = self.controllers.get(stream)
+        if controller is None:
+            controller = self.controllers[stream] = ImageSizeController(
+                budget_ms or self.latency_budget_ms, max_imgsz)
+        return controller
+
+    def _send_tracked(self, stream, seq, detections=None, context=None):
+        """
+        Hand a scheduled frame to its stream's tracker (context=None when its
+        request failed) and send the response of every frame this completes,
+        in frame order. context is (response, received_at, outcome).
+        """
+        scheduler, lock = self.scheduler_for(stream)
+        with lock:
+            ready = scheduler.cancel(seq) if context is None else scheduler.complete(seq, detections, context)
+            for (response, received_at, outcome), tracks, counts in ready:
+                response['detections'] = tracks
+                response['counts'] = counts
+                timings = response['timings']
+                timings['total_ms'] = (time.perf_counter() - received_at) * 1000
+                timings['age_ms'] = time.time() * 1000 - response['capture_ts']
+                self.metrics.observe(timings, outcome, stream)
+                self.send(response)
+
+    def stream_stats(self):
+        """Motion gate and input size controller counters, per stream (added to the metrics' streams)."""
+        streams = {}
+        for stream, gate in list(self.gates.items()):
+            streams.setdefault(stream, {})['gate'] = gate.get_counters()
+        for stream, controller in list(self.controllers.items()):
+            streams.setdefault(stream, {})['adaptive'] = controller.get_counters()
+        return streams
+
+    def get_counters(self):
+        counters = self.engine.get_counters()
+        for stream, gate in list(self.gates.items()):
+            counters[f'gate_{stream}'] = gate.get_counters()
+        for stream, controller in list(self.controllers.items()):
+            counters[f'adaptive_{stream}'] = controller.get_counters()
+        counters['streams'] = self.metrics.to_dict()['streams']
+        return counters
+
+    def _fail(self, request_id, received_at, error, stream=None):
+        print(f"Error in request {request_id}: {str(error)}", file=sys.stderr, flush=True)
+        total_ms = (time.perf_counter() - received_at) * 1000
+        self.metrics.count('error', stream)
+        self.send({'id': request_id, 'ok': False, 'error': str(error), 'timings': {'total_ms': total_ms}})
+
+    def _send_profile(self, request_id, seconds, interval_ms):
+        try:
+            collapsed = metrics.profile_for(seconds, interval_ms)
+        except Exception as e:
+            self._fail(request_id, time.perf_counter(), e)
+            return
+        self.send({'id': request_id, 'ok': True, 'format': 'collapsed'}, collapsed.encode('utf-8'))
+
+    def handle(self, header, payload):
+        """Start one request. The response is sent once inference completes."""
+        request_id = header.get('id')
+        received_at = time.perf_counter()
+        op = header.get('op', 'process')
+
+        if op == 'ping':
+            self.send({'id': request_id, 'ok': True})
+            return
+        if op == 'stats':
+            self.send({'id': request_id, 'ok': True, 'counters': self.get_counters()})
+            return
+        if op == 'metrics':
+            if header.get('format') == 'prometheus':
+                self.send({'id': request_id, 'ok': True}, self.metrics.render_prometheus().encode('utf-8'))
+            else:
+                self.send({'id': request_id, 'ok': True, 'metrics': self.metrics.to_dict()})
+            return
+        if op == 'profile':
+            if not self.allow_profiling:
+                self._fail(request_id, received_at, Exception("Profiling is disabled (start with --allow-profiling)"))
+                return
+            # Sample in the background so requests keep being served meanwhile
+            threading.Thread(target=self._send_profile, name="profile", daemon=True,
+                             args=(request_id, float(header.get('seconds', 10)),
+                                   float(header.get('interval_ms', metrics.DEFAULT_SAMPLE_INTERVAL_MS)))).start()
+            return
+        if op != 'process':
+            self._fail(request_id, received_at, Exception(f"Unknown op: {op}"))
+            return
+
+        stream = header.get('stream', 'default')
+        timings = {}
+        track_seq = detect = None
+        try:
+            start = time.perf_counter()
+            if 'input_path' in header:
+                if not os.path.exists(header['input_path']):
+                    raise Exception(f"Input image does not exist: {header['input_path']}")
+                img = cv2.imread(header['input_path'])
+                if img is None:
+                    raise Exception(f"Could not load image from: {header['input_path']}")
+            else:
+                img = decode_image(payload,
+                                   image_format=header.get('format', 'jpeg'),
+                                   width=header.get('width'),
+                                   height=header.get('height'))
+            timings['decode_ms'] = (time.perf_counter() - start) * 1000
+
+            profile = profile_from_request(header, self.profile)
+            controller = None
+            if header.get('adaptive'):
+                controller = self.controller_for(stream, profile.imgsz, header.get('budget_ms'))
+                profile = profile.with_overrides(imgsz=controller.imgsz)
+            options = profile.options(self.model.names)
+            timings['imgsz'] = options['imgsz']
+
+            if header.get('track') and header.get('output') == 'detections':
+                scheduler, lock = self.scheduler_for(stream)
+                with lock:
+                    track_seq, detect = scheduler.schedule()
+
+            fp = reused = future = None
+            if detect is not False:
+                if header.get('gate'):
+                    start = time.perf_counter()
+                    fp, reused, reason = self.gate_for(stream).check(img, options_key(options, header.get('tiled')))
+                    timings['gate_ms'] = (time.perf_counter() - start) * 1000
+
+                if reused is not None:
+                    # Unchanged frame: answer with the previous detections
+                    capture_ts = header.get('capture_ts') or time.time() * 1000
+                    future = Future()
+                    future.set_result((reused, {'gated': reason, 'capture_ts': capture_ts,
+                                                'age_ms': time.time() * 1000 - capture_ts, 'stale': False}))
+                elif header.get('tiled'):
+                    future = submit_tiled(self.engine, img, self.model.names, self.tile_size,
+                                          self.tile_overlap, self.max_tiles, options=options,
+                                          capture_ts=header.get('capture_ts'))
+                else:
+                    future = self.engine.submit(img, options,
+                                                policy=header.get('policy', POLICY_FIFO),
+                                                stream=stream,
+                                                capture_ts=header.get('capture_ts'))
+        except Exception as e:
+            if track_seq is not None:
+                self._send_tracked(stream, track_seq)
+            self._fail(request_id, received_at, e, stream)
+            return
+
+        if future is None:
+            # Between detector runs: the tracker propagates the boxes, once the
+            # frames before this one (maybe a pending detection) are in
+            timings['tracked'] = True
+            response = {'id': request_id, 'ok': True, 'timings': timings,
+                        'capture_ts': header.get('capture_ts') or time.time() * 1000,
+                        'stale': False, 'image_size': [img.shape[1], img.shape[0]]}
+            self._send_tracked(stream, track_seq, context=(response, received_at, 'tracked'))
+            return
+
+        def on_inferred(done):
+            if reused is None and done.exception() is None:
+                result, engine_timings = done.result()
+                if fp is not None:
+                    self.gate_for(stream).store(fp, result)
+                if controller is not None:
+                    controller.observe(engine_timings['age_ms'], options['imgsz'])
+            self._finisher.submit(self._finish, header, img, timings, received_at, done, track_seq)
+
+        future.add_done_callback(on_inferred)
+
+    def _finish(self, header, img, timings, received_at, future, track_seq=None):
+        request_id = header.get('id')
+        stream = header.get('stream', 'default')
+        try:
+            result, engine_timings = future.result()
+            timings.update(engine_timings)
+            capture_ts = timings.pop('capture_ts')
+
+            response = {'id': request_id, 'ok': True, 'timings': timings,
+                        'capture_ts': capture_ts, 'stale': timings.pop('stale')}
+            payload = b''
+            if header.get('output') == 'detections':
+                response['detections'] = extract_detections(result, self.class_labels)
+                response['image_size'] = [img.shape[1], img.shape[0]]
+            else:
+                # The decoded frame is not needed afterwards, so draw on it directly,
+                # unless it is a read-only view of the payload (raw BGR requests)
+                annotated_img = plot_result(result, timings, in_place=result.orig_img.flags.writeable)
+                start = time.perf_counter()
+                if 'output_path' in header:
+                    cv2.imwrite(header['output_path'], annotated_img)
+                    if not os.path.exists(header['output_path']):
+                        raise Exception(f"Failed to write output file to {header['output_path']}")
+                else:
+                    payload = encode_image(annotated_img, header.get('quality', JPEG_QUALITY))
+                timings['encode_ms'] = (time.perf_counter() - start) * 1000
+        except FrameDropped as e:
+            if track_seq is not None:
+                self._send_tracked(stream, track_seq)
+            self.metrics.count('dropped', stream)
+            self.send({'id': request_id, 'ok': False, 'dropped': True, 'error': str(e)})
+            return
+        except Exception as e:
+            if track_seq is not None:
+                self._send_tracked(stream, track_seq)
+            self._fail(request_id, received_at, e, stream)
+            return
+
+        outcome = 'gated' if 'gated' in timings else 'ok'
+        if track_seq is not None:
+            # Sent once the tracker has seen the frames before this one
+            self._send_tracked(stream, track_seq, response['detections'], (response, received_at, outcome))
+            return
+        timings['total_ms'] = (time.perf_counter() - received_at) * 1000
+        timings['age_ms'] = time.time() * 1000 - capture_ts
+        self.metrics.observe(timings, outcome, stream)
+        self.send(response, payload)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="process_image.py --worker",
+                                     description="Serve detection requests over stdin/stdout.")
+    parser.add_argument("--backend", choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help="inference backend (default from DETECTION_BACKEND)")
+    parser.add_argument("--int8", action="store_true", default=DEFAULT_INT8,
+                        help="use the INT8-quantized model (onnx/openvino)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="inference threads (default: the runtime's own choice)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_MAX_BATCH_SIZE,
+                        help="maximum number of images per forward pass")
+    parser.add_argument("--batch-window-ms", type=float, default=DEFAULT_BATCH_WINDOW_MS,
+                        help="how long to wait for more requests before running a batch")
+    parser.add_argument("--stale-ms", type=float, default=DEFAULT_STALE_AFTER_MS,
+                        help="count results older than this (capture to inference end) as stale")
+    parser.add_argument("--motion-threshold", type=float, default=DEFAULT_CHANGE_THRESHOLD,
+                        help="mean pixel change (0-255) below which gated frames reuse the last detections")
+    parser.add_argument("--gate-cache-size", type=int, default=DEFAULT_CACHE_SIZE,
+                        help="number of recent frame hashes kept per stream by the motion gate")
+    parser.add_argument("--detect-every", type=int, default=DEFAULT_DETECT_EVERY,
+                        help="run the model every N frames on tracked streams")
+    parser.add_argument("--tile-size", type=int, default=DEFAULT_TILE_SIZE,
+                        help="tile size in pixels for tiled requests")
+    parser.add_argument("--tile-overlap", type=float, default=DEFAULT_TILE_OVERLAP,
+                        help="overlap between neighbouring tiles, as a fraction of the tile size")
+    parser.add_argument("--max-tiles", type=int, default=DEFAULT_MAX_TILES,
+                        help="maximum number of tiles per image (tiles grow beyond it)")
+    parser.add_argument("--profile", choices=PROFILES, default=DEFAULT_PROFILE,
+                        help="default inference profile (default from DETECTION_PROFILE)")
+    parser.add_argument("--latency-budget-ms", type=float, default=DEFAULT_LATENCY_BUDGET_MS,
+                        help="latency target of adaptive streams, from capture to end of inference")
+    parser.add_argument("--metrics-port", type=int, default=int(os.environ.get('DETECTION_METRICS_PORT', '0')),
+                        help="serve /metrics and /metrics.json on this local port (0: off)")
+    parser.add_argument("--allow-profiling", action="store_true",
+                        default=os.environ.get('DETECTION_PROFILING', '0') == '1',
+                        help="enable the sampling profiler (profile op and /profile)")
+    return parser.parse_args(argv)
+
+
+def serve(argv=(), input_stream=None, output_stream=None):
+    """Serve requests until stdin closes. Returns a process exit code."""
+    args = parse_args(list(argv))
+    if output_stream is None:
+        output_stream = redirect_stdout()
+    if input_stream is None:
+        input_stream = sys.stdin.buffer
+
+    try:
+        start = time.perf_counter()
+        class_labels = load_class_labels()
+        model = load_model(backend=args.backend, int8=args.int8, class_labels=class_labels,
+                           threads=args.threads or None)
+        load_ms = (time.perf_counter() - start) * 1000
+    except Exception as e:
+        print(f"Error loading model: {str(e)}", file=sys.stderr, flush=True)
+        write_message(output_stream, {'type': 'error', 'error': str(e)})
+        return 1
+
+    worker = Worker(model, class_labels, output_stream, args.batch_size, args.batch_window_ms,
+                    args.stale_ms, args.motion_threshold, args.gate_cache_size,
+                    args.detect_every, args.tile_size, args.tile_overlap, args.max_tiles,
+                    get_profile(args.profile), args.latency_budget_ms, args.allow_profiling)
+    worker.metrics.set_gauge('model_load_seconds', round(load_ms / 1000, 3))
+    if args.metrics_port:
+        try:
+            metrics.serve_http(worker.metrics, args.metrics_port, allow_profiling=args.allow_profiling)
+        except OSError as e:
+            print(f"Could not serve metrics on port {args.metrics_port}: {str(e)}", file=sys.stderr, flush=True)
+    print(f"Worker ready ({model.name} model loaded in {load_ms:.0f}ms, batch size {args.batch_size}, "
+          f"window {args.batch_window_ms}ms)", file=sys.stderr, flush=True)
+    worker.send({'type': 'ready', 'labels': class_labels, 'load_ms': load_ms,
+                 'backend': model.name, 'int8': model.int8, 'profile': worker.profile.to_dict()})
+
+    try:
+        while True:
+            try:
+                header, payload = read_message(input_stream)
+            except (ValueError, EOFError) as e:
+                print(f"Worker protocol error: {str(e)}", file=sys.stderr, flush=True)
+                return 1
+            if header is None:
+                return 0
+
+            if header.get('op') == 'shutdown':
+                worker.close()
+                worker.send({'id': header.get('id'), 'ok': True})
+                return 0
+
+            worker.handle(header, payload)
+    finally:
+        worker.close()
@@ -0,0 +1,339 @@
+/**
+ * Detection worker module that keeps a single long-running
+ * `ai/process_image.py --worker` process alive, so the YOLO model is loaded
+ * once instead of on every frame. With DETECTION_WORKERS set to a number
+ * above 1 (or 'auto', one per CPU) it starts `ai/process_image.py --pool`
+ * instead, which schedules the streams of several cameras fairly over that
+ * many worker processes (see ai/pool.py).
+ *
+ * Messages in both directions are one line of JSON followed by `size` bytes
+ * of binary payload (see ai/worker.py for the protocol).
+ */
+
+const { spawn, execSync } = require('child_process');
+const path = require('path');
+const EventEmitter = require('events');
+
+class DetectionWorker extends EventEmitter {
+  constructor() {
+    super();
+    // Configuration
+    this.scriptPath = path.resolve(path.join(__dirname, '../ai/process_image.py'));
+    this.restartDelay = 2000;
+    // Micro-batching: up to batchSize images arriving within batchWindowMs
+    // of each other run as one forward pass in the worker
+    this.batchSize = parseInt(process.env.DETECTION_BATCH_SIZE || '4', 10);
+    this.batchWindowMs = parseFloat(process.env.DETECTION_BATCH_WINDOW_MS || '10');
+    // Tracked streams run the model on every detectEvery-th frame
+    this.detectEvery = parseInt(process.env.DETECTION_DETECT_EVERY || '3', 10);
+    // Worker processes: '1' for a single worker, a number or 'auto' for a pool
+    this.workers = process.env.DETECTION_WORKERS || '1';
+    // Turns between the streams of a pool: 'weighted' by stream priority, or 'round_robin'
+    this.scheduling = process.env.DETECTION_SCHEDULING || 'weighted';
+
+    // State variables
+    this.process = null;
+    this.ready = false;
+    this.running = false;
+    this.nextId = 1;
+    this.pending = new Map();
+    // Unparsed stdout, kept as received and joined only once a whole header or payload is in
+    this.chunks = [];
+    this.bufferedBytes = 0;
+    this.currentHeader = null;
+  }
+
+  // Determine which Python command to use based on OS
+  resolvePythonCommand() {
+    let pythonCommand = 'python';
+    if (process.platform === 'win32') {
+      try {
+        execSync('py --version');
+        pythonCommand = 'py';
+      } catch (error) {
+        console.log('Falling back to python command');
+      }
+    } else if (process.platform === 'darwin' || process.platform === 'linux') {
+      try {
+        execSync('python3 --version');
+        pythonCommand = 'python3';
+      } catch (error) {
+        console.log('Falling back to python command');
+      }
+    }
+    return pythonCommand;
+  }
+
+  // Start the worker process if it is not already running
+  start() {
+    if (this.process) return;
+
+    if (!this.pythonCommand) {
+      this.pythonCommand = this.resolvePythonCommand();
+    }
+
+    this.running = true;
+    this.ready = false;
+    this.chunks = [];
+    this.bufferedBytes = 0;
+    this.currentHeader = null;
+
+    const pool = this.workers === 'auto' || parseInt(this.workers, 10) > 1;
+    const args = [this.scriptPath];
+    if (pool) {
+      args.push('--pool',
+        '--processes', this.workers === 'auto' ? '0' : String(parseInt(this.workers, 10)),
+        '--scheduling', this.scheduling);
+    } else {
+      args.push('--worker');
+    }
+    args.push(
+      '--batch-size', String(this.batchSize),
+      '--batch-window-ms', String(this.batchWindowMs),
+      '--detect-every', String(this.detectEvery)
+    );
+    console.log(`Starting detection worker: ${this.pythonCommand} ${args.join(' ')}`);
+    const worker = spawn(this.pythonCommand, args);
+    this.process = worker;
+
+    worker.stdout.on('data', (chunk) => this.handleData(chunk));
+
+    worker.stderr.on('data', (data) => {
+      console.error('Detection worker:', data.toString().trimEnd());
+    });
+
+    worker.on('error', (err) => {
+      console.error(`Detection worker error: ${err}`);
+    });
+
+    worker.stdin.on('error', (err) => {
+      console.error(`Detection worker stdin error: ${err}`);
+    });
+
+    worker.on('close', (code) => {
+      console.log(`Detection worker exited with code ${code}`);
+      if (this.process !== worker) return;
+      this.process = null;
+      this.ready = false;
+      this.emit('exit', code);
+
+      // Fail every request still waiting on this process
+      this.pending.forEach(({ reject }) => reject(new Error('Detection worker exited')));
+      this.pending.clear();
+
+      if (this.running) {
+        setTimeout(() => this.start(), this.restartDelay);
+      }
+    });
+  }
+
+  // Stop the worker process. It answers the requests already sent before
+  // exiting; the close handler rejects the rest and clears this.process
+  stop() {
+    this.running = false;
+    if (this.process) {
+      this.process.stdin.end();
+    }
+  }
+
+  // Parse framed messages out of the worker's stdout
+  handleData(chunk) {
+    this.chunks.push(chunk);
+    this.bufferedBytes += chunk.length;
+    // The chunks before this one were already searched for a header's newline
+    let unsearched = this.chunks.length - 1;
+
+    while (true) {
+      if (!this.currentHeader) {
+        if (!this.chunks.slice(unsearched).some((c) => c.includes(0x0A))) return;
+
+        const buffer = this.joinChunks();
+        const newline = buffer.indexOf(0x0A);
+        const line = buffer.toString('utf8', 0, newline);
+        this.keepChunks(buffer.subarray(newline + 1));
+        unsearched = 0;
+        try {
+          this.currentHeader = JSON.parse(line);
+        } catch (err) {
+          console.error(`Invalid message from detection worker: ${line}`);
+          continue;
+        }
+      }
+
+      const size = this.currentHeader.size || 0;
+      if (this.bufferedBytes < size) return;
+
+      const header = this.currentHeader;
+      const buffer = this.joinChunks();
+      const payload = size > 0 ? Buffer.from(buffer.subarray(0, size)) : null;
+      this.keepChunks(buffer.subarray(size));
+      unsearched = 0;
+      this.currentHeader = null;
+      this.handleMessage(header, payload);
+    }
+  }
+
+  // Join the buffered chunks into one buffer
+  joinChunks() {
+    return this.chunks.length === 1 ? this.chunks[0] : Buffer.concat(this.chunks, this.bufferedBytes);
+  }
+
+  // Replace the buffered chunks with what is left of them after a message
+  keepChunks(rest) {
+    this.chunks = rest.length > 0 ? [rest] : [];
+    this.bufferedBytes = rest.length;
+  }
+
+  handleMessage(header, payload) {
+    if (header.type === 'ready') {
+      const processes = header.processes ? `, ${header.processes} processes` : '';
+      console.log(`Detection worker ready (model loaded in ${Math.round(header.load_ms)}ms${processes})`);
+      this.ready = true;
+      this.emit('ready', header);
+      return;
+    }
+
+    if (header.type === 'error') {
+      console.error(`Detection worker failed to start: ${header.error}`);
+      return;
+    }
+
+    const request = this.pending.get(header.id);
+    if (!request) return;
+    this.pending.delete(header.id);
+
+    if (header.ok) {
+      request.resolve({ header, payload });
+    } else {
+      const error = new Error(header.error || 'Detection failed');
+      // Frames replaced by a newer one under the "latest" policy
+      error.dropped = Boolean(header.dropped);
+      request.reject(error);
+    }
+  }
+
+  // Send a request to the worker and resolve with its response
+  request(header, payload) {
+    this.start();
+
+    return new Promise((resolve, reject) => {
+      const id = this.nextId++;
+      const body = payload || Buffer.alloc(0);
+      const line = JSON.stringify(Object.assign({}, header, { id, size: body.length })) + '\n';
+
+      if (this.process.stdin.writableEnded) {
+        reject(new Error('Detection worker is stopping'));
+        return;
+      }
+      this.pending.set(id, { resolve, reject });
+      this.process.stdin.write(line);
+      if (body.length > 0) {
+        this.process.stdin.write(body);
+      }
+    });
+  }
+
+  // Run detection on an image file and write the annotated result to outputPath
+  async processFile(inputPath, outputPath) {
+    const { header } = await this.request({
+      op: 'process',
+      input_path: inputPath,
+      output_path: outputPath
+    });
+    return header.timings;
+  }
+
+  // Inference profile fields of a request (see ai/profiles.py): a named
+  // { profile } plus optional { imgsz, conf, iou, classes, maxDet }
+  // overrides, and { adaptive, budgetMs } to let the worker scale the input
+  // size of the stream to its latency budget
+  profileFields(options) {
+    const fields = {
+      profile: options.profile,
+      imgsz: options.imgsz,
+      conf: options.conf,
+      iou: options.iou,
+      classes: options.classes,
+      max_det: options.maxDet,
+      adaptive: options.adaptive || undefined,
+      budget_ms: options.budgetMs
+    };
+    Object.keys(fields).forEach(key => fields[key] === undefined && delete fields[key]);
+    return fields;
+  }
+
+  // Run detection on an in-memory JPEG and resolve with the annotated JPEG,
+  // without writing anything to disk. With { tiled: true } large images are
+  // run as overlapping tiles so that small bolts are not lost to downscaling.
+  async processBuffer(imageBuffer, options = {}) {
+    const { header, payload } = await this.request(Object.assign({
+      op: 'process',
+      format: 'jpeg',
+      tiled: Boolean(options.tiled)
+    }, this.profileFields(options)), imageBuffer);
+    return { image: payload, timings: header.timings };
+  }
+
+  // Run detection on an in-memory JPEG and resolve with structured boxes
+  // ({ detections, image_size, capture_ts, stale, timings }) instead of an
+  // annotated image. With { policy: 'latest' } a frame still waiting in the
+  // worker is dropped when a newer one arrives on the same stream; the
+  // dropped request rejects with error.dropped set. With { gate: true } the
+  // worker reuses the previous detections when the frame has not changed,
+  // and with { track: true } the model only runs every few frames while a
+  // tracker propagates the boxes (which then carry a track_id). Profile
+  // options are passed on as in processBuffer. When the worker runs as a
+  // pool, { priority } weights the stream's share of the inference time
+  // against the other streams (default 1).
+  async detectBuffer(imageBuffer, options = {}) {
+    const { header } = await this.request(Object.assign({
+      op: 'process',
+      format: 'jpeg',
+      output: 'detections',
+      policy: options.policy || 'fifo',
+      stream: options.stream || 'default',
+      capture_ts: options.captureTs || Date.now(),
+      gate: Boolean(options.gate),
+      track: Boolean(options.track),
+      priority: options.priority
+    }, this.profileFields(options)), imageBuffer);
+    return {
+      detections: header.detections,
+      counts: header.counts,
+      image_size: header.image_size,
+      capture_ts: header.capture_ts,
+      stale: header.stale,
+      timings: header.timings
+    };
+  }
+
+  // Fetch the worker's submitted/processed/dropped/stale frame counters,
+  // with the throughput and latency of each stream under counters.streams
+  async stats() {
+    const { header } = await this.request({ op: 'stats' });
+    return header.counters;
+  }
+
+  // Fetch the worker's metrics: a JSON snapshot, or Prometheus text with
+  // format 'prometheus'
+  async metrics(format = 'json') {
+    const { header, payload } = await this.request({ op: 'metrics', format });
+    return format === 'prometheus' ? payload.toString('utf8') : header.metrics;
+  }
+
+  // Sample the worker's threads for a few seconds and resolve with collapsed
+  // stacks (flamegraph.pl / speedscope input). The worker must run with
+  // DETECTION_PROFILING=1.
+  async profile(seconds = 10, intervalMs) {
+    const { payload } = await this.request({ op: 'profile', seconds, interval_ms: intervalMs });
+    return payload.toString('utf8');
+  }
+
+  // Check if the model is loaded and the worker is accepting requests
+  isReady() {
+    return this.ready;
+  }
+}
+
+// Create and export a singleton instance
+module.exports = new DetectionWorker();
@@ -1,8 +1,6 @@
 const express = require('express');
 const multer = require('multer');
 const path = require('path');
-const { spawn } = require('child_process');
-const fs = require('fs');
 const cors = require('cors');
 const http = require('http');
 const WebSocket = require('ws');
@@ -10,18 +8,60 @@ const WebSocket = require('ws');
 // Import our camera stream module
 const esp32Cam = require('./esp32-cam');
 
+// Import the persistent detection worker
+const detector = require('./detector');
+
 const app = express();
 const server = http.createServer(app);
 const port = process.env.PORT || 3000;
 
+// Skip inference on camera frames that have not changed since the last
+// analysed one (e.g. while the robot is parked at an inspection point)
+const motionGateEnabled = process.env.DETECTION_MOTION_GATE !== '0';
+
+// Run YOLO only every DETECTION_DETECT_EVERY frames and track the bolts in
+// between; boxes then carry persistent track ids
+const trackingEnabled = process.env.DETECTION_TRACKING === '1';
+
+// Run uploaded images as overlapping tiles so small bolts are not lost when
+// the whole image is downscaled to the model input size
+const tiledUploads = process.env.DETECTION_TILED_UPLOADS !== '0';
+
+// Inference profile of camera frames (see ai/profiles.py; the worker default
+// when unset). With DETECTION_ADAPTIVE=1 the worker lowers the input size
+// when frames take longer than DETECTION_LATENCY_BUDGET_MS to analyse, and
+// raises it again when there is headroom.
+const cameraProfile = process.env.DETECTION_CAMERA_PROFILE || undefined;
+const adaptiveResolution = process.env.DETECTION_ADAPTIVE === '1';
+const latencyBudgetMs = process.env.DETECTION_LATENCY_BUDGET_MS
+    ? Number(process.env.DETECTION_LATENCY_BUDGET_MS) : undefined;
+
+// Name of the camera's detection stream and its share of inference time
+// when several robots use the same worker pool (DETECTION_WORKERS > 1)
+const cameraStream = process.env.DETECTION_CAMERA_STREAM || 'esp32-cam';
+const cameraPriority = process.env.DETECTION_CAMERA_PRIORITY
+    ? Number(process.env.DETECTION_CAMERA_PRIORITY) : undefined;
+
+// When the Pi runs the detector itself (EDGE_DETECTION=1 on the Pi), its
+// results replace the server-side detection of camera frames for as long
+// as they keep arriving
+const edgeResultTimeoutMs = Number(process.env.EDGE_RESULT_TIMEOUT_MS || 2000);
+let lastEdgeResultTs = 0;
+
+// While the Pi runs its automatic sequence, camera frames are analysed even
+// without a detection client and the results are sent to the Pi, which
+// reacts to defects (see DEFECT_REACTION in rasp2.py)
+let automaticActive = false;
+
+// Latest dispatch and actuation counters reported by the Pi controller
+let controllerStats = null;
+
 // WebSocket server for both frontend and Pi connections
 const wss = new WebSocket.Server({ server, path: '/robot' }); 
 
 // Store connections
 let frontendConnections = new Set();
 let piConnection = null;
-let processingQueue = []; // Queue for frames waiting to be processed
-let isProcessing = false; // Flag to prevent multiple simultaneous processing
 
 // Handle WebSocket connections
 wss.on('connection', (ws, req) => {
@@ -93,6 +133,7 @@ wss.on('connection', (ws, req) => {
             if (!isRaspberryPi && data.type === 'automatic') {
                 if (piConnection && piConnection.readyState === WebSocket.OPEN) {
                     piConnection.send(JSON.stringify(data));
+                    automaticActive = data.enabled !== false;
                     console.log(`Automatic mode command forwarded to Pi: enabled=${data.enabled}`);
                     
                     // Send confirmation back to all frontend clients
@@ -162,8 +203,31 @@ wss.on('connection', (ws, req) => {
             // Forward Pi messages to all frontend clients
             if (isRaspberryPi) {
                 // Check for completion messages from automatic mode
-                if (data.type === 'automatic_completed') {
+                if (data.type === 'detection_result') {
+                    // Edge detection results only go to the clients that asked for detection
+                    if (!lastEdgeResultTs) {
+                        console.log('Receiving edge detection results from Pi');
+                    }
+                    lastEdgeResultTs = Date.now();
+                    frontendConnections.forEach(client => {
+                        if (client.readyState === WebSocket.OPEN && client.realTimeDetectionEnabled) {
+                            client.send(message);
+                        }
+                    });
+                } else if (data.type === 'controller_stats') {
+                    controllerStats = Object.assign({ received_at: Date.now() }, data);
+                } else if (data.type === 'defect_event') {
+                    console.log(`Defect ${data.class_name} (${data.confidence}) -> ${data.reaction}, ` +
+                        `capture to actuation ${data.latency_ms.capture_to_actuation} ms` +
+                        (data.over_budget ? ' (over budget)' : ''));
+                    frontendConnections.forEach(client => {
+                        if (client.readyState === WebSocket.OPEN) {
+                            client.send(message);
+                        }
+                    });
+                } else if (data.type === 'automatic_completed') {
                     console.log('Received automatic mode completion notification from Pi');
+                    automaticActive = false;
                     // Inform all frontend clients that automatic mode has completed
                     frontendConnections.forEach(client => {
                         if (client.readyState === WebSocket.OPEN) {
@@ -192,6 +256,7 @@ wss.on('connection', (ws, req) => {
         if (isRaspberryPi) {
             console.log('Raspberry Pi disconnected');
             piConnection = null;
+            automaticActive = false;
             
             // Notify all frontend clients that Pi is disconnected
             frontendConnections.forEach(client => {
@@ -220,133 +285,66 @@ wss.on('connection', (ws, req) => {
     }
 });
 
-// Process frames for object detection
-async function processFrameForDetection(frameBuffer) {
+// Process frames for object detection. Real-time frames use the worker's
+// "latest" policy: when inference falls behind, older waiting frames are
+// dropped so results always describe the most recent view.
+async function processFrameForDetection(frameBuffer, captureTs) {
     if (!frameBuffer) return null;
     
     try {
-        // Save frame to temporary file
-        const tempDir = path.join(__dirname, 'temp');
-        if (!fs.existsSync(tempDir)) {
-            fs.mkdirSync(tempDir, { recursive: true });
-        }
-        
-        const inputPath = path.join(tempDir, `frame_${Date.now()}.jpg`);
-        const outputPath = path.join(tempDir, `processed_${Date.now()}.jpg`);
-        
-        fs.writeFileSync(inputPath, frameBuffer);
-        
-        // Get the absolute path to the Python script
-        const pythonScriptPath = path.resolve(path.join(__dirname, '../ai/process_image.py'));
-        
-        // Determine which Python command to use based on OS
-        let pythonCommand = 'python';
-        if (process.platform === 'win32') {
-            try {
-                require('child_process').execSync('py --version');
-                pythonCommand = 'py';
-            } catch (error) {
-                console.log('Falling back to python command');
-            }
-        } else if (process.platform === 'darwin' || process.platform === 'linux') {
-            try {
-                require('child_process').execSync('python3 --version');
-                pythonCommand = 'python3';
-            } catch (error) {
-                console.log('Falling back to python command');
-            }
-        }
-        
-        return new Promise((resolve, reject) => {
-            const pythonProcess = spawn(pythonCommand, [
-                pythonScriptPath,
-                inputPath,
-                outputPath
-            ]);
-            
-            let pythonError = '';
-            pythonProcess.stderr.on('data', (data) => {
-                pythonError += data.toString();
-            });
-            
-            pythonProcess.on('close', (code) => {
-                if (code !== 0) {
-                    console.error(`Python error: ${pythonError}`);
-                    // Clean up files
-                    try {
-                        if (fs.existsSync(inputPath)) fs.unlinkSync(inputPath);
-                    } catch (err) {}
-                    reject(new Error(`Failed to process frame: ${pythonError}`));
-                    return;
-                }
-                
-                // Read the processed image file
-                try {
-                    if (!fs.existsSync(outputPath)) {
-                        reject(new Error('Processed file not found'));
-                        return;
-                    }
-                    
-                    const processedImage = fs.readFileSync(outputPath);
-                    const base64Image = Buffer.from(processedImage).toString('base64');
-                    
-                    // Clean up files
-                    try {
-                        fs.unlinkSync(inputPath);
-                        fs.unlinkSync(outputPath);
-                    } catch (err) {
-                        console.error('Error cleaning up temporary files:', err);
-                    }
-                    
-                    resolve(base64Image);
-                } catch (err) {
-                    console.error('Error reading processed image:', err);
-                    reject(err);
-                }
-            });
+        // Send the frame to the detection worker in memory and get back
+        // compact boxes; clients draw them over the camera_frame they have
+        return await detector.detectBuffer(frameBuffer, {
+            policy: 'latest',
+            stream: cameraStream,
+            priority: cameraPriority,
+            captureTs,
+            gate: motionGateEnabled,
+            track: trackingEnabled,
+            profile: cameraProfile,
+            adaptive: adaptiveResolution,
+            budgetMs: latencyBudgetMs
         });
     } catch (error) {
-        console.error('Error in processFrameForDetection:', error);
+        if (!error.dropped) {
+            console.error('Error in processFrameForDetection:', error);
+        }
         return null;
     }
 }
 
-// Process the queue of frames
-async function processQueue() {
-    if (isProcessing || processingQueue.length === 0) return;
-    
-    isProcessing = true;
+// Run detection on a camera frame and send the result to detection clients
+async function detectFrame(frameBuffer, captureTs) {
+    const result = await processFrameForDetection(frameBuffer, captureTs);
+    if (!result) return;
     
-    try {
-        const { frameBuffer, clients } = processingQueue.shift();
-        
-        const base64Image = await processFrameForDetection(frameBuffer);
-        
-        if (base64Image) {
-            // Send processed frame to all clients who requested it
-            clients.forEach(client => {
-                if (client.readyState === WebSocket.OPEN && client.realTimeDetectionEnabled) {
-                    client.send(JSON.stringify({
-                        type: 'detection_frame',
-                        data: base64Image
-                    }));
-                }
-            });
-        }
-    } catch (error) {
-        console.error('Error in processQueue:', error);
-    } finally {
-        isProcessing = false;
-        
-        // Process next item in queue
-        if (processingQueue.length > 0) {
-            processQueue();
+    // Send detections to all clients who requested them
+    const message = JSON.stringify({
+        type: 'detection_result',
+        stream: cameraStream,
+        detections: result.detections,
+        counts: result.counts,
+        image_size: result.image_size,
+        capture_ts: result.capture_ts,
+        age_ms: result.timings.age_ms,
+        stale: result.stale,
+        timings: result.timings
+    });
+    frontendConnections.forEach(client => {
+        if (client.readyState === WebSocket.OPEN && client.realTimeDetectionEnabled) {
+            client.send(message);
         }
+    });
+    if (automaticActive && result.detections.length > 0 &&
+        piConnection && piConnection.readyState === WebSocket.OPEN) {
+        piConnection.send(message);
     }
 }
 
 // Camera stream events
 esp32Cam.on('frame', (frameBuffer) => {
+    const captureTs = Date.now();
+    
     // Convert frame buffer to base64
     const frameBase64 = frameBuffer.toString('base64');
     
@@ -365,18 +363,12 @@ esp32Cam.on('frame', (frameBuffer) => {
         }
     });
     
-    // If we have clients with real-time detection enabled and 
-    // the queue is not too large, add the frame to the processing queue
-    if (detectionClients.length > 0 && processingQueue.length < 3) { // Increased from 2 to 3
-        processingQueue.push({
-            frameBuffer,
-            clients: detectionClients
-        });
-        
-        // Start processing if not already processing
-        if (!isProcessing) {
-            processQueue();
-        }
+    // If we have clients with real-time detection enabled, hand the frame
+    // to the worker; it keeps only the newest waiting frame. Skipped while
+    // the Pi publishes its own results.
+    const edgeActive = captureTs - lastEdgeResultTs < edgeResultTimeoutMs;
+    if ((detectionClients.length > 0 || automaticActive) && !edgeActive) {
+        detectFrame(frameBuffer, captureTs);
     }
 });
 
@@ -411,6 +403,50 @@ app.get('/cam-stream', (req, res) => {
     res.sendFile(path.join(__dirname, 'templates', 'cam-stream.html'));
 });
 
+// Detection frame counters (submitted, processed, dropped, stale) and the
+// throughput and latency of each stream, to tune the camera frame rate
+// against inference capacity
+app.get('/api/detection-stats', async (req, res) => {
+    try {
+        res.json(await detector.stats());
+    } catch (error) {
+        res.status(503).json({ error: error.message });
+    }
+});
+
+// Worker metrics in the Prometheus text format (?format=json for JSON)
+app.get('/api/detection-metrics', async (req, res) => {
+    try {
+        if (req.query.format === 'json') {
+            res.json(await detector.metrics('json'));
+        } else {
+            res.type('text/plain; version=0.0.4').send(await detector.metrics('prometheus'));
+        }
+    } catch (error) {
+        res.status(503).json({ error: error.message });
+    }
+});
+
+// On-demand sampling profile of the worker as collapsed stacks
+// (?seconds=N, only when the worker runs with DETECTION_PROFILING=1)
+app.get('/api/detection-profile', async (req, res) => {
+    const seconds = Math.min(Math.max(parseFloat(req.query.seconds) || 10, 0.1), 120);
+    try {
+        res.type('text/plain').send(await detector.profile(seconds));
+    } catch (error) {
+        res.status(503).json({ error: error.message });
+    }
+});
+
+// Message and hardware-write counters of the Pi controller (sent every 10 s)
+app.get('/api/controller-stats', (req, res) => {
+    if (!controllerStats) {
+        res.status(503).json({ error: 'No stats received from the Raspberry Pi yet' });
+        return;
+    }
+    res.json(controllerStats);
+});
+
 app.get('/frame', (req, res) => {
     const frame = esp32Cam.getLatestFrame();
     if (!frame) {
@@ -431,20 +467,9 @@ app.use(cors());
 // Serve static files from the frontend directory
 app.use(express.static(path.join(__dirname, '../frontend')));
 
-// Configure multer for file uploads
-const storage = multer.diskStorage({
-    destination: function(req, file, cb) {
-        const uploadDir = path.join(__dirname, 'uploads');
-        if (!fs.existsSync(uploadDir)) {
-            fs.mkdirSync(uploadDir, { recursive: true });
-        }
-        cb(null, uploadDir);
-    },
-    filename: function(req, file, cb) {
-        // Create a unique filename
-        cb(null, Date.now() + '-' + file.originalname);
-    }
-});
+// Configure multer for file uploads. Uploads are kept in memory and handed
+// straight to the detection worker, so nothing is written to disk.
+const storage = multer.memoryStorage();
 
 const upload = multer({ 
     storage: storage,
@@ -459,6 +484,18 @@ const upload = multer({
 });
 
 // API route for processing images
+// Optional inference profile fields sent along with an upload
+function uploadProfileOptions(body) {
+    const options = {};
+    if (body.profile) options.profile = String(body.profile);
+    if (body.imgsz) options.imgsz = parseInt(body.imgsz, 10);
+    if (body.conf) options.conf = parseFloat(body.conf);
+    if (body.iou) options.iou = parseFloat(body.iou);
+    if (body.max_det) options.maxDet = parseInt(body.max_det, 10);
+    if (body.classes) options.classes = String(body.classes).split(',').map(c => c.trim()).filter(Boolean);
+    return options;
+}
+
 app.post('/api/process-image', upload.single('image'), async (req, res) => {
     try {
         if (!req.file) {
@@ -466,107 +503,25 @@ app.post('/api/process-image', upload.single('image'), async (req, res) => {
             return res.status(400).json({ error: 'No image file uploaded' });
         }
         
-        console.log('File received:', req.file.originalname);
-        console.log('File saved to:', req.file.path);
-
-        // Create output directory if it doesn't exist
-        const outputDir = path.join(__dirname, 'outputs');
-        if (!fs.existsSync(outputDir)) {
-            fs.mkdirSync(outputDir, { recursive: true });
-            console.log('Created output directory:', outputDir);
-        }
-
-        // Define input and output paths
-        const inputPath = req.file.path;
-        const outputPath = path.join(outputDir, 'processed-' + path.basename(inputPath));
-        console.log('Output path will be:', outputPath);
-
-        // Get the absolute path to the Python script
-        const pythonScriptPath = path.resolve(path.join(__dirname, '../ai/process_image.py'));
-        console.log('Python script path:', pythonScriptPath);
-
-        // Check if Python script exists
-        if (!fs.existsSync(pythonScriptPath)) {
-            console.error('Python script not found at:', pythonScriptPath);
-            return res.status(500).json({ error: 'Image processing script not found' });
-        }
+        console.log('File received:', req.file.originalname, `(${req.file.size} bytes)`);
 
-        // Determine which Python command to use based on OS
-        let pythonCommand = 'python';
-        if (process.platform === 'win32') {
-            // On Windows, try 'py' first
-            try {
-                require('child_process').execSync('py --version');
-                pythonCommand = 'py';
-                console.log('Using Python command: py');
-            } catch (error) {
-                // Fall back to python
-                console.log('Falling back to python command');
-            }
-        } else if (process.platform === 'darwin' || process.platform === 'linux') {
-            // On macOS/Linux, try python3 first
-            try {
-                require('child_process').execSync('python3 --version');
-                pythonCommand = 'python3';
-                console.log('Using Python command: python3');
-            } catch (error) {
-                console.log('Falling back to python command');
-            }
+        // Run detection in the long-running Python worker
+        console.log('Sending image to detection worker');
+        let result;
+        try {
+            result = await detector.processBuffer(req.file.buffer,
+                Object.assign({ tiled: tiledUploads }, uploadProfileOptions(req.body || {})));
+        } catch (err) {
+            console.error(`Detection error: ${err.message}`);
+            return res.status(500).json({ error: `Failed to process image: ${err.message}` });
         }
+        console.log('Detection timings (ms):', result.timings);
 
-        // Run the Python script to process the image
-        console.log(`Spawning ${pythonCommand} process with arguments:`, [pythonScriptPath, inputPath, outputPath]);
-        const pythonProcess = spawn(pythonCommand, [
-            pythonScriptPath,
-            inputPath,
-            outputPath
-        ]);
-
-        let pythonError = '';
-        pythonProcess.stderr.on('data', (data) => {
-            const errorText = data.toString();
-            pythonError += errorText;
-            console.error('Python stderr:', errorText);
-        });
-
-        pythonProcess.stdout.on('data', (data) => {
-            console.log('Python stdout:', data.toString());
-        });
-
-        pythonProcess.on('close', (code) => {
-            console.log(`Python process exited with code ${code}`);
-            
-            if (code !== 0) {
-                console.error(`Python error: ${pythonError}`);
-                return res.status(500).json({ error: `Failed to process image: ${pythonError}` });
-            }
-
-            // Check if output file exists
-            if (!fs.existsSync(outputPath)) {
-                console.error('Output file was not generated at:', outputPath);
-                return res.status(500).json({ error: 'Output file was not generated' });
-            }
-
-            console.log('Image processed successfully, reading file');
-            // Read the processed image file
-            const processedImage = fs.readFileSync(outputPath);
-            const base64Image = Buffer.from(processedImage).toString('base64');
-            
-            console.log('Sending processed image to client');
-            // Send the processed image back to the client
-            res.json({ processedImage: base64Image });
-
-            // Clean up temporary files
-            setTimeout(() => {
-                try {
-                    fs.unlinkSync(inputPath);
-                    fs.unlinkSync(outputPath);
-                    console.log('Temporary files cleaned up');
-                } catch (err) {
-                    console.error('Error cleaning up temporary files:', err);
-                }
-            }, 60000); // Clean up after 1 minute
-        });
+        const base64Image = result.image.toString('base64');
+        
+        console.log('Sending processed image to client');
+        // Send the processed image back to the client
+        res.json({ processedImage: base64Image });
     } catch (error) {
         console.error('Server error:', error);
         res.status(500).json({ error: `Internal server error: ${error.message}` });
@@ -586,4 +541,7 @@ server.listen(port, () => {
     
     // Try to connect to the ESP32-CAM when server starts
     esp32Cam.start();
+    
+    // Load the detection model up front so the first frame is not delayed
+    detector.start();
 });
\ No newline at end of file
@@ -42,8 +42,8 @@ document.addEventListener('DOMContentLoaded', () => {
                     updateCameraFrame(message.data);
                 } else if (message.type === 'stream_status') {
                     updateStreamStatus(message.connected);
-                } else if (message.type === 'detection_frame') {
-                    updateDetectionFrame(message.data);
+                } else if (message.type === 'detection_result') {
+                    updateDetectionResult(message);
                 } else if (message.type === 'detection_status') {
                     updateDetectionStatus(message.enabled, message.mode);
                 } else if (message.type === 'automatic_status') {
@@ -80,14 +80,57 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    function updateDetectionFrame(base64Data) {
-        const img = document.getElementById('detection-result');
+    // Box colours for the data.yaml classes (Boulon_Bon, Boulon_Mauvais, fp-bolt-missing)
+    const DETECTION_COLORS = ['#2ecc71', '#e74c3c', '#f39c12'];
+
+    // Draw the latest camera frame with the detected boxes on top
+    function updateDetectionResult(result) {
+        const canvas = document.getElementById('detection-result');
+        const cameraImg = document.getElementById('camera-stream');
         const resultContainer = document.getElementById('detection-result-container');
         const loadingContainer = document.getElementById('detection-loading-container');
         const viewWrapper = document.getElementById('realtime-view-wrapper');
 
-        if (img && resultContainer && loadingContainer && viewWrapper) {
-            img.src = `data:image/jpeg;base64,${base64Data}`;
+        if (canvas && cameraImg && resultContainer && loadingContainer && viewWrapper) {
+            const [width, height] = result.image_size || [cameraImg.naturalWidth, cameraImg.naturalHeight];
+            if (!width || !height) return;
+
+            if (canvas.width !== width || canvas.height !== height) {
+                canvas.width = width;
+                canvas.height = height;
+            }
+
+            const ctx = canvas.getContext('2d');
+            ctx.drawImage(cameraImg, 0, 0, width, height);
+            ctx.lineWidth = 2;
+            ctx.font = '14px sans-serif';
+            ctx.textBaseline = 'top';
+
+            (result.detections || []).forEach(detection => {
+                const [x1, y1, x2, y2] = detection.box;
+                const color = DETECTION_COLORS[detection.class_id % DETECTION_COLORS.length];
+                const trackLabel = detection.track_id !== undefined ? ` #${detection.track_id}` : '';
+                const label = `${detection.class_name}${trackLabel} ${detection.confidence.toFixed(2)}`;
+
+                ctx.strokeStyle = color;
+                ctx.strokeRect(x1, y1, x2 - x1, y2 - y1);
+
+                const labelWidth = ctx.measureText(label).width + 6;
+                const labelY = Math.max(0, y1 - 18);
+                ctx.fillStyle = color;
+                ctx.fillRect(x1, labelY, labelWidth, 18);
+                ctx.fillStyle = '#ffffff';
+                ctx.fillText(label, x1 + 3, labelY + 2);
+            });
+
+            // Show how old the analysed frame is, so operators know how much
+            // to trust the boxes while the robot is moving
+            const status = document.getElementById('detection-status');
+            if (status && typeof result.age_ms === 'number') {
+                status.textContent = `Détection d'objets active (${Math.round(result.age_ms)} ms)`;
+                status.className = result.stale ? 'detection-status stale' : 'detection-status active';
+            }
+
             resultContainer.style.display = 'flex';
             loadingContainer.style.display = 'none';
             viewWrapper.classList.add('split-view');
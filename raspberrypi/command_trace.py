@@ -0,0 +1,313 @@
+"""
+Recording and replay of the controller's WebSocket command sessions.
+
+rasp2.py appends every message it receives from the server to the file
+named by COMMAND_TRACE, one JSON line per message with its time in the
+session; each connection starts a new session:
+
+    {"session_start": 1718000000.123}
+    {"t": 0.0, "message": "{\\"type\\":\\"control\\",\\"direction\\":\\"forward\\",...}"}
+    {"t": 0.041, "message": "..."}
+
+Replaying a session feeds the same messages, with the same spacing divided
+by --speed (0: back to back), to a controller running on the simulated
+hardware of hal.py, and reports the dispatch throughput, the time from each
+command to the first write of its actuator (commands coalesced into a later
+one are answered by that write and counted as superseded; repeats of a
+command already written are counted apart), and the GPIO and I2C write
+counts. The actuation loop and the motion ramps still run in real time, so
+replays at different speeds are comparable with each other rather than
+with the live session.
+
+    python command_trace.py trace.jsonl [--controller rasp2|raspberrypi]
+        [--session N] [--speed X] [--settle S] [--json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import hal
+from pca9685 import BYTES_PER_CHANNEL, LED0_ON_L
+
+
+class TraceWriter:
+    """Appends received messages to a trace file, one session per start_session()."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a', buffering=1, encoding='utf-8')
+        self._start = None
+
+    def start_session(self):
+        self._start = time.monotonic()
+        self._file.write(json.dumps({'session_start': round(time.time(), 3)}) + '\n')
+
+    def write(self, message):
+        if self._start is None:
+            self.start_session()
+        if isinstance(message, bytes):
+            message = message.decode('utf-8', 'replace')
+        self._file.write(json.dumps({'t': round(time.monotonic() - self._start, 6), 'message': message}) + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+def load_trace(path):
+    """Sessions of a trace file, each a list of (t, message)."""
+    sessions = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if 'session_start' in entry or not sessions:
+                sessions.append([])
+            if 'message' in entry:
+                sessions[-1].append((entry['t'], entry['message']))
+    return [session for session in sessions if session]
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        "p50": round(values[len(values) // 2], 3),
+        "p99": round(values[min(len(values) - 1, int(len(values) * 0.99))], 3),
+        "max": round(values[-1], 3),
+    }
+
+
+ALL_ACTUATORS = '*' # An e-stop: the first write of any actuator answers it
+
+
+def message_actuators(message):
+    """Actuators a command message sets ('base' or ('servo', channel)); empty for other messages."""
+    try:
+        data = json.loads(message)
+    except ValueError:
+        return ()
+    message_type = str(data.get('type', '')).lower()
+    if message_type == 'control':
+        return ('base',)
+    if message_type == 'servo':
+        try:
+            return (('servo', int(data.get('motor_id'))),)
+        except (TypeError, ValueError):
+            return ()
+    if message_type == 'command' and str(data.get('action', '')).lower() == 'stop':
+        return (ALL_ACTUATORS,)
+    return ()
+
+
+def write_actuators(write):
+    """Actuators changed by a recorded write: the base for PWM, the channels of a PCA9685 block write."""
+    _, device, _, value = write
+    if device == 'pwm':
+        return ('base',)
+    if device == 'i2c' and value and value[0] >= LED0_ON_L:
+        first = (value[0] - LED0_ON_L) // BYTES_PER_CHANNEL
+        count = -(-(len(value) - 1) // BYTES_PER_CHANNEL)
+        return tuple(('servo', channel) for channel in range(first, first + count))
+    return ()
+
+
+def actuation_latencies(sent, messages, writes):
+    """
+    Time (ms) from each command message to the first write of its actuator
+    after it. A write answers every message for its actuator since that
+    actuator's previous write: the latest one and those it superseded
+    (coalesced by the actuation loop, or replaced while ramping). A command
+    identical to the last one written for its actuator (e.g. a joystick
+    held down) may have nothing to write: if the next command for that
+    actuator arrives before any write, it is counted as a repeat instead.
+    sent holds (perf_counter at dispatch, number of writes recorded then)
+    per message. Returns (latencies, counts of superseded, repeated and
+    unanswered commands).
+    """
+    latencies = []
+    counts = {'superseded': 0, 'repeated': 0, 'unanswered': 0}
+    pending = {} # Actuator -> [message index, is a repeat] waiting for its next write
+    last_written = {} # Actuator -> the last command answered by a write
+    resolved = set()
+
+    def answer(actuator, written_at):
+        waiting = [i for i, _ in pending.pop(actuator, ()) if i not in resolved]
+        for i in waiting:
+            resolved.add(i)
+            latencies.append((written_at - sent[i][0]) * 1000)
+        if waiting:
+            counts['superseded'] += len(waiting) - 1
+            last_written[actuator] = json.loads(messages[waiting[-1]][1])
+
+    def drop_repeats(actuator):
+        entries = pending.get(actuator)
+        if entries:
+            for i, repeat in entries:
+                if repeat and i not in resolved:
+                    resolved.add(i)
+                    counts['repeated'] += 1
+            entries[:] = [entry for entry in entries if not entry[1]]
+
+    events = sorted([(first_write, 0, i) for i, (_, first_write) in enumerate(sent)] +
+                    [(index, 1, index) for index in range(len(writes))])
+    commands = 0
+    for _, kind, index in events:
+        if kind == 0:
+            actuators = message_actuators(messages[index][1])
+            if not actuators:
+                continue
+            commands += 1
+            command = json.loads(messages[index][1])
+            for actuator in (list(pending) if ALL_ACTUATORS in actuators else actuators):
+                drop_repeats(actuator)
+            for actuator in actuators:
+                repeat = not pending.get(actuator) and last_written.get(actuator) == command
+                pending.setdefault(actuator, []).append((index, repeat))
+        else:
+            written_at = writes[index][0]
+            actuators = write_actuators(writes[index])
+            for actuator in actuators:
+                answer(actuator, written_at)
+            if actuators and pending.get(ALL_ACTUATORS):
+                answer(ALL_ACTUATORS, written_at)
+    for actuator in list(pending):
+        drop_repeats(actuator)
+    counts['unanswered'] = commands - len(resolved)
+    return latencies, counts
+
+
+async def _replay_async(controller, messages, speed, settle):
+    import asyncio
+
+    controller.outgoing_queue = asyncio.Queue(maxsize=controller.WS_OUTGOING_QUEUE_SIZE)
+    controller.sequence_wake_event = asyncio.Event()
+    actuation = asyncio.create_task(controller.actuation_loop())
+    sent, dispatch_s = [], 0.0
+    start = time.perf_counter()
+    for t, message in messages:
+        if speed > 0:
+            delay = start + t / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)
+        sent.append((time.perf_counter(), len(hal.recorder.writes)))
+        controller.on_message(message)
+        dispatch_s += time.perf_counter() - sent[-1][0]
+    await asyncio.sleep(settle)
+    controller.cancel_automatic_sequence("replay finished")
+    actuation.cancel()
+    await asyncio.gather(actuation, *([controller.sequence_task] if controller.sequence_task else []),
+                         return_exceptions=True)
+    return sent, dispatch_s
+
+
+def _replay_sync(controller, messages, speed, settle):
+    sent, dispatch_s = [], 0.0
+    start = time.perf_counter()
+    for t, message in messages:
+        if speed > 0:
+            delay = start + t / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        sent.append((time.perf_counter(), len(hal.recorder.writes)))
+        controller.on_message(None, message)
+        dispatch_s += time.perf_counter() - sent[-1][0]
+    time.sleep(settle)
+    return sent, dispatch_s
+
+
+def replay(controller_name, messages, speed=0.0, settle=1.0):
+    """Replay messages against a controller on the simulated hardware and measure it."""
+    import asyncio
+    import importlib
+
+    controller = importlib.import_module(controller_name)
+    if controller_name == 'rasp2':
+        controller.setup_dc_motors_gpio()
+        controller.setup_arm_servos()
+        controller.setup_motion_profiles()
+    else:
+        controller.setup_dc_motors_gpio()
+        controller.setup_arm_servos()
+    setup_writes = len(hal.recorder.writes)
+    hal.recorder.clear()
+
+    started = time.perf_counter()
+    if controller_name == 'rasp2':
+        sent, dispatch_s = asyncio.run(_replay_async(controller, messages, speed, settle))
+    else:
+        sent, dispatch_s = _replay_sync(controller, messages, speed, settle)
+    elapsed = time.perf_counter() - started - settle
+
+    writes = list(hal.recorder.writes)
+    latencies, counts = actuation_latencies(sent, messages, writes)
+    report = {
+        'controller': controller_name,
+        'messages': len(messages),
+        'speed': speed,
+        'replay_s': round(elapsed, 3),
+        'trace_s': round(messages[-1][0] - messages[0][0], 3) if messages else 0,
+        'dispatch_ms': round(dispatch_s * 1000, 2),
+        'dispatch_per_s': round(len(messages) / dispatch_s) if dispatch_s else None,
+        'actuated_messages': len(latencies),
+        'superseded_messages': counts['superseded'],
+        'repeated_messages': counts['repeated'],
+        'unactuated_messages': counts['unanswered'],
+        'command_to_actuation_ms': percentiles(latencies),
+        'writes': hal.recorder.counts(),
+        'setup_writes': setup_writes,
+    }
+    if controller_name == 'rasp2':
+        report['controller_stats'] = controller.controller_stats()
+    return report
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Replay a recorded command session against a controller on simulated hardware.")
+    parser.add_argument("trace", help="trace file written with COMMAND_TRACE")
+    parser.add_argument("--controller", choices=('rasp2', 'raspberrypi'), default='rasp2',
+                        help="controller to replay against (default: rasp2)")
+    parser.add_argument("--session", type=int, default=-1, help="session of the trace to replay (default: the last)")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="replay speed relative to the recording (default 0: messages back to back)")
+    parser.add_argument("--settle", type=float, default=1.0,
+                        help="seconds to keep the actuation loop running after the last message")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    sessions = load_trace(args.trace)
+    if not sessions:
+        print(f"No messages in {args.trace}", file=sys.stderr)
+        return 1
+    messages = sessions[args.session]
+
+    # The controller creates its devices on the simulated hardware
+    os.environ['ROBOT_HARDWARE'] = 'sim'
+    import logging
+    logging.disable(logging.WARNING)
+
+    report = replay(args.controller, messages, args.speed, args.settle)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+    print(f"Replayed {report['messages']} messages ({report['trace_s']} s recorded) against {report['controller']} "
+          f"in {report['replay_s']} s")
+    print(f"  dispatch: {report['dispatch_ms']} ms total, {report['dispatch_per_s']} messages/s")
+    print(f"  command to actuation: {report['command_to_actuation_ms']} ms over {report['actuated_messages']} "
+          f"commands ({report['superseded_messages']} superseded before their write); "
+          f"{report['repeated_messages']} repeats, {report['unactuated_messages']} never written")
+    print(f"  writes: {report['writes']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+Edge inference on the Raspberry Pi.
+
+Runs the bolt detector next to the robot controller instead of on the
+server: the ESP32-CAM stream is read directly (ai/mjpeg.py), every frame
+is decoded in memory and analysed by the INT8-quantized ONNX model on the
+CPU, and only the detections leave the process, as one compact line of
+JSON per analysed frame on stdout:
+
+    {"type": "detection_result", "source": "edge", "stream": "esp32-cam",
+     "capture_ts": 1718000000123, "age_ms": 142.0, "stale": false,
+     "image_size": [640, 480], "counts": {"fp-bolt-missing": 1},
+     "detections": [{"class_id": 1, "class_name": "fp-bolt-missing",
+                     "confidence": 0.87, "box": [102, 40, 180, 121]}],
+     "timings": {"inference_ms": 96.2}}
+
+rasp2.py starts this script as a child process when EDGE_DETECTION=1 and
+forwards the lines over its /robot WebSocket; no frame is sent anywhere.
+It runs as a separate process so inference never competes with the
+controller's WebSocket thread for the GIL.
+
+    python edge_detector.py [URL] [--backend onnx|stub] [--model PATH]
+        [--profile NAME] [--threads N] [--max-rate HZ] [--duration S]
+
+The detector code is imported from the repository's ai/ directory
+(EDGE_AI_DIR to use another checkout). With a model path ending in .onnx
+the file is loaded as is, so the Pi only needs best.int8.onnx, neither
+best.pt nor ultralytics. On a normal Linux box the whole path can be
+exercised with the stand-in camera and the stub model:
+
+    python ../ai/mjpeg.py --serve --port 8081 &
+    python edge_detector.py http://127.0.0.1:8081/stream --backend stub
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+AI_DIR = os.environ.get('EDGE_AI_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ai'))
+sys.path.insert(0, os.path.abspath(AI_DIR))
+
+from backends import BACKEND_ONNX, BACKENDS, onnx_path_for  # noqa: E402
+from process_image import MODEL_PATH  # noqa: E402
+
+# MJPEG stream of the ESP32-CAM (access point address, as in esp32-cam.js)
+DEFAULT_STREAM_URL = os.environ.get('EDGE_STREAM_URL', 'http://192.168.4.1/stream')
+
+DEFAULT_BACKEND = os.environ.get('EDGE_BACKEND', BACKEND_ONNX)
+
+# The quantized export next to the weights; copied to the Pi on its own
+DEFAULT_MODEL_PATH = os.environ.get('EDGE_MODEL_PATH', onnx_path_for(MODEL_PATH, int8=True))
+
+# Small input size: the Pi's CPU manages a few frames per second at 320 px
+DEFAULT_PROFILE = os.environ.get('EDGE_PROFILE', 'realtime')
+
+# Leave one core to the controller process
+DEFAULT_THREADS = int(os.environ.get('EDGE_THREADS', 0)) or max(1, (os.cpu_count() or 1) - 1)
+
+# Upper bound on published results per second (0: every analysed frame)
+DEFAULT_MAX_RATE_HZ = float(os.environ.get('EDGE_MAX_RATE_HZ', 5))
+
+
+def compact_detections(detections):
+    """Round boxes to whole pixels and confidences to two decimals."""
+    return [dict(detection, confidence=round(detection['confidence'], 2),
+                 box=[int(round(v)) for v in detection['box']])
+            for detection in detections]
+
+
+class EdgePublisher:
+    """
+    Turns engine results into compact detection_result lines on an output
+    stream, publishing at most max_rate_hz results per second. A result is
+    skipped under the rate limit only while it has the same detections per
+    class as the last published one, so a change always goes out at once.
+    closed is set once the output stream is gone (the controller exited).
+    """
+
+    def __init__(self, output_stream, class_labels, stream='esp32-cam', max_rate_hz=DEFAULT_MAX_RATE_HZ):
+        self.output_stream = output_stream
+        self.class_labels = class_labels
+        self.stream = stream
+        self.min_interval = 1 / max_rate_hz if max_rate_hz > 0 else 0
+        self._last_sent = 0
+        self._last_counts = None
+        self._lock = threading.Lock()
+        self.counters = {'analysed': 0, 'published': 0, 'skipped': 0}
+        self.closed = threading.Event()
+
+    def __call__(self, result, timings):
+        from process_image import extract_detections
+
+        detections = compact_detections(extract_detections(result, self.class_labels))
+        counts = dict(Counter(detection['class_name'] for detection in detections))
+        now = time.monotonic()
+        with self._lock:
+            self.counters['analysed'] += 1
+            if counts == self._last_counts and now - self._last_sent < self.min_interval:
+                self.counters['skipped'] += 1
+                return
+            self._last_sent = now
+            self._last_counts = counts
+            self.counters['published'] += 1
+            line = json.dumps({
+                'type': 'detection_result',
+                'source': 'edge',
+                'stream': self.stream,
+                'capture_ts': timings['capture_ts'],
+                'age_ms': round(timings['age_ms'], 1),
+                'stale': timings['stale'],
+                'image_size': [result.orig_img.shape[1], result.orig_img.shape[0]],
+                'counts': counts,
+                'detections': detections,
+                'timings': {'inference_ms': round(timings['inference_ms'], 1)},
+            }, separators=(',', ':'))
+            if self.closed.is_set():
+                return
+            try:
+                self.output_stream.write(line.encode('utf-8') + b'\n')
+                self.output_stream.flush()
+            except OSError:
+                self.closed.set()
+
+
+def parse_args(argv):
+    from profiles import PROFILES
+
+    parser = argparse.ArgumentParser(description="Run the bolt detector on the Pi and print compact results.")
+    parser.add_argument("url", nargs='?', default=DEFAULT_STREAM_URL,
+                        help=f"MJPEG stream URL (default: {DEFAULT_STREAM_URL})")
+    parser.add_argument("--backend", choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help="inference backend (default: onnx, EDGE_BACKEND)")
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH,
+                        help="weights or exported .onnx file (default: the INT8 export, EDGE_MODEL_PATH)")
+    parser.add_argument("--fp32", action="store_true", help="with .pt weights, export and run the FP32 model instead of INT8")
+    parser.add_argument("--profile", choices=PROFILES, default=DEFAULT_PROFILE,
+                        help="inference profile (default: realtime, EDGE_PROFILE)")
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS,
+                        help="CPU threads for inference (default: all cores but one, EDGE_THREADS)")
+    parser.add_argument("--max-rate", type=float, default=DEFAULT_MAX_RATE_HZ,
+                        help="published results per second while nothing changes (0: all)")
+    parser.add_argument("--stream", default='esp32-cam', help="stream name in the published results")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    from engine import InferenceEngine
+    from mjpeg import feed_engine
+    from process_image import load_class_labels, load_model
+    from profiles import get_profile
+    from worker import redirect_stdout
+
+    # Keep stdout for the results
+    out = redirect_stdout()
+    class_labels = load_class_labels()
+    model = load_model(args.model, backend=args.backend, int8=not args.fp32,
+                       class_labels=class_labels, threads=args.threads)
+    # One stream on a small CPU: no point in waiting to fill a batch
+    engine = InferenceEngine(model, max_batch_size=1, batch_window_ms=0)
+    publisher = EdgePublisher(out, class_labels, args.stream, args.max_rate)
+
+    client = feed_engine(args.url, engine, publisher, args.stream,
+                         get_profile(args.profile).options(model.names)).start()
+    print(f"Edge detection running on {args.url} ({model.name}{' INT8' if model.int8 else ''}, "
+          f"profile {args.profile}, {args.threads} threads)", file=sys.stderr, flush=True)
+    try:
+        publisher.closed.wait(args.duration)
+    except KeyboardInterrupt:
+        pass
+    client.stop()
+    engine.stop()
+    print(f"Edge detection counters: {publisher.counters}, MJPEG client: {client.counters}, "
+          f"engine: {engine.get_counters()}", file=sys.stderr, flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
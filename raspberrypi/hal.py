@@ -0,0 +1,186 @@
+"""
+Hardware abstraction layer of the Pi controllers.
+
+raspberrypi.py and rasp2.py get their GPIO module, I2C bus and servo kit
+from here instead of importing RPi.GPIO and adafruit_servokit directly.
+With ROBOT_HARDWARE=pi (the default) these are the real libraries,
+imported only when asked for. With ROBOT_HARDWARE=sim they are simulated
+in memory and every actuator write is recorded with its time.perf_counter()
+timestamp in `recorder`, so a controller runs, and can be timed, on any
+Linux box:
+
+    ROBOT_HARDWARE=sim python rasp2.py
+
+command_trace.py uses this to replay recorded command sessions against a
+controller and report dispatch throughput, command-to-actuation latency
+and write counts.
+"""
+
+import os
+import time
+
+from pca9685 import PCA9685, ServoDriver, SimulatedI2C
+
+
+def simulated():
+    """Whether ROBOT_HARDWARE selects the simulation (read when a device is created)."""
+    return os.environ.get('ROBOT_HARDWARE', 'pi').lower() == 'sim'
+
+
+class WriteRecorder:
+    """
+    Timestamped actuator writes of the simulated devices, as
+    (perf_counter, device, target, value) tuples: ('pwm', pin, duty),
+    ('gpio', pin, level) and ('i2c', address, bytes written).
+    """
+
+    def __init__(self):
+        self.writes = []
+
+    def record(self, device, target, value):
+        self.writes.append((time.perf_counter(), device, target, value))
+
+    def clear(self):
+        self.writes.clear()
+
+    def counts(self):
+        """Writes per device, and the bytes sent over I2C."""
+        counts = {'pwm': 0, 'gpio': 0, 'i2c': 0, 'i2c_bytes': 0}
+        for _, device, _, value in self.writes:
+            counts[device] += 1
+            if device == 'i2c':
+                counts['i2c_bytes'] += len(value)
+        return counts
+
+
+recorder = WriteRecorder()
+
+
+class SimulatedPWM:
+    """RPi.GPIO.PWM stand-in recording duty cycle changes."""
+
+    def __init__(self, pin, frequency):
+        self.pin = pin
+        self.frequency = frequency
+        self.duty = 0
+
+    def start(self, duty):
+        self.ChangeDutyCycle(duty)
+
+    def ChangeDutyCycle(self, duty):
+        self.duty = duty
+        recorder.record('pwm', self.pin, duty)
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def stop(self):
+        self.ChangeDutyCycle(0)
+
+
+class SimulatedGPIO:
+    """The part of the RPi.GPIO module the controllers use."""
+
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PWM = SimulatedPWM
+
+    def __init__(self):
+        self.mode = None
+        self.pins = {}
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, enabled):
+        pass
+
+    def setup(self, pin, direction, initial=None):
+        self.pins[pin] = direction
+        if initial is not None:
+            self.output(pin, initial)
+
+    def output(self, pin, level):
+        recorder.record('gpio', pin, level)
+
+    def cleanup(self):
+        self.pins.clear()
+
+
+class RecordingI2C(SimulatedI2C):
+    """SimulatedI2C that also records each transaction."""
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        super().writeto(address, buffer, start=start, end=end)
+        recorder.record('i2c', address, bytes(buffer[start:end]))
+
+
+class _SimulatedChannel:
+    def __init__(self, driver, channel):
+        self._driver = driver
+        self._channel = channel
+        self._angle = None
+        self._throttle = 0.0
+
+    @property
+    def angle(self):
+        return self._angle
+
+    @angle.setter
+    def angle(self, value):
+        self._driver.set_angle(self._channel, value)
+        self._driver.pca.invalidate(self._channel)
+        self._driver.flush()
+        self._angle = value
+
+    @property
+    def throttle(self):
+        return self._throttle
+
+    @throttle.setter
+    def throttle(self, value):
+        self._driver.set_throttle(self._channel, value)
+        self._driver.pca.invalidate(self._channel)
+        self._driver.flush()
+        self._throttle = value
+
+
+class SimulatedServoKit:
+    """
+    adafruit_servokit.ServoKit stand-in on a recorded PCA9685; like
+    ServoKit, every angle or throttle assignment is one I2C write, even
+    when the value does not change.
+    """
+
+    def __init__(self, channels=16, address=0x40, frequency=50):
+        self.driver = ServoDriver(PCA9685(RecordingI2C(), address=address, frequency=frequency))
+        self.servo = [_SimulatedChannel(self.driver, channel) for channel in range(channels)]
+        self.continuous_servo = self.servo
+
+
+def load_gpio():
+    """RPi.GPIO, or its simulation."""
+    if simulated():
+        return SimulatedGPIO()
+    import RPi.GPIO as GPIO
+    return GPIO
+
+
+def i2c_bus():
+    """The Pi's I2C bus (Adafruit Blinka), or a recorded simulation of it."""
+    if simulated():
+        return RecordingI2C()
+    import board
+    return board.I2C()
+
+
+def servo_kit(address, frequency, channels=16):
+    """An adafruit_servokit.ServoKit, or its simulation."""
+    if simulated():
+        return SimulatedServoKit(channels=channels, address=address, frequency=frequency)
+    from adafruit_servokit import ServoKit
+    return ServoKit(channels=channels, address=address, frequency=frequency)
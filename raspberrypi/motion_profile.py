@@ -0,0 +1,148 @@
+"""
+Acceleration- and jerk-limited ramps for the robot's actuators.
+
+A RampGenerator moves one actuator value (a DC motor duty cycle, a
+continuous servo throttle or a servo angle) toward its target without
+exceeding a maximum velocity, acceleration and, optionally, jerk, so the
+motors never jump from standstill to full duty. It is evaluated
+incrementally: the control loop calls step(dt) once per tick and writes
+the returned value, and changing the target mid-move just bends the
+trajectory from the current state. step() is a few microseconds of float
+arithmetic on the generator's slots; no state is kept beyond them.
+
+Units follow the actuator: with a duty cycle in percent, max_velocity is
+in percent per second, max_acceleration in percent per second squared and
+so on. For positional servos the same generator gives an interpolated
+angle sweep instead of a single jump to the target angle.
+
+    ramp = RampGenerator(max_velocity=250, max_acceleration=1500, max_jerk=15000)
+    ramp.set_target(100)
+    while not ramp.done:
+        write_duty(ramp.step(0.01))
+"""
+
+import math
+
+
+class RampGenerator:
+    """
+    Jerk-limited ramp of one value toward a target. Each step picks the
+    most forward acceleration the jerk limit allows from which the
+    jerk-limited stopping distance still fits before the target, so the
+    value slows down ahead of it and arrives without overshooting or
+    backing up; the last step lands on the target at a speed the
+    acceleration limit can cancel within one tick.
+    With resolution set, step() returns the value rounded to that step
+    (e.g. the smallest change the hardware can express) until it ends on
+    the target, so a slow sweep does not produce writes that change nothing.
+    """
+
+    __slots__ = ('value', 'velocity', 'acceleration', 'target',
+                 'max_velocity', 'max_acceleration', 'max_jerk', 'resolution')
+
+    def __init__(self, max_velocity, max_acceleration, max_jerk=None, value=0.0, resolution=None):
+        if max_velocity <= 0 or max_acceleration <= 0 or (max_jerk is not None and max_jerk <= 0):
+            raise ValueError("Ramp limits must be positive")
+        self.max_velocity = float(max_velocity)
+        self.max_acceleration = float(max_acceleration)
+        self.max_jerk = float(max_jerk) if max_jerk else None
+        self.resolution = resolution
+        self.reset(value)
+
+    def reset(self, value):
+        """Jump to value and stand still there (e.g. after an e-stop)."""
+        self.value = self.target = float(value)
+        self.velocity = self.acceleration = 0.0
+
+    def set_target(self, target):
+        self.target = float(target)
+
+    @property
+    def done(self):
+        return self.value == self.target and self.velocity == 0.0
+
+    def output(self):
+        if self.resolution and self.value != self.target:
+            return round(self.value / self.resolution) * self.resolution
+        return self.value
+
+    def step(self, dt):
+        """Advance the ramp by dt seconds and return the new (output) value."""
+        distance = self.target - self.value
+        if distance == 0.0 and self.velocity == 0.0:
+            self.acceleration = 0.0
+            return self.output()
+
+        # Work toward the target in the positive direction
+        sign = 1.0 if distance > 0 or (distance == 0.0 and self.velocity > 0) else -1.0
+        remaining = distance * sign
+        velocity = self.velocity * sign
+        acceleration = self.acceleration * sign
+        max_a = self.max_acceleration
+        jerk = self.max_jerk
+        if jerk:
+            candidates = (acceleration + jerk * dt, acceleration, acceleration - jerk * dt)
+        else:
+            candidates = (max_a, 0.0, -max_a)
+
+        # The most forward of: more, same, less acceleration (within the jerk
+        # limit) that can level off at max_velocity and still stop on the target
+        chosen = None
+        for candidate in candidates:
+            candidate = max(-max_a, min(max_a, candidate))
+            next_velocity = self._next_velocity(velocity, acceleration, candidate, dt)
+            if jerk and candidate > 0 and next_velocity + candidate * candidate / (2 * jerk) > self.max_velocity:
+                continue
+            advance = (velocity + next_velocity) / 2 * dt
+            if advance + self._stopping_distance(next_velocity, candidate) <= remaining:
+                chosen = candidate
+                break
+        if chosen is None:
+            chosen = max(-max_a, candidates[2]) # Brake as hard as allowed
+
+        next_velocity = self._next_velocity(velocity, acceleration, chosen, dt)
+        if velocity >= 0.0 and next_velocity < 0.0:
+            # Stopped short of the target: stand still, never back up
+            next_velocity = chosen = 0.0
+        advance = (velocity + next_velocity) / 2 * dt
+
+        if (advance >= remaining or remaining <= max_a * dt * dt) and max(abs(velocity), abs(next_velocity)) <= max_a * dt:
+            # Close and slow enough to end on the target within one tick's acceleration
+            self.value = self.target
+            self.velocity = self.acceleration = 0.0
+        else:
+            self.value += advance * sign
+            self.velocity = next_velocity * sign
+            self.acceleration = chosen * sign
+        return self.output()
+
+    def _next_velocity(self, velocity, acceleration, candidate, dt):
+        # With a jerk limit the acceleration changes linearly over the tick
+        average = (acceleration + candidate) / 2 if self.max_jerk else candidate
+        return min(self.max_velocity, velocity + average * dt)
+
+    def _stopping_distance(self, velocity, acceleration):
+        """Distance covered until standstill when braking from (velocity, acceleration) within the limits."""
+        if velocity < 0.0:
+            return -self._stopping_distance(-velocity, -acceleration)
+        max_a = self.max_acceleration
+        jerk = self.max_jerk
+        if not jerk:
+            return velocity * velocity / (2 * max_a)
+        if acceleration < 0.0 and acceleration * acceleration / (2 * jerk) >= velocity:
+            # Already braking hard enough: only release the brake
+            t = -acceleration / jerk
+            return max(0.0, velocity * t + acceleration * t * t / 2 + jerk * t ** 3 / 6)
+        # Jerk down to the peak deceleration, hold it if capped, jerk back to zero
+        reserve = velocity + acceleration * acceleration / (2 * jerk)
+        peak = math.sqrt(jerk * reserve)
+        hold = 0.0
+        if peak > max_a:
+            peak = max_a
+            hold = (reserve - max_a * max_a / jerk) / max_a
+        distance = 0.0
+        for t, j in (((acceleration + peak) / jerk, -jerk), (hold, 0.0), (peak / jerk, jerk)):
+            distance += velocity * t + acceleration * t * t / 2 + j * t ** 3 / 6
+            velocity += acceleration * t + j * t * t / 2
+            acceleration += j * t
+        return distance
@@ -0,0 +1,266 @@
+"""
+Batched PCA9685 servo driver.
+
+adafruit_servokit turns every `kit.servo[ch].angle = ...` or
+`kit.continuous_servo[ch].throttle = ...` into its own I2C transaction.
+This driver stages the new pulse widths instead, keeps a shadow copy of
+the 16 channel registers and, on flush(), sends only the channels whose
+registers actually change: runs of neighbouring changed channels go out
+as one auto-increment block write (register pointer + 4 bytes per
+channel), so stopping all arm servos or a coordinated arm move costs one
+bus transaction instead of one per channel.
+
+    driver = ServoDriver(PCA9685(board.I2C(), address=0x40, frequency=50))
+    driver.set_throttle(0, 0.3)
+    driver.set_throttle(1, 0.3)
+    driver.set_angle(3, 90)
+    driver.flush()    # one write for channels 0-1, one for channel 3
+
+The bus only needs the CircuitPython/Blinka writeto(address, buffer)
+method. SimulatedI2C implements it in memory with the PCA9685 register
+auto-increment, and counts transactions and bytes, so the savings can be
+measured without the hardware:
+
+    python pca9685.py
+"""
+
+import time
+
+# Registers
+MODE1 = 0x00
+PRESCALE = 0xFE
+LED0_ON_L = 0x06
+
+# MODE1 bits
+MODE1_RESTART = 0x80
+MODE1_AI = 0x20 # Register auto-increment
+MODE1_SLEEP = 0x10
+MODE1_ALLCALL = 0x01
+
+OSCILLATOR_HZ = 25_000_000
+OSCILLATOR_STARTUP_S = 0.0005 # Oscillator run time needed after leaving sleep before RESTART
+COUNTS = 4096
+FULL_OFF = 0x1000 # Bit 4 of LEDn_OFF_H
+
+CHANNELS = 16
+BYTES_PER_CHANNEL = 4
+
+# Largest block written in one transaction (register byte excluded); SMBus
+# block writes are limited to 32 bytes, i.e. 8 channels
+DEFAULT_MAX_BLOCK = 32
+
+# Unchanged channels between two changed ones that are still rewritten to
+# save a transaction (4 extra bytes instead of a new start, address and
+# register byte)
+DEFAULT_MERGE_GAP = 1
+
+# Pulse range of adafruit_motor's servo and continuous servo defaults
+DEFAULT_MIN_PULSE_US = 750
+DEFAULT_MAX_PULSE_US = 2250
+DEFAULT_ACTUATION_RANGE = 180
+
+
+class PCA9685:
+    """
+    PCA9685 with shadow registers. set_counts() only stages a channel;
+    flush() writes the staged channels that differ from what the chip holds.
+    """
+
+    def __init__(self, i2c, address=0x40, frequency=50, max_block=DEFAULT_MAX_BLOCK,
+                 merge_gap=DEFAULT_MERGE_GAP):
+        self.i2c = i2c
+        self.address = address
+        self.max_channels = max(1, max_block // BYTES_PER_CHANNEL)
+        self.merge_gap = merge_gap
+        # What the chip holds (valid where _known is set) and what it should hold
+        self._shadow = bytearray(CHANNELS * BYTES_PER_CHANNEL)
+        self._staged = bytearray(CHANNELS * BYTES_PER_CHANNEL)
+        self._known = [False] * CHANNELS
+        self._dirty = [False] * CHANNELS
+        self.counters = {'transactions': 0, 'bytes': 0, 'channels_written': 0, 'channels_skipped': 0}
+        self.frequency = frequency
+        self._set_frequency(frequency)
+
+    def _write(self, data):
+        self.i2c.writeto(self.address, data)
+        self.counters['transactions'] += 1
+        self.counters['bytes'] += len(data)
+
+    def _set_frequency(self, frequency):
+        prescale = int(round(OSCILLATOR_HZ / (COUNTS * frequency))) - 1
+        if not 3 <= prescale <= 255:
+            raise ValueError(f"PCA9685 frequency {frequency} Hz out of range")
+        # The prescaler can only be written while the oscillator sleeps; after
+        # waking, the oscillator must run 500 us before RESTART may be set
+        self._write(bytes((MODE1, MODE1_SLEEP | MODE1_ALLCALL)))
+        self._write(bytes((PRESCALE, prescale)))
+        self._write(bytes((MODE1, MODE1_AI | MODE1_ALLCALL)))
+        time.sleep(OSCILLATOR_STARTUP_S)
+        self._write(bytes((MODE1, MODE1_RESTART | MODE1_AI | MODE1_ALLCALL)))
+
+    def set_counts(self, channel, on, off):
+        """Stage a channel's ON and OFF counts (OFF may include FULL_OFF)."""
+        i = channel * BYTES_PER_CHANNEL
+        staged = self._staged
+        staged[i] = on & 0xFF
+        staged[i + 1] = on >> 8
+        staged[i + 2] = off & 0xFF
+        staged[i + 3] = off >> 8
+        self._dirty[channel] = True
+
+    def set_pulse_us(self, channel, pulse_us):
+        """Stage a pulse width in microseconds; None turns the channel fully off."""
+        if pulse_us is None:
+            self.set_counts(channel, 0, FULL_OFF)
+        else:
+            counts = int(round(pulse_us * self.frequency * COUNTS / 1_000_000))
+            self.set_counts(channel, 0, max(0, min(COUNTS - 1, counts)))
+
+    def invalidate(self, channel=None):
+        """Forget what the chip holds (one channel or all), so the next flush rewrites it."""
+        for i in (range(CHANNELS) if channel is None else (channel,)):
+            self._known[i] = False
+            self._dirty[i] = True
+
+    def _changed(self, channel):
+        if not self._dirty[channel]:
+            return False
+        if self._known[channel]:
+            i = channel * BYTES_PER_CHANNEL
+            if self._staged[i:i + BYTES_PER_CHANNEL] == self._shadow[i:i + BYTES_PER_CHANNEL]:
+                self._dirty[channel] = False
+                self.counters['channels_skipped'] += 1
+                return False
+        return True
+
+    def flush(self):
+        """Write the changed channels, neighbours in one block; returns the number of transactions."""
+        changed = [channel for channel in range(CHANNELS) if self._changed(channel)]
+        if not changed:
+            return 0
+
+        # Group into runs, bridging small gaps and splitting at the block size
+        runs = []
+        start = end = changed[0]
+        for channel in changed[1:]:
+            if channel - end - 1 <= self.merge_gap and channel - start < self.max_channels:
+                end = channel
+            else:
+                runs.append((start, end))
+                start = end = channel
+        runs.append((start, end))
+
+        for start, end in runs:
+            i, j = start * BYTES_PER_CHANNEL, (end + 1) * BYTES_PER_CHANNEL
+            self._write(bytes((LED0_ON_L + i,)) + self._staged[i:j])
+            self._shadow[i:j] = self._staged[i:j]
+            for channel in range(start, end + 1):
+                self._known[channel] = True
+                self._dirty[channel] = False
+            self.counters['channels_written'] += end - start + 1
+        return len(runs)
+
+
+class ServoDriver:
+    """
+    Angle and throttle control of servos on a PCA9685, with the pulse
+    ranges of adafruit_servokit; updates are staged until flush().
+    """
+
+    def __init__(self, pca, min_pulse_us=DEFAULT_MIN_PULSE_US, max_pulse_us=DEFAULT_MAX_PULSE_US,
+                 actuation_range=DEFAULT_ACTUATION_RANGE):
+        self.pca = pca
+        self.min_pulse_us = min_pulse_us
+        self.max_pulse_us = max_pulse_us
+        self.actuation_range = actuation_range
+
+    def set_angle(self, channel, angle):
+        """Stage an angle in degrees; None relaxes the servo (no pulses)."""
+        if angle is None:
+            self.pca.set_pulse_us(channel, None)
+            return
+        if not 0 <= angle <= self.actuation_range:
+            raise ValueError(f"Angle {angle} out of range 0-{self.actuation_range}")
+        fraction = angle / self.actuation_range
+        self.pca.set_pulse_us(channel, self.min_pulse_us + fraction * (self.max_pulse_us - self.min_pulse_us))
+
+    def set_throttle(self, channel, throttle):
+        """Stage a continuous servo throttle in [-1, 1]."""
+        if not -1 <= throttle <= 1:
+            raise ValueError(f"Throttle {throttle} out of range -1 to 1")
+        fraction = (throttle + 1) / 2
+        self.pca.set_pulse_us(channel, self.min_pulse_us + fraction * (self.max_pulse_us - self.min_pulse_us))
+
+    def flush(self):
+        return self.pca.flush()
+
+    @property
+    def counters(self):
+        return self.pca.counters
+
+
+class SimulatedI2C:
+    """
+    In-memory I2C bus with PCA9685-like devices: each write sets the
+    register pointer from its first byte and stores the rest, advancing
+    the pointer when MODE1 has auto-increment on. Counts transactions and
+    bytes sent.
+    """
+
+    def __init__(self):
+        self.registers = {}
+        self.transactions = 0
+        self.bytes_sent = 0
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        data = bytes(buffer[start:end])
+        self.transactions += 1
+        self.bytes_sent += len(data)
+        registers = self.registers.setdefault(address, bytearray(256))
+        if not data:
+            return
+        pointer = data[0]
+        for value in data[1:]:
+            registers[pointer] = value
+            if registers[MODE1] & MODE1_AI:
+                pointer = (pointer + 1) & 0xFF
+
+    def channel_counts(self, address, channel):
+        """(on, off) counts held by a channel of the device at address."""
+        registers = self.registers.get(address, bytearray(256))
+        i = LED0_ON_L + channel * BYTES_PER_CHANNEL
+        return registers[i] | registers[i + 1] << 8, registers[i + 2] | registers[i + 3] << 8
+
+
+def main():
+    """Compare bus traffic of per-channel writes with batched flushes on typical arm updates."""
+    updates = [
+        ("stop all arm servos", {0: ('throttle', 0.067), 1: ('throttle', 0.067), 2: ('throttle', 0.067), 3: ('angle', None)}),
+        ("coordinated arm move", {0: ('throttle', 0.3), 1: ('throttle', -0.3), 2: ('throttle', 0.3), 3: ('angle', 120)}),
+        ("one servo changes", {0: ('throttle', 0.3), 1: ('throttle', -0.3), 2: ('throttle', 0.067), 3: ('angle', 120)}),
+        ("nothing changes", {0: ('throttle', 0.3), 1: ('throttle', -0.3), 2: ('throttle', 0.067), 3: ('angle', 120)}),
+    ]
+    for batched in (False, True):
+        bus = SimulatedI2C()
+        driver = ServoDriver(PCA9685(bus))
+        setup_transactions, setup_bytes = bus.transactions, bus.bytes_sent
+        print("Batched flushes:" if batched else "One transaction per channel update (like adafruit_servokit):")
+        for name, channels in updates:
+            before = bus.transactions, bus.bytes_sent
+            for channel, (kind, value) in channels.items():
+                if kind == 'angle':
+                    driver.set_angle(channel, value)
+                else:
+                    driver.set_throttle(channel, value)
+                if not batched:
+                    # Unconditional write of this channel alone
+                    driver.pca.invalidate(channel)
+                    driver.flush()
+            driver.flush()
+            print(f"  {name:<22} {bus.transactions - before[0]:>2} transactions, {bus.bytes_sent - before[1]:>3} bytes")
+        print(f"  total (excluding setup: {setup_transactions} transactions, {setup_bytes} bytes): "
+              f"{bus.transactions - setup_transactions} transactions, {bus.bytes_sent - setup_bytes} bytes")
+
+
+if __name__ == "__main__":
+    main()
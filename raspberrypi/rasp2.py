@@ -1,9 +1,30 @@
-import websocket
+# Raspberry Pi robot controller, on an asyncio event loop: the WebSocket
+# receive path, the actuation of motors and servos, the automatic sequence
+# and the optional edge detector run as independent tasks, so an e-stop is
+# handled within milliseconds even while a sequence runs, and a sequence
+# can be cancelled at any await point.
+#
+# Pi dependencies: websockets (the asyncio client, `pip install websockets`,
+# not the websocket-client package of the older raspberrypi.py), RPi.GPIO
+# and adafruit-blinka for the I2C bus of the PCA9685, which pca9685.py
+# drives directly (adafruit_servokit is not used). With ROBOT_HARDWARE=sim
+# only websockets is needed (see hal.py).
+import asyncio
+import websockets
 import json
+import os
+import shlex
+import sys
 import time
 import logging
-import RPi.GPIO as GPIO
-from adafruit_servokit import ServoKit
+from collections import deque
+from functools import partial
+import hal
+from pca9685 import PCA9685, ServoDriver
+from motion_profile import RampGenerator
+from command_trace import TraceWriter
+
+GPIO = hal.load_gpio() # RPi.GPIO, or simulated with ROBOT_HARDWARE=sim
 # import sys # No longer needed for command-line mode selection
 
 # Set up logging
@@ -13,6 +34,9 @@ logger = logging.getLogger(__name__)
 
 # WebSocket server URL
 SERVER_URL = "ws://192.168.12.1:3000/robot" # Replace if different
+WS_RECONNECT_DELAY_S = 5
+WS_OUTGOING_QUEUE_SIZE = 100 # Messages to the server waiting to be sent; newer ones are dropped beyond this
+COMMAND_TRACE_PATH = os.environ.get('COMMAND_TRACE', '') # Record received messages here, for command_trace.py replays
 
 # --- DC Motor (Base Locomotion) Configuration ---
 PIN_RIGHT_MOTORS_LPWM = 20
@@ -41,12 +65,94 @@ POSITIONAL_SERVO_S1_INITIAL_ANGLE = 90.0
 POSITIONAL_SERVO_S1_MIN_ANGLE = 0.0  # Min angle for clamping
 POSITIONAL_SERVO_S1_MAX_ANGLE = 180.0 # Max angle for clamping (ServoKit default actuation_range)
 
+# --- Motion Profiles (see motion_profile.py) ---
+# Commands set a target; the actuation loop ramps each actuator toward it
+# within these limits (velocity per s, acceleration per s², jerk per s³).
+# E-stops and 'stop' defect reactions still cut the motors at once.
+BASE_RAMP_LIMITS = {'max_velocity': 250, 'max_acceleration': 1500, 'max_jerk': 15000} # Duty % per side: 0 -> 100% in ~0.65 s
+SERVO_THROTTLE_RAMP_LIMITS = {'max_velocity': 2.0, 'max_acceleration': 12.0, 'max_jerk': 150.0} # Continuous servo throttle
+S1_SWEEP_LIMITS = {'max_velocity': 120, 'max_acceleration': 600, 'max_jerk': 6000, 'resolution': 0.5} # Degrees
+
+# --- Edge Detection (optional) ---
+# With EDGE_DETECTION=1 the bolt detector runs on the Pi itself
+# (edge_detector.py, in its own process) on the ESP32-CAM stream, and its
+# compact results are published over the /robot WebSocket.
+EDGE_DETECTION_ENABLED = os.environ.get('EDGE_DETECTION', '0') == '1'
+EDGE_DETECTOR_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'edge_detector.py')
+EDGE_DETECTOR_ARGS = shlex.split(os.environ.get('EDGE_DETECTOR_ARGS', '')) # e.g. "--backend stub"
+EDGE_RESTART_DELAY_S = 5
+
+# --- Defect-Triggered Reaction (automatic mode) ---
+# Detections of these classes at or above DEFECT_MIN_CONFIDENCE, from the
+# edge detector or the server, trigger DEFECT_REACTION while the automatic
+# sequence runs: 'stop' aborts the sequence, 'dwell' holds the robot for
+# DEFECT_DWELL_S then resumes, 'log' only records the defect and position.
+DEFECT_CLASSES = ('Boulon_Mauvais', 'fp-bolt-missing')
+DEFECT_MIN_CONFIDENCE = float(os.environ.get('DEFECT_MIN_CONFIDENCE', 0.6))
+DEFECT_REACTION = os.environ.get('DEFECT_REACTION', 'dwell').lower()
+DEFECT_DWELL_S = float(os.environ.get('DEFECT_DWELL_S', 3))
+DEFECT_LATENCY_BUDGET_MS = float(os.environ.get('DEFECT_LATENCY_BUDGET_MS', 300)) # Capture to actuation
+DEFECT_COOLDOWN_S = 2.0 # Ignore further triggers for this long (same bolt still in view)
+
+# --- Actuation Loop, Hot-Path Logging and Counters ---
+ACTUATION_RATE_HZ = float(os.environ.get('ACTUATION_RATE_HZ', 100)) # Setpoints applied per second at most
+HOT_LOG_INTERVAL_S = 1.0 # At most one log line per actuator per interval; repeats are counted
+CONTROLLER_STATS_INTERVAL_S = 10 # Period of the controller_stats message to the server
+
 # --- Global PWM Objects (DC Motors) ---
 pwm_right_lpwm, pwm_right_rpwm, pwm_left_lpwm, pwm_left_rpwm = None, None, None, None
 
-# --- Global ServoKit Object (Arm Servos) ---
+# --- Global Servo Driver (Arm Servos) ---
+# pca9685.ServoDriver: servo writes are staged and sent to the PCA9685 by
+# flush_servo_writes(), once per actuation tick or right away for a stop.
 kit = None
 
+# --- Cached Actuator State ---
+# Last value written to each PWM pin and PCA9685 channel: a command that
+# would write the same value again causes no GPIO write or servo update.
+pwm_duty_cache = {} # PWM object -> duty cycle
+servo_throttle_cache = {} # Continuous servo channel -> throttle
+servo_angle_cache = {} # Positional servo channel -> angle (None: relaxed)
+base_state = None # (direction, speed) of the last base command actually applied
+
+# --- Motion Profile State (created in setup_motion_profiles()) ---
+base_ramps = {} # 'right'/'left' -> RampGenerator of the signed duty cycle of that side
+servo_ramps = {} # Channel -> RampGenerator of the throttle or angle
+profile_outputs = () # (ramp, apply(value)) pairs stepped by the actuation loop
+
+controller_counters = {
+    'messages': {}, # Per message type
+    'unknown_messages': 0,
+    'dispatch_ms': 0.0, # Total time spent in message handlers
+    'gpio_writes': 0, 'gpio_skipped': 0,
+    'i2c_writes': 0, 'i2c_skipped': 0,
+    'logs_suppressed': 0,
+}
+_hot_log_state = {} # Log key -> (time of last line, lines suppressed since)
+
+# --- Global Controller State (asyncio; created in main()) ---
+current_ws = None # Set while connected to the server
+outgoing_queue = None # Messages for the server, sent by the connection's sender task
+command_trace = None # TraceWriter when COMMAND_TRACE is set
+
+# --- Global Actuation Loop State ---
+pending_setpoints = {} # Actuator -> latest (received_at, function, args), applied on the next tick
+actuation_stats = {'ticks': 0, 'overruns': 0, 'missed_ticks': 0, 'applied': 0, 'coalesced': 0,
+                   'command_latency_ms_max': 0.0}
+actuation_jitter_ms = deque(maxlen=1000) # Lateness of the recent ticks
+
+# --- Global Automatic Sequence State ---
+sequence_task = None
+sequence_wake_event = None # Wakes sequence_sleep() when a dwell starts
+sequence_motion = None # (kind, target, direction, speed) being driven by the sequence
+sequence_motion_started = 0.0
+sequence_dwell_started = 0.0
+sequence_dwell_until = 0.0
+sequence_step = ""
+sequence_travel_s = 0.0 # Dead reckoning of the base, in seconds of travel at sequence speed
+last_defect_trigger = 0.0
+defect_latencies = [] # Capture-to-actuation latency of each trigger (ms)
+
 # --- Setup Functions ---
 def setup_dc_motors_gpio():
     global pwm_right_lpwm, pwm_right_rpwm, pwm_left_lpwm, pwm_left_rpwm
@@ -67,20 +173,22 @@ def setup_dc_motors_gpio():
         logger.error(f"Error initializing RPi.GPIO PWM for DC motors: {e}")
         raise
     pwm_right_lpwm.start(0); pwm_right_rpwm.start(0); pwm_left_lpwm.start(0); pwm_left_rpwm.start(0)
+    for pwm in (pwm_right_lpwm, pwm_right_rpwm, pwm_left_lpwm, pwm_left_rpwm):
+        pwm_duty_cache[pwm] = 0
     logger.info("DC Motor GPIO and RPi.GPIO PWM initialized.")
 
 def setup_arm_servos():
     global kit
     logger.info("Setting up ServoKit for Arm Servos...")
     try:
-        kit = ServoKit(channels=16, address=SERVO_PCA_ADDRESS, frequency=SERVO_PWM_FREQUENCY)
+        kit = ServoDriver(PCA9685(hal.i2c_bus(), address=SERVO_PCA_ADDRESS, frequency=SERVO_PWM_FREQUENCY))
         logger.info(f"ServoKit initialized (PCA9685 on I2C addr 0x{SERVO_PCA_ADDRESS:02X}, Freq: {SERVO_PWM_FREQUENCY}Hz).")
 
         # Initialize Continuous Rotation Servos
         for motor_id in CONTINUOUS_SERVO_CHANNELS_ARM:
             if motor_id in CALIBRATED_STOP_THROTTLES:
                 stop_throttle = CALIBRATED_STOP_THROTTLES[motor_id]
-                kit.continuous_servo[motor_id].throttle = stop_throttle
+                set_servo_throttle(motor_id, stop_throttle, force=True)
                 logger.info(f"  Continuous servo on channel {motor_id} initialized to stop throttle: {stop_throttle:.4f}")
             else:
                 logger.warning(f"  No calibrated stop throttle for continuous servo {motor_id}.")
@@ -89,10 +197,11 @@ def setup_arm_servos():
         try:
             # Clamp initial angle just in case
             angle_to_set = max(POSITIONAL_SERVO_S1_MIN_ANGLE, min(POSITIONAL_SERVO_S1_MAX_ANGLE, POSITIONAL_SERVO_S1_INITIAL_ANGLE))
-            kit.servo[POSITIONAL_SERVO_CHANNEL_S1].angle = angle_to_set
+            set_servo_angle(POSITIONAL_SERVO_CHANNEL_S1, angle_to_set, force=True)
             logger.info(f"  Positional servo on channel {POSITIONAL_SERVO_CHANNEL_S1} initialized to {angle_to_set:.1f}°.")
         except Exception as e:
             logger.error(f"  Error setting initial angle for positional servo {POSITIONAL_SERVO_CHANNEL_S1}: {e}")
+        flush_servo_writes()
 
     except ValueError as e:
         logger.error(f"Error initializing ServoKit (PCA9685): {e}.")
@@ -101,17 +210,115 @@ def setup_arm_servos():
         logger.error(f"Unexpected error initializing ServoKit: {e}")
         kit = None
 
-# --- Control Functions ---
-def set_dc_motor_speed(pwm_pin_forward, pwm_pin_backward, direction, speed):
-    if direction == 1: pwm_pin_forward.ChangeDutyCycle(speed); pwm_pin_backward.ChangeDutyCycle(0)
-    elif direction == -1: pwm_pin_forward.ChangeDutyCycle(0); pwm_pin_backward.ChangeDutyCycle(speed)
-    else: pwm_pin_forward.ChangeDutyCycle(0); pwm_pin_backward.ChangeDutyCycle(0)
+def setup_motion_profiles():
+    global profile_outputs
+    outputs = []
+    if all([pwm_right_lpwm, pwm_right_rpwm, pwm_left_lpwm, pwm_left_rpwm]):
+        base_ramps['right'] = RampGenerator(**BASE_RAMP_LIMITS)
+        base_ramps['left'] = RampGenerator(**BASE_RAMP_LIMITS)
+        outputs.append((base_ramps['right'], partial(apply_base_side, pwm_right_rpwm, pwm_right_lpwm)))
+        outputs.append((base_ramps['left'], partial(apply_base_side, pwm_left_rpwm, pwm_left_lpwm)))
+    if kit is not None:
+        for motor_id in CONTINUOUS_SERVO_CHANNELS_ARM:
+            servo_ramps[motor_id] = RampGenerator(**SERVO_THROTTLE_RAMP_LIMITS,
+                                                  value=CALIBRATED_STOP_THROTTLES.get(motor_id, 0.0))
+            outputs.append((servo_ramps[motor_id], partial(apply_servo_throttle, motor_id)))
+        servo_ramps[POSITIONAL_SERVO_CHANNEL_S1] = RampGenerator(**S1_SWEEP_LIMITS, value=POSITIONAL_SERVO_S1_INITIAL_ANGLE)
+        outputs.append((servo_ramps[POSITIONAL_SERVO_CHANNEL_S1], partial(apply_servo_angle, POSITIONAL_SERVO_CHANNEL_S1)))
+    profile_outputs = tuple(outputs)
+    logger.info(f"Motion profiles ready for {len(profile_outputs)} actuators.")
+
+def step_motion_profiles(dt):
+    """Advance every moving ramp by dt seconds and write its new value."""
+    for ramp, apply in profile_outputs:
+        if not ramp.done:
+            apply(ramp.step(dt))
+
+def apply_base_side(pwm_forward, pwm_backward, value):
+    set_dc_motor_speed(pwm_forward, pwm_backward, 1 if value > 0 else -1 if value < 0 else 0, round(abs(value), 1))
+
+def apply_servo_throttle(channel, value):
+    try:
+        set_servo_throttle(channel, round(value, 4))
+    except Exception as e:
+        log_hot(('servo_error', channel), f"ARM_SERVO: Error setting throttle for continuous motor {channel}: {e}", logging.ERROR)
+
+def apply_servo_angle(channel, value):
+    try:
+        set_servo_angle(channel, value)
+    except Exception as e:
+        log_hot(('servo_error', channel), f"ARM_SERVO: Error setting angle for servo {channel}: {e}", logging.ERROR)
+
+# --- Hot-Path Logging ---
+def log_hot(key, message, level=logging.INFO):
+    """Log at most one line per HOT_LOG_INTERVAL_S for this key; the lines in between are counted."""
+    now = time.monotonic()
+    last, suppressed = _hot_log_state.get(key, (0.0, 0))
+    if now - last < HOT_LOG_INTERVAL_S:
+        _hot_log_state[key] = (last, suppressed + 1)
+        controller_counters['logs_suppressed'] += 1
+        return
+    _hot_log_state[key] = (now, 0)
+    if suppressed:
+        message = f"{message} ({suppressed} similar lines suppressed)"
+    logger.log(level, message)
+
+def controller_stats():
+    return dict(controller_counters, messages=dict(controller_counters['messages']),
+                dispatch_ms=round(controller_counters['dispatch_ms'], 2),
+                actuation=actuation_loop_stats(),
+                i2c_bus=dict(kit.counters) if kit is not None else None)
+
+# --- Cached Writes ---
+def set_pwm_duty(pwm, duty, force=False):
+    if not force and pwm_duty_cache.get(pwm) == duty:
+        controller_counters['gpio_skipped'] += 1
+        return
+    pwm.ChangeDutyCycle(duty)
+    pwm_duty_cache[pwm] = duty
+    controller_counters['gpio_writes'] += 1
+
+def set_servo_throttle(channel, throttle, force=False):
+    if not force and servo_throttle_cache.get(channel) == throttle:
+        controller_counters['i2c_skipped'] += 1
+        return
+    kit.set_throttle(channel, throttle)
+    servo_throttle_cache[channel] = throttle
+    controller_counters['i2c_writes'] += 1
+
+def set_servo_angle(channel, angle, force=False):
+    if not force and channel in servo_angle_cache and servo_angle_cache[channel] == angle:
+        controller_counters['i2c_skipped'] += 1
+        return
+    kit.set_angle(channel, angle)
+    servo_angle_cache[channel] = angle
+    controller_counters['i2c_writes'] += 1
 
-def all_dc_motors_stop():
-    logger.info("DC_MOTORS COMMAND: All motors stop")
+def flush_servo_writes():
+    """Send the staged servo writes to the PCA9685, changed neighbouring channels in one block write."""
+    if kit is None:
+        return
+    try:
+        kit.flush()
+    except Exception as e:
+        log_hot('servo_flush_error', f"ARM_SERVO: Error writing to the PCA9685: {e}", logging.ERROR)
+
+# --- Control Functions ---
+def set_dc_motor_speed(pwm_pin_forward, pwm_pin_backward, direction, speed, force=False):
+    if direction == 1: set_pwm_duty(pwm_pin_forward, speed, force); set_pwm_duty(pwm_pin_backward, 0, force)
+    elif direction == -1: set_pwm_duty(pwm_pin_forward, 0, force); set_pwm_duty(pwm_pin_backward, speed, force)
+    else: set_pwm_duty(pwm_pin_forward, 0, force); set_pwm_duty(pwm_pin_backward, 0, force)
+
+def all_dc_motors_stop(force=False):
+    """Cut the DC motors at once, without a ramp (e-stop, defect stop, shutdown)."""
+    global base_state
+    log_hot('dc_stop', "DC_MOTORS COMMAND: All motors stop")
+    for ramp in base_ramps.values():
+        ramp.reset(0)
     if all([pwm_right_rpwm, pwm_right_lpwm, pwm_left_rpwm, pwm_left_lpwm]):
-        set_dc_motor_speed(pwm_right_rpwm, pwm_right_lpwm, 0, 0)
-        set_dc_motor_speed(pwm_left_rpwm, pwm_left_lpwm, 0, 0)
+        set_dc_motor_speed(pwm_right_rpwm, pwm_right_lpwm, 0, 0, force)
+        set_dc_motor_speed(pwm_left_rpwm, pwm_left_lpwm, 0, 0, force)
+        base_state = ("stop", 0)
     else: logger.warning("DC_MOTORS: RPi.GPIO PWM objects not initialized.")
 
 def cleanup_dc_motors_gpio():
@@ -151,11 +358,19 @@ def control_continuous_servo(motor_id, value_direction_str, is_active): # Rename
             # target_throttle remains stop_throttle
         direction_log_text = f"(Throttle: {target_throttle:.4f})"
     
-    logger.info(f"ARM_SERVO CMD (Continuous): Motor {motor_id} {action_description} {direction_log_text}")
-    try:
-        kit.continuous_servo[motor_id].throttle = target_throttle
-    except Exception as e:
-        logger.error(f"ARM_SERVO CMD: Error setting throttle for continuous motor {motor_id}: {e}")
+    ramp = servo_ramps[motor_id]
+    if ramp.target == target_throttle:
+        controller_counters['i2c_skipped'] += 1
+        return # Already running, or ramping, that way
+    log_hot(('servo', motor_id), f"ARM_SERVO CMD (Continuous): Motor {motor_id} {action_description} {direction_log_text}")
+    ramp.set_target(target_throttle)
+
+def stop_continuous_servo_now(motor_id):
+    """Stop a continuous servo at once, without a ramp (the caller flushes the write)."""
+    stop_throttle = CALIBRATED_STOP_THROTTLES.get(motor_id, 0.0)
+    if motor_id in servo_ramps:
+        servo_ramps[motor_id].reset(stop_throttle)
+    set_servo_throttle(motor_id, stop_throttle, force=True)
 
 def set_positional_servo_angle(channel, target_angle):
     global kit
@@ -168,8 +383,15 @@ def set_positional_servo_angle(channel, target_angle):
         if abs(clamped_target_angle - float(target_angle)) > 0.01: # Check if clamping occurred
             logger.warning(f"ARM_SERVO CMD (Positional): Target angle {target_angle}° for servo {channel} was clamped to {clamped_target_angle:.1f}°.")
         
-        logger.info(f"ARM_SERVO CMD (Positional): Moving servo {channel} to {clamped_target_angle:.1f}°...")
-        kit.servo[channel].angle = clamped_target_angle
+        sweep = servo_ramps[channel]
+        if sweep.target == clamped_target_angle and servo_angle_cache.get(channel) is not None:
+            controller_counters['i2c_skipped'] += 1
+            return # Already there, or sweeping there
+        log_hot(('servo', channel), f"ARM_SERVO CMD (Positional): Sweeping servo {channel} to {clamped_target_angle:.1f}°...")
+        sweep.set_target(clamped_target_angle)
+        if servo_angle_cache.get(channel) is None:
+            # Relaxed: the sweep starts from the last commanded angle, write it to hold the servo there
+            set_servo_angle(channel, sweep.output())
     except ValueError:
         logger.error(f"ARM_SERVO CMD (Positional): Invalid angle format '{target_angle}' for servo {channel}.")
     except Exception as e:
@@ -182,10 +404,9 @@ def all_arm_servos_stop(): # Now handles both types for "stop" or "relax"
         logger.info("ARM_SERVO COMMAND: Stopping/relaxing all defined arm servos.")
         # Stop continuous servos
         for motor_id in CONTINUOUS_SERVO_CHANNELS_ARM:
-            stop_throttle = CALIBRATED_STOP_THROTTLES.get(motor_id, 0.0)
             try:
-                kit.continuous_servo[motor_id].throttle = stop_throttle
-                logger.debug(f"  Continuous servo {motor_id} throttle set to {stop_throttle:.4f}")
+                stop_continuous_servo_now(motor_id)
+                logger.debug(f"  Continuous servo {motor_id} stopped")
             except Exception as e:
                 logger.error(f"  Error stopping continuous servo {motor_id}: {e}")
         
@@ -193,56 +414,227 @@ def all_arm_servos_stop(): # Now handles both types for "stop" or "relax"
         try:
             if POSITIONAL_SERVO_CHANNEL_S1 is not None: # Check if it's defined
                  logger.debug(f"  Relaxing positional servo {POSITIONAL_SERVO_CHANNEL_S1} (angle=None).")
-                 kit.servo[POSITIONAL_SERVO_CHANNEL_S1].angle = None
+                 if POSITIONAL_SERVO_CHANNEL_S1 in servo_ramps:
+                     sweep = servo_ramps[POSITIONAL_SERVO_CHANNEL_S1]
+                     sweep.reset(sweep.value) # Stop the sweep where it is
+                 set_servo_angle(POSITIONAL_SERVO_CHANNEL_S1, None, force=True)
         except Exception as e:
             logger.error(f"  Error relaxing positional servo {POSITIONAL_SERVO_CHANNEL_S1}: {e}")
+        flush_servo_writes() # Stops and relax go out together
     else:
         logger.info("ARM_SERVO COMMAND: ServoKit not initialized.")
 
 def move_robot_base(direction, is_active, speed=DEFAULT_DC_SPEED):
-    # ... (This function remains unchanged from your last version) ...
-    logger.info(f"DC_MOTORS CMD: Direction: {direction}, Active: {is_active}, Speed: {speed}")
+    global base_state
     if not all([pwm_right_lpwm, pwm_right_rpwm, pwm_left_lpwm, pwm_left_rpwm]):
         logger.error("DC_MOTORS: RPi.GPIO PWM objects not initialized."); return
-    if not is_active: all_dc_motors_stop(); return
-    if direction == "forward": set_dc_motor_speed(pwm_right_rpwm, pwm_right_lpwm, 1, speed); set_dc_motor_speed(pwm_left_rpwm, pwm_left_lpwm, 1, speed)
-    elif direction == "backward": set_dc_motor_speed(pwm_right_rpwm, pwm_right_lpwm, -1, speed); set_dc_motor_speed(pwm_left_rpwm, pwm_left_lpwm, -1, speed)
-    elif direction == "right": set_dc_motor_speed(pwm_left_rpwm, pwm_left_lpwm, 1, speed); set_dc_motor_speed(pwm_right_rpwm, pwm_right_lpwm, -1, speed)
-    elif direction == "left": set_dc_motor_speed(pwm_right_rpwm, pwm_right_lpwm, 1, speed); set_dc_motor_speed(pwm_left_rpwm, pwm_left_lpwm, -1, speed)
-    elif direction == "stop": all_dc_motors_stop()
-    else: logger.warning(f"DC_MOTORS: Unknown direction: {direction}."); all_dc_motors_stop()
-
-def run_automatic_base_sequence():
-    logger.info("AUTOMATIC MODE: Sequence started (this will block other WebSocket commands).")
+    target_state = (direction, speed) if is_active and direction in ("forward", "backward", "right", "left") else ("stop", 0)
+    if target_state == base_state:
+        controller_counters['gpio_skipped'] += 4
+        return # Repeated command (e.g. joystick held): nothing to write
+    log_hot('base', f"DC_MOTORS CMD: Direction: {direction}, Active: {is_active}, Speed: {speed}")
+    if is_active and target_state[0] == "stop" and direction != "stop":
+        logger.warning(f"DC_MOTORS: Unknown direction: {direction}.")
+    base_state = target_state
+    # Signed duty cycle of each side; the actuation loop ramps to it
+    if target_state[0] == "forward": right, left = speed, speed
+    elif target_state[0] == "backward": right, left = -speed, -speed
+    elif target_state[0] == "right": right, left = -speed, speed
+    elif target_state[0] == "left": right, left = speed, -speed
+    else: right, left = 0, 0
+    base_ramps['right'].set_target(right)
+    base_ramps['left'].set_target(left)
+
+# --- Actuation ---
+# Motor and servo commands from the WebSocket only update the setpoint of
+# their actuator; actuation_loop() applies the latest setpoint of each
+# actuator once per tick, at ACTUATION_RATE_HZ on the monotonic clock, and
+# advances the motion profiles toward the resulting targets. A
+# burst of messages therefore costs at most one write per actuator per
+# tick, however fast clients send. An e-stop or a defect reaction preempts
+# the loop: pending setpoints are dropped and the motors stopped directly.
+def set_setpoint(actuator, function, *args, received_at=None):
+    """Replace the pending setpoint of actuator ('base' or ('servo', channel))."""
+    if actuator in pending_setpoints:
+        actuation_stats['coalesced'] += 1
+    pending_setpoints[actuator] = (received_at or time.perf_counter(), function, args)
+
+def drop_pending_actuation():
+    if pending_setpoints:
+        logger.info(f"ACTUATION: Dropped {len(pending_setpoints)} pending setpoint(s).")
+        pending_setpoints.clear()
+
+def apply_setpoints():
+    global pending_setpoints
+    setpoints, pending_setpoints = pending_setpoints, {}
+    now = time.perf_counter()
+    for actuator, (received_at, function, args) in setpoints.items():
+        try:
+            function(*args)
+        except Exception as e:
+            logger.error(f"ACTUATION: Error in {function.__name__}{args}: {e}")
+        actuation_stats['applied'] += 1
+        latency_ms = (now - received_at) * 1000
+        actuation_stats['command_latency_ms_max'] = max(actuation_stats['command_latency_ms_max'], latency_ms)
+
+async def actuation_loop():
+    period = 1 / ACTUATION_RATE_HZ
+    last_tick = time.monotonic()
+    next_tick = last_tick + period
+    while True:
+        delay = next_tick - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        now = time.monotonic()
+        actuation_jitter_ms.append((now - next_tick) * 1000)
+        actuation_stats['ticks'] += 1
+        apply_setpoints()
+        # Ramps advance by the time actually elapsed (bounded after a stall)
+        step_motion_profiles(min(now - last_tick, 5 * period))
+        flush_servo_writes() # This tick's servo updates, in as few I2C transactions as possible
+        last_tick = now
+        # A tick that ends after the next one was due is an overrun; the
+        # missed ticks are skipped rather than run back to back
+        next_tick += period
+        now = time.monotonic()
+        if now > next_tick:
+            missed = int((now - next_tick) / period) + 1
+            actuation_stats['overruns'] += 1
+            actuation_stats['missed_ticks'] += missed
+            next_tick += missed * period
+
+def actuation_loop_stats():
+    """Tick, overrun and coalescing counts, and the lateness of the recent ticks (ms)."""
+    stats = dict(actuation_stats, rate_hz=ACTUATION_RATE_HZ,
+                 command_latency_ms_max=round(actuation_stats['command_latency_ms_max'], 2))
+    if actuation_jitter_ms:
+        jitter = sorted(actuation_jitter_ms)
+        stats['jitter_ms'] = {
+            "p50": round(jitter[len(jitter) // 2], 3),
+            "p99": round(jitter[min(len(jitter) - 1, int(len(jitter) * 0.99))], 3),
+            "max": round(jitter[-1], 3),
+        }
+    return stats
+
+def emergency_stop(received_at):
+    """Stop everything now, ahead of any pending setpoint, and cancel the sequence."""
+    drop_pending_actuation()
+    cancel_automatic_sequence("e-stop")
+    all_dc_motors_stop(force=True) # Write even if the cache says stopped
+    all_arm_servos_stop()
+    logger.info(f"E-STOP: All systems stopped {(time.perf_counter() - received_at) * 1000:.2f} ms after receipt.")
+
+
+# --- Automatic Sequence ---
+# The sequence is a task: cancelling it (e-stop, automatic mode disabled,
+# 'stop' defect reaction) raises CancelledError at whichever await it is
+# in, and its finally block stops the motors. Its waits go through
+# sequence_sleep(), which also holds the sequence during a defect dwell.
+def sequence_move(kind, target, direction, speed=DEFAULT_DC_SPEED):
+    """Start a motion of the sequence ('base' or 'servo') and remember it for dwell/resume."""
+    global sequence_motion, sequence_motion_started
+    sequence_motion = (kind, target, direction, speed)
+    sequence_motion_started = time.monotonic()
+    if time.monotonic() >= sequence_dwell_until:
+        _actuate_sequence_motion(sequence_motion, True)
+
+def sequence_halt():
+    """Stop the current motion of the sequence."""
+    global sequence_motion
+    if sequence_motion is not None:
+        _account_travel(time.monotonic())
+        _actuate_sequence_motion(sequence_motion, False)
+        sequence_motion = None
+
+def _actuate_sequence_motion(motion, is_active):
+    kind, target, direction, speed = motion
+    if kind == 'base':
+        move_robot_base(direction, is_active, speed)
+    else:
+        control_continuous_servo(target, direction, is_active)
+
+def _account_travel(now):
+    """Add the base travel of the current motion up to now (dead reckoning, in seconds at sequence speed)."""
+    global sequence_travel_s, sequence_motion_started
+    if sequence_motion is not None and sequence_motion[0] == 'base':
+        sign = 1 if sequence_motion[2] == 'forward' else -1
+        sequence_travel_s += sign * max(0.0, now - sequence_motion_started)
+    sequence_motion_started = now
+
+def sequence_position():
+    """Where the sequence is: step name and estimated base travel."""
+    travel = sequence_travel_s
+    if sequence_motion is not None and sequence_motion[0] == 'base' and time.monotonic() >= sequence_dwell_until:
+        sign = 1 if sequence_motion[2] == 'forward' else -1
+        travel += sign * (time.monotonic() - sequence_motion_started)
+    return {"step": sequence_step, "base_travel_s": round(travel, 2)}
+
+async def sequence_sleep(duration):
+    """
+    Wait for duration seconds of sequence time. A dwell stops the clock: the
+    motion stopped by the reaction is restarted after the dwell for what was
+    left of the step.
+    """
+    global sequence_motion_started
+    sleep_start = time.monotonic()
+    deadline = sleep_start + duration
+    while True:
+        if time.monotonic() < sequence_dwell_until:
+            left = max(0.0, deadline - max(sequence_dwell_started, sleep_start))
+            # Hold until the (possibly extended) dwell is over
+            while (hold := sequence_dwell_until - time.monotonic()) > 0:
+                await asyncio.sleep(hold)
+            if sequence_motion is not None:
+                logger.info("AUTOMATIC MODE: Dwell over, resuming motion.")
+                _actuate_sequence_motion(sequence_motion, True)
+            sequence_motion_started = time.monotonic()
+            sleep_start = time.monotonic()
+            deadline = sleep_start + left
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            return
+        sequence_wake_event.clear()
+        try:
+            await asyncio.wait_for(sequence_wake_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+async def run_automatic_base_sequence():
+    global sequence_step, sequence_travel_s
+    logger.info("AUTOMATIC MODE: Sequence started.")
     auto_speed_dc = DEFAULT_DC_SPEED  # Speed for DC base motors
     arm_servo_id_to_move = 0         # Servo ID 0 for the arm movement
+    sequence_travel_s = 0.0
+    completed = False
 
     try:
         # --- Part 1: DC Base Movement ---
+        sequence_step = "first advance"
         logger.info("AUTOMATIC MODE: Base advancing for 6 seconds...")
-        move_robot_base("forward", True, auto_speed_dc)
-        time.sleep(6)
-        move_robot_base("forward", False, auto_speed_dc) # Stop DC base
+        sequence_move('base', None, "forward", auto_speed_dc)
+        await sequence_sleep(6)
+        sequence_halt() # Stop DC base
         logger.info("AUTOMATIC MODE: Base stopped after first advance.")
 
         # --- Part 2: Arm Servo Maneuver during Base Pause (approx 15s slot) ---
+        sequence_step = "arm maneuver"
         logger.info(f"AUTOMATIC MODE: Starting arm servo {arm_servo_id_to_move} maneuver...")
 
         # 2a. Arm servo 0 moves "right" for 3 seconds
         logger.info(f"AUTOMATIC MODE: Arm servo {arm_servo_id_to_move} moving 'right' for 3 seconds...")
-        control_continuous_servo(arm_servo_id_to_move, "right", True)
-        time.sleep(3)
-        control_continuous_servo(arm_servo_id_to_move, "right", False) # Stop arm servo 0
+        sequence_move('servo', arm_servo_id_to_move, "right")
+        await sequence_sleep(3)
+        sequence_halt() # Stop arm servo 0
         logger.info(f"AUTOMATIC MODE: Arm servo {arm_servo_id_to_move} stopped after 'right' movement.")
-        time.sleep(1)  # Brief 1-second pause for the arm/observation
+        await sequence_sleep(1)  # Brief 1-second pause for the arm/observation
 
         # 2b. Arm servo 0 moves "left" for 4 seconds
         logger.info(f"AUTOMATIC MODE: Arm servo {arm_servo_id_to_move} moving 'left' for 4 seconds...")
-        control_continuous_servo(arm_servo_id_to_move, "left", True)
-        time.sleep(4)
-        control_continuous_servo(arm_servo_id_to_move, "left", False) # Stop arm servo 0
+        sequence_move('servo', arm_servo_id_to_move, "left")
+        await sequence_sleep(4)
+        sequence_halt() # Stop arm servo 0
         logger.info(f"AUTOMATIC MODE: Arm servo {arm_servo_id_to_move} stopped after 'left' movement.")
-        time.sleep(1)  # Brief 1-second pause for the arm/observation
+        await sequence_sleep(1)  # Brief 1-second pause for the arm/observation
 
         # 2c. Calculate and execute remaining pause time for this segment
         # Time spent in arm servo maneuvers and brief pauses: 3s (move) + 1s (pause) + 4s (move) + 1s (pause) = 9s
@@ -250,121 +642,289 @@ def run_automatic_base_sequence():
         remaining_pause_duration = 15 - (3 + 1 + 4 + 1)
         if remaining_pause_duration > 0:
             logger.info(f"AUTOMATIC MODE: Pausing DC base for an additional {remaining_pause_duration} seconds...")
-            time.sleep(remaining_pause_duration)
+            await sequence_sleep(remaining_pause_duration)
         logger.info("AUTOMATIC MODE: Arm servo maneuver and base pause segment finished.")
 
         # --- Part 3: DC Base Movement ---
+        sequence_step = "second advance"
         logger.info("AUTOMATIC MODE: Base advancing again for 6 seconds...")
-        move_robot_base("forward", True, auto_speed_dc)
-        time.sleep(6)
-        move_robot_base("forward", False, auto_speed_dc) # Stop DC base
+        sequence_move('base', None, "forward", auto_speed_dc)
+        await sequence_sleep(6)
+        sequence_halt() # Stop DC base
         logger.info("AUTOMATIC MODE: Base stopped after second advance.")
 
         # --- Part 4: DC Base Movement ---
+        sequence_step = "return"
         logger.info("AUTOMATIC MODE: Base returning to start (moving backward for 12s)...")
-        move_robot_base("backward", True, auto_speed_dc)
-        time.sleep(12)
-        move_robot_base("backward", False, auto_speed_dc) # Stop DC base
+        sequence_move('base', None, "backward", auto_speed_dc)
+        await sequence_sleep(12)
+        sequence_halt() # Stop DC base
         logger.info("AUTOMATIC MODE: Base returned to start and stopped.")
+        completed = True
 
-    except KeyboardInterrupt:
-        logger.info("AUTOMATIC MODE: Interrupted by user during sequence. Stopping all motors/servos.")
-        all_dc_motors_stop()
-        # Ensure specific arm servo being moved is also stopped
-        if 'kit' in globals() and kit is not None and arm_servo_id_to_move in CALIBRATED_STOP_THROTTLES:
-            control_continuous_servo(arm_servo_id_to_move, "", False)
-        raise # Re-raise to allow the main script's finally block to execute fully
+    except asyncio.CancelledError:
+        logger.info("AUTOMATIC MODE: Sequence cancelled.")
+        raise
     except Exception as e:
         logger.error(f"AUTOMATIC MODE: Error during sequence: {e}")
-        all_dc_motors_stop()
-        if 'kit' in globals() and kit is not None and arm_servo_id_to_move in CALIBRATED_STOP_THROTTLES:
-            control_continuous_servo(arm_servo_id_to_move, "", False)
     finally:
-        # Ensure the specific arm servo used in the sequence is explicitly stopped
-        # in case the sequence ended mid-servo-maneuver due to an error other than KeyboardInterrupt
-        if 'kit' in globals() and kit is not None and arm_servo_id_to_move in CALIBRATED_STOP_THROTTLES:
-             if not isinstance(e, KeyboardInterrupt): # if not already handled by specific except
-                logger.info(f"AUTOMATIC MODE: Ensuring arm servo {arm_servo_id_to_move} is stopped post-sequence.")
-                control_continuous_servo(arm_servo_id_to_move, "", False)
-        logger.info("AUTOMATIC MODE: Sequence function finished or was interrupted.")
+        # Ensure the base and the arm servo used in the sequence are stopped,
+        # whether the sequence finished, was cancelled or failed
+        # (ramped down; an e-stop has already cut them)
+        sequence_halt()
+        move_robot_base("stop", False)
+        if kit is not None and arm_servo_id_to_move in CALIBRATED_STOP_THROTTLES:
+            control_continuous_servo(arm_servo_id_to_move, "", False)
+        logger.info(f"AUTOMATIC MODE: Sequence {'finished' if completed else 'ended early'}. "
+                    f"Defect triggers: {defect_stats()}")
+        sequence_step = ""
+        send_to_server({"type": "automatic_completed"})
+
+def sequence_running():
+    return sequence_task is not None and not sequence_task.done()
+
+def start_automatic_sequence():
+    global sequence_task, sequence_dwell_until
+    if sequence_running():
+        logger.warning("AUTOMATIC MODE: Sequence already running, ignoring start request.")
+        return
+    sequence_dwell_until = 0.0
+    defect_latencies.clear()
+    sequence_task = asyncio.get_running_loop().create_task(run_automatic_base_sequence())
+
+def cancel_automatic_sequence(reason):
+    if sequence_running():
+        logger.info(f"AUTOMATIC MODE: Cancelling sequence ({reason}).")
+        sequence_task.cancel()
+
+
+# --- Defect-Triggered Reaction ---
+def handle_detection_result(data, received_at):
+    """
+    React to a detection result (from the edge detector or the server) while
+    the automatic sequence runs: the most confident defect at or above
+    DEFECT_MIN_CONFIDENCE triggers DEFECT_REACTION. received_at is the
+    time.perf_counter() at which the result reached the controller.
+    """
+    global sequence_dwell_started, sequence_dwell_until, last_defect_trigger
+    if not sequence_running():
+        return
+    defects = [d for d in data.get('detections', [])
+               if d.get('class_name') in DEFECT_CLASSES and d.get('confidence', 0) >= DEFECT_MIN_CONFIDENCE]
+    if not defects:
+        return
+    now = time.monotonic()
+    if now - last_defect_trigger < DEFECT_COOLDOWN_S:
+        return # Most likely the same bolt, still in view
+    last_defect_trigger = now
+    defect = max(defects, key=lambda d: d['confidence'])
+    # Taken before a 'stop' cancels the sequence
+    position = sequence_position()
+
+    # Actuate first, measure and report afterwards
+    if DEFECT_REACTION == 'stop':
+        drop_pending_actuation()
+        all_dc_motors_stop()
+        if sequence_motion is not None and sequence_motion[0] == 'servo':
+            stop_continuous_servo_now(sequence_motion[1])
+            flush_servo_writes()
+        cancel_automatic_sequence("defect")
+    elif DEFECT_REACTION == 'dwell':
+        if now >= sequence_dwell_until:
+            _account_travel(now)
+            sequence_dwell_started = now
+            if sequence_motion is not None:
+                _actuate_sequence_motion(sequence_motion, False)
+        sequence_dwell_until = max(sequence_dwell_until, now + DEFECT_DWELL_S)
+        sequence_wake_event.set()
+    actuated_at = time.perf_counter()
+
+    # Detection side: capture to result published. Edge results carry a
+    # capture time on this clock, so capture to actuation is exact for them;
+    # for server results the network hop to the Pi is not included.
+    receive_to_actuation_ms = (actuated_at - received_at) * 1000
+    if data.get('source') == 'edge' and data.get('capture_ts'):
+        capture_to_actuation_ms = time.time() * 1000 - data['capture_ts']
+    else:
+        capture_to_actuation_ms = data.get('age_ms', 0) + receive_to_actuation_ms
+    defect_latencies.append(capture_to_actuation_ms)
+    over_budget = capture_to_actuation_ms > DEFECT_LATENCY_BUDGET_MS
+
+    event = {
+        "type": "defect_event",
+        "reaction": DEFECT_REACTION,
+        "class_name": defect['class_name'],
+        "confidence": defect['confidence'],
+        "box": defect.get('box'),
+        "source": data.get('source', 'server'),
+        "capture_ts": data.get('capture_ts'),
+        "position": position,
+        "latency_ms": {
+            "detection": round(data.get('age_ms', 0), 1),
+            "receive_to_actuation": round(receive_to_actuation_ms, 2),
+            "capture_to_actuation": round(capture_to_actuation_ms, 1),
+        },
+        "over_budget": over_budget,
+    }
+    log = logger.warning if over_budget else logger.info
+    log(f"DEFECT: {defect['class_name']} ({defect['confidence']:.2f}) at {position['step']}, "
+        f"travel {position['base_travel_s']}s -> {DEFECT_REACTION.upper()}; "
+        f"capture to actuation {capture_to_actuation_ms:.0f} ms (budget {DEFECT_LATENCY_BUDGET_MS:.0f} ms), "
+        f"receive to actuation {receive_to_actuation_ms:.2f} ms")
+    send_to_server(event)
+
+def defect_stats():
+    """Count, mean and max capture-to-actuation latency of this sequence's triggers."""
+    if not defect_latencies:
+        return {"triggers": 0}
+    return {"triggers": len(defect_latencies),
+            "mean_latency_ms": round(sum(defect_latencies) / len(defect_latencies), 1),
+            "max_latency_ms": round(max(defect_latencies), 1)}
+
+
+# --- Edge Detection ---
+async def run_edge_detector():
+    """Run edge_detector.py, react to and publish its results, and restart it if it exits."""
+    while True:
+        command = [sys.executable, EDGE_DETECTOR_SCRIPT] + EDGE_DETECTOR_ARGS
+        logger.info(f"EDGE: starting detector: {' '.join(command)}")
+        try:
+            process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE)
+        except OSError as e:
+            logger.error(f"EDGE: could not start detector: {e}")
+        else:
+            try:
+                async for line in process.stdout:
+                    received_at = time.perf_counter()
+                    line = line.decode('utf-8', 'replace').strip()
+                    if not line:
+                        continue
+                    try:
+                        data = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"EDGE: ignoring malformed output line: {line[:200]}")
+                        continue
+                    # React before publishing: the reaction is on the latency budget
+                    handle_detection_result(data, received_at)
+                    send_to_server(line) # Not connected: results are dropped, not queued
+                return_code = await process.wait()
+                logger.warning(f"EDGE: detector exited with code {return_code}.")
+            finally:
+                if process.returncode is None:
+                    logger.info("EDGE: stopping detector...")
+                    process.terminate()
+                    try:
+                        await asyncio.wait_for(process.wait(), 5)
+                    except asyncio.TimeoutError:
+                        process.kill()
+        logger.info(f"EDGE: restarting detector in {EDGE_RESTART_DELAY_S}s...")
+        await asyncio.sleep(EDGE_RESTART_DELAY_S)
+
+
+# --- WebSocket ---
+def send_to_server(message):
+    """Queue a message (dict or JSON text) for the server; dropped when not connected or backed up."""
+    if current_ws is None:
+        return
+    try:
+        outgoing_queue.put_nowait(message if isinstance(message, str) else json.dumps(message))
+    except asyncio.QueueFull:
+        logger.debug("Outgoing queue full, dropping message.")
+
+async def send_outgoing(ws):
+    while True:
+        message = await outgoing_queue.get()
+        await ws.send(message)
+
+# --- Message Handlers ---
+# One handler per message type, looked up in MESSAGE_HANDLERS. Each takes
+# the parsed message and the time.perf_counter() at which it was received.
+def handle_command(data, received_at):
+    action = data.get('action', '').lower()
+    if action == 'stop':
+        logger.info("COMMAND RECEIVED: E-STOP - Stopping all systems.")
+        emergency_stop(received_at)
+    else:
+        logger.warning(f"Received 'command' type with unknown action: '{action}'")
+
+def handle_control(data, received_at): # For DC motor base (locomotion)
+    dc_speed = data.get('speed', DEFAULT_DC_SPEED)
+    if type(dc_speed) is not int or not 0 <= dc_speed <= 100: # Fast path for well-formed values
+        try:
+            dc_speed = max(0, min(100, int(dc_speed)))
+        except (ValueError, TypeError):
+            log_hot('bad_speed', f"Invalid DC motor speed value '{dc_speed}'. Using default {DEFAULT_DC_SPEED}.", logging.WARNING)
+            dc_speed = DEFAULT_DC_SPEED
+    set_setpoint('base', move_robot_base, data.get('direction', ''), data.get('isActive', False), dc_speed,
+                 received_at=received_at)
+
+def handle_servo(data, received_at): # For ALL arm servos (continuous or positional)
+    motor_id_val = data.get('motor_id')
+    try:
+        motor_id = int(motor_id_val)
+    except (ValueError, TypeError):
+        log_hot('bad_servo', f"ARM_SERVO CMD: motor_id '{motor_id_val}' is not a valid integer.", logging.WARNING)
+        return
 
+    # Positional servo (S1 - Wrist): the angle comes in the 'direction' field
+    if motor_id == POSITIONAL_SERVO_CHANNEL_S1:
+        try:
+            target_angle = float(data['direction'])
+        except (KeyError, ValueError, TypeError):
+            log_hot('bad_servo', f"ARM_SERVO CMD (Positional): Invalid or missing angle '{data.get('direction')}' for motor {motor_id}.", logging.WARNING)
+            return
+        set_setpoint(('servo', motor_id), set_positional_servo_angle, motor_id, target_angle,
+                     received_at=received_at)
+
+    # Continuous servos: "left" or "right" while active
+    elif motor_id in CONTINUOUS_SERVO_CHANNELS_ARM:
+        value_direction_str = data.get('value', '').lower()
+        is_active_servo = data.get('is_active', False)
+        if value_direction_str not in ("left", "right") and is_active_servo:
+            log_hot('bad_servo', f"ARM_SERVO CMD (Continuous): Invalid value_direction '{value_direction_str}' for motor {motor_id} while active. Stopping servo.", logging.WARNING)
+            value_direction_str, is_active_servo = "", False # Force stop
+        set_setpoint(('servo', motor_id), control_continuous_servo, motor_id, value_direction_str, is_active_servo,
+                     received_at=received_at)
+
+    else:
+        log_hot('bad_servo', f"ARM_SERVO CMD: motor_id {motor_id} not configured for arm control.", logging.WARNING)
 
-# --- WebSocket Event Handlers (Modified on_message) ---
-def on_message(ws, message):
+def handle_automatic(data, received_at):
+    if data.get('enabled', True):
+        logger.info("WebSocket command received to START automatic base sequence.")
+        start_automatic_sequence()
+    else:
+        cancel_automatic_sequence("automatic mode disabled")
+
+def handle_stats(data, received_at):
+    send_to_server(dict(controller_stats(), type="controller_stats"))
+
+MESSAGE_HANDLERS = {
+    'command': handle_command,
+    'control': handle_control,
+    'servo': handle_servo,
+    'automatic': handle_automatic,
+    'detection_result': handle_detection_result, # From the server during automatic mode
+    'stats': handle_stats,
+}
+
+def on_message(message):
+    received_at = time.perf_counter()
     try:
         data = json.loads(message)
-        message_type = data.get('type', '').lower()
-        logger.debug(f"Received message: {data}")
-
-        if message_type == 'command':
-            action = data.get('action', '').lower()
-            if action == 'stop':
-                logger.info("COMMAND RECEIVED: E-STOP - Stopping all systems.")
-                all_dc_motors_stop()
-                all_arm_servos_stop()
-                return
-            else:
-                logger.warning(f"Received 'command' type with unknown action: '{action}'")
-
-        elif message_type == 'control': # For DC motor base (locomotion)
-            direction = data.get('direction', '')
-            is_active = data.get('isActive', False)
-            dc_speed_val = data.get('speed', DEFAULT_DC_SPEED)
-            try:
-                dc_speed = int(dc_speed_val)
-                if not (0 <= dc_speed <= 100):
-                    logger.warning(f"DC motor speed {dc_speed} (from {dc_speed_val}) out of range (0-100). Clamping.")
-                    dc_speed = max(0, min(100, dc_speed))
-            except (ValueError, TypeError):
-                logger.warning(f"Invalid DC motor speed value '{dc_speed_val}'. Using default {DEFAULT_DC_SPEED}.")
-                dc_speed = DEFAULT_DC_SPEED
-            move_robot_base(direction, is_active, dc_speed)
-
-        elif message_type == 'servo': # For ALL arm servos (continuous or positional)
-            motor_id_val = data.get('motor_id')
-            motor_id = -1 # Default to invalid
-
-            # Try to parse motor_id as integer
-            try:
-                motor_id = int(motor_id_val)
-            except (ValueError, TypeError):
-                logger.warning(f"ARM_SERVO CMD: motor_id '{motor_id_val}' is not a valid integer.")
-                return # Invalid motor_id format
-
-            # Check if it's the positional servo (S1 - Wrist)
-            if motor_id == POSITIONAL_SERVO_CHANNEL_S1:
-                angle_val = data.get('direction') # Using 'direction' field for angle as requested
-                if angle_val is None:
-                    logger.warning(f"ARM_SERVO CMD (Positional): 'direction' (angle) field missing for motor {motor_id}.")
-                    return
-                try:
-                    target_angle = float(angle_val)
-                    set_positional_servo_angle(motor_id, target_angle)
-                except ValueError:
-                    logger.warning(f"ARM_SERVO CMD (Positional): Invalid angle value '{angle_val}' for motor {motor_id}.")
-            
-            # Check if it's one of the continuous servos
-            elif motor_id in CONTINUOUS_SERVO_CHANNELS_ARM:
-                value_direction_str = data.get('value', '').lower() # "left" or "right"
-                is_active_servo = data.get('is_active', False) # For continuous, is_active matters
-
-                if value_direction_str not in ["left", "right"] and is_active_servo:
-                    logger.warning(f"ARM_SERVO CMD (Continuous): Invalid value_direction '{value_direction_str}' for motor {motor_id} while active. Stopping servo.")
-                    control_continuous_servo(motor_id, "", False) # Force stop
-                    return
-                control_continuous_servo(motor_id, value_direction_str, is_active_servo)
-            
-            else: # motor_id is not recognized for any arm servo
-                logger.warning(f"ARM_SERVO CMD: motor_id {motor_id} not configured for arm control.")
-
-        elif message_type == 'automatic':
-            logger.info("WebSocket command received to START automatic base sequence.")
-            logger.warning(">>> Automatic sequence will BLOCK ALL OTHER WebSocket commands until finished. <<<")
-            run_automatic_base_sequence()
-            logger.info("Automatic base sequence completed. Resuming WebSocket listening.")
-        
-        else:
-            logger.warning(f"Received unknown message type: '{message_type}'")
+        message_type = data.get('type', '')
+        handler = MESSAGE_HANDLERS.get(message_type)
+        if handler is None:
+            message_type = str(message_type).lower()
+            handler = MESSAGE_HANDLERS.get(message_type)
+        if handler is None:
+            controller_counters['unknown_messages'] += 1
+            log_hot('unknown', f"Received unknown message type: '{message_type}'", logging.WARNING)
+            return
+        counts = controller_counters['messages']
+        counts[message_type] = counts.get(message_type, 0) + 1
+        handler(data, received_at)
+        controller_counters['dispatch_ms'] += (time.perf_counter() - received_at) * 1000
 
     except json.JSONDecodeError:
         logger.error(f"Error decoding JSON: {message}")
@@ -373,27 +933,79 @@ def on_message(ws, message):
         import traceback
         logger.error(traceback.format_exc())
 
-# --- on_error, on_close, on_open, connect_websocket (Keep as before) ---
-def on_error(ws, error): logger.error(f"WebSocket error: {error}")
-def on_close(ws, close_status_code, close_msg):
-    logger.warning(f"WS closed. Code: {close_status_code}, Msg: {close_msg}. Reconnecting...")
-    time.sleep(5); connect_websocket()
-def on_open(ws):
-    logger.info("Connection established to server")
-    ws.send(json.dumps({"type": "identity", "device": "raspberry_pi"}))
-def connect_websocket():
-    logger.info(f"Connecting to {SERVER_URL}...")
-    ws = websocket.WebSocketApp(SERVER_URL, on_open=on_open, on_message=on_message, on_error=on_error, on_close=on_close)
-    ws.run_forever()
+async def report_controller_stats():
+    """Send the dispatch and actuation counters to the server every CONTROLLER_STATS_INTERVAL_S."""
+    while True:
+        await asyncio.sleep(CONTROLLER_STATS_INTERVAL_S)
+        stats = controller_stats()
+        logger.debug(f"Controller stats: {stats}")
+        send_to_server(dict(stats, type="controller_stats"))
+
+async def websocket_loop():
+    """Connect to the server, handle its messages and reconnect whenever the connection drops."""
+    global current_ws
+    while True:
+        logger.info(f"Connecting to {SERVER_URL}...")
+        try:
+            async with websockets.connect(SERVER_URL) as ws:
+                logger.info("Connection established to server")
+                await ws.send(json.dumps({"type": "identity", "device": "raspberry_pi"}))
+                current_ws = ws
+                if command_trace is not None:
+                    command_trace.start_session()
+                sender = asyncio.get_running_loop().create_task(send_outgoing(ws))
+                try:
+                    async for message in ws:
+                        if command_trace is not None:
+                            command_trace.write(message)
+                        on_message(message)
+                finally:
+                    current_ws = None
+                    sender.cancel()
+                    while not outgoing_queue.empty():
+                        outgoing_queue.get_nowait()
+            logger.warning("WS closed.")
+        except (OSError, websockets.exceptions.WebSocketException) as e:
+            logger.error(f"WebSocket error: {e}")
+        logger.warning(f"Reconnecting in {WS_RECONNECT_DELAY_S}s...")
+        await asyncio.sleep(WS_RECONNECT_DELAY_S)
+
+async def main():
+    global outgoing_queue, sequence_wake_event, command_trace
+    outgoing_queue = asyncio.Queue(maxsize=WS_OUTGOING_QUEUE_SIZE)
+    sequence_wake_event = asyncio.Event()
+    if COMMAND_TRACE_PATH:
+        command_trace = TraceWriter(COMMAND_TRACE_PATH)
+        logger.info(f"Recording received commands to {COMMAND_TRACE_PATH}.")
+
+    tasks = [asyncio.create_task(actuation_loop()), asyncio.create_task(websocket_loop()),
+             asyncio.create_task(report_controller_stats())]
+    if EDGE_DETECTION_ENABLED:
+        logger.info("Edge detection enabled: running the detector on the Pi.")
+        tasks.append(asyncio.create_task(run_edge_detector()))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        cancel_automatic_sequence("shutdown")
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, *([sequence_task] if sequence_task else []), return_exceptions=True)
+        if command_trace is not None:
+            command_trace.close()
 
 # --- Main Execution ---
 if __name__ == "__main__":
     try:
         setup_dc_motors_gpio()
         setup_arm_servos()
+        setup_motion_profiles()
+        if DEFECT_REACTION not in ('stop', 'dwell', 'log'):
+            logger.warning(f"Unknown DEFECT_REACTION '{DEFECT_REACTION}', defects will only be logged.")
+        logger.info(f"Defect reaction in automatic mode: {DEFECT_REACTION} on {', '.join(DEFECT_CLASSES)} "
+                    f">= {DEFECT_MIN_CONFIDENCE:.2f}, latency budget {DEFECT_LATENCY_BUDGET_MS:.0f} ms")
         logger.info("Starting Raspberry Pi robot controller.")
         logger.info("Listening for WebSocket commands.")
-        connect_websocket()
+        asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Program interrupted by user (Ctrl+C).")
     except Exception as e:
@@ -401,6 +1013,7 @@ if __name__ == "__main__":
         import traceback; logger.error(traceback.format_exc())
     finally:
         logger.info("Initiating shutdown sequence...")
+        logger.info(f"Controller stats: {controller_stats()}")
         all_dc_motors_stop()
         all_arm_servos_stop()
         cleanup_dc_motors_gpio()
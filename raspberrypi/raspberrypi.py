@@ -1,9 +1,13 @@
+# Older, callback-based Pi controller (rasp2.py is the asyncio one). Pi dependencies:
+# websocket-client (`pip install websocket-client`, imported as websocket; not
+# the websockets package of rasp2.py), RPi.GPIO and adafruit-circuitpython-servokit.
 import websocket
 import json
 import time
 import logging
-import RPi.GPIO as GPIO
-from adafruit_servokit import ServoKit # Added for arm servos
+import hal # RPi.GPIO and ServoKit, or their simulation with ROBOT_HARDWARE=sim
+
+GPIO = hal.load_gpio()
 
 # Set up logging
 logging.basicConfig(level=logging.INFO,
@@ -75,7 +79,7 @@ def setup_arm_servos():
     global kit
     logger.info("Setting up ServoKit for Arm Servos...")
     try:
-        kit = ServoKit(channels=16, address=SERVO_PCA_ADDRESS, frequency=SERVO_PWM_FREQUENCY)
+        kit = hal.servo_kit(SERVO_PCA_ADDRESS, SERVO_PWM_FREQUENCY)
         logger.info(f"ServoKit initialized (PCA9685 on I2C addr 0x{SERVO_PCA_ADDRESS:02X}, Freq: {SERVO_PWM_FREQUENCY}Hz).")
         # Set initial state for defined continuous arm servos
         for motor_id in SERVO_ARM_CHANNELS:
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+os.environ.setdefault('ROBOT_HARDWARE', 'sim')
+
+import rasp2  # noqa: E402
+from motion_profile import RampGenerator  # noqa: E402
+
+DT = 0.01
+
+MOVES = [
+    (rasp2.BASE_RAMP_LIMITS, 0, 100),
+    (rasp2.BASE_RAMP_LIMITS, 100, 0),
+    (rasp2.BASE_RAMP_LIMITS, -100, 100),
+    (rasp2.SERVO_THROTTLE_RAMP_LIMITS, rasp2.CALIBRATED_STOP_THROTTLES[0], rasp2.SERVO_MOVEMENT_THROTTLE_VALUE),
+    (rasp2.SERVO_THROTTLE_RAMP_LIMITS, rasp2.SERVO_MOVEMENT_THROTTLE_VALUE, rasp2.CALIBRATED_STOP_THROTTLES[0]),
+    (rasp2.SERVO_THROTTLE_RAMP_LIMITS, rasp2.CALIBRATED_STOP_THROTTLES[0], -rasp2.SERVO_MOVEMENT_THROTTLE_VALUE),
+    (rasp2.S1_SWEEP_LIMITS, 90, 45),
+    (rasp2.S1_SWEEP_LIMITS, 90, 180),
+    (rasp2.S1_SWEEP_LIMITS, 0, 180),
+    (rasp2.S1_SWEEP_LIMITS, 90, 90.3),
+]
+
+
+@pytest.mark.parametrize("limits, start, target", MOVES)
+def test_ramp_stays_within_limits(limits, start, target):
+    ramp = RampGenerator(**limits, value=start)
+    ramp.set_target(target)
+    direction = 1 if target > start else -1
+    tolerance = 1e-9 * max(1.0, limits['max_acceleration'])
+    value, velocity = ramp.value, ramp.velocity
+    for _ in range(10_000):
+        if ramp.done:
+            break
+        ramp.step(DT)
+        assert (ramp.value - value) * direction >= 0, "position reversed"
+        assert abs(ramp.velocity) <= limits['max_velocity'] + tolerance
+        assert abs(ramp.velocity - velocity) / DT <= limits['max_acceleration'] + tolerance
+        value, velocity = ramp.value, ramp.velocity
+    assert ramp.done
+    assert ramp.value == target